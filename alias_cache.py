@@ -0,0 +1,70 @@
+# Persistent SQLite cache of node aliases, keyed by pubkey.
+# Entries expire after a TTL and the least recently used entries are evicted once
+# the cache grows past its size limit. On a miss only that pubkey is fetched, via
+# the fetch function passed in by the caller (e.g. a getnodeinfo call), which returns
+# None when the alias cannot be fetched; such pubkeys are left out, to be fetched again
+# next time, and callers apply their own fallback.
+
+import sqlite3
+import threading
+import time
+
+class AliasCache:
+    def __init__(self, path, ttl=7 * 86400, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS node_aliases (
+                pubkey TEXT PRIMARY KEY,
+                alias TEXT NOT NULL,
+                fetched_at REAL NOT NULL,
+                last_used REAL NOT NULL
+            )""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS node_aliases_last_used ON node_aliases (last_used)")
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get(self, pubkey, fetch):
+        return self.get_many([pubkey], fetch).get(pubkey)
+
+    # Look up many pubkeys with one query, fetching only the missing or expired ones
+    def get_many(self, pubkeys, fetch):
+        pubkeys = list(dict.fromkeys(pubkeys))
+        now = time.time()
+        with self.lock:
+            aliases = {}
+            for start in range(0, len(pubkeys), 500):
+                chunk = pubkeys[start:start + 500]
+                rows = self.conn.execute(
+                    f"SELECT pubkey, alias FROM node_aliases WHERE fetched_at >= ? AND pubkey IN ({', '.join('?' * len(chunk))})",
+                    [now - self.ttl] + chunk)
+                aliases.update(rows)
+
+        missing = [pubkey for pubkey in pubkeys if pubkey not in aliases]
+        fetched = {pubkey: alias for pubkey, alias in zip(missing, map(fetch, missing)) if alias is not None}
+        aliases.update(fetched)
+
+        with self.lock, self.conn:
+            self.conn.executemany("UPDATE node_aliases SET last_used = ? WHERE pubkey = ?",
+                                  ((now, pubkey) for pubkey in pubkeys if pubkey not in missing))
+            self.conn.executemany("INSERT OR REPLACE INTO node_aliases (pubkey, alias, fetched_at, last_used) VALUES (?, ?, ?, ?)",
+                                  ((pubkey, alias, now, now) for pubkey, alias in fetched.items()))
+            if fetched:
+                self._evict()
+        return aliases
+
+    # Drop the least recently used entries beyond max_entries
+    def _evict(self):
+        self.conn.execute(
+            "DELETE FROM node_aliases WHERE pubkey IN (SELECT pubkey FROM node_aliases ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,))
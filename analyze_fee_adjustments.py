@@ -1,64 +1,324 @@
 #!/usr/bin/env python
 # coding: utf-8
 
-# In[2]:
+# Analysis of the fee adjustment data collected by fee_setting_agent.py. Rows are read from
+# the configured data store in chunks and folded into per-run, per-channel and per-reason
+# aggregates, together with the fees and volume of the forwarding events in the local event
+# store. The aggregates are cached, so a rerun after a new batch only reads the new rows and
+# events. Tables are written as CSV files and plots are rendered to PNG files.
+#
+#   python analyze_fee_adjustments.py               # update the cache, write tables and plots
+#   python analyze_fee_adjustments.py --rebuild     # ignore the cache and read everything again
+#   python analyze_fee_adjustments.py --no-plots --top 20
 
+import argparse
+import csv
+import json
+import os
+from datetime import datetime, timezone
 
-import pandas as pd
+import numpy as np
 
-# Load the data
-data = pd.read_csv('fee_adjustment_data.csv')
+import fee_setting_agent as agent
+from data_store import DATE_FORMAT
+from event_store import ForwardingEventStore
 
-# Convert the 'Date' column to datetime format
-data['Date'] = pd.to_datetime(data['Date'])
+# Configuration parameters
+ANALYSIS_CACHE_FILE = "fee_analysis_cache.json"  # Aggregates and store positions kept between runs
+ANALYSIS_CHUNK_ROWS = 1000000  # Rows or events read at a time, so memory use does not grow with the history
+RUN_GAP = 600  # Rows less than this many seconds after the previous row belong to the same run
+OUTPUT_DIR = "."  # Folder for the CSV tables and plots
+TOP_CHANNELS = 10  # Channels printed and plotted, by fees earned
 
-# Sort data by date
-data = data.sort_values(by='Date')
+STRATEGIES = ['rule', 'q_learning', 'random']
+DATA_FIELDS = ['timestamp', 'chan_id', 'alias', 'increase', 'reason', 'adjustment_amount', 'reward', 'next_state']
 
-# Group by the run time (assuming all rows within a few minutes belong to the same run)
-# Adjust the time floor to match your script run intervals. Here it's floored to the nearest hour.
-data['Run'] = data['Date'].dt.floor('H')
+# Function to name the strategy behind a reason written by fee_setting_agent.py
+def reason_strategy(reason):
+    if reason == 'Q-Learning decision':
+        return 'q_learning'
+    if reason == 'Random decision':
+        return 'random'
+    return 'rule'
 
-# Calculate cumulative rewards for each run
-cumulative_rewards = data.groupby('Run')['Reward'].sum().cumsum().reset_index()
-cumulative_rewards.columns = ['Run', 'Cumulative Reward']
+def format_time(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime(DATE_FORMAT)
 
-# Calculate the difference from the previous run
-cumulative_rewards['Difference from Previous Run'] = cumulative_rewards['Cumulative Reward'].diff().fillna(0)
+# Function to start an empty cache for the configured data store
+def new_cache(source):
+    return {'source': source, 'data_position': 0, 'event_index': 0, 'last_timestamp': None,
+            'runs': [], 'channels': {}, 'reasons': {}}
 
-# Print the results
-print(cumulative_rewards)
+def new_channel(alias=''):
+    return {'alias': alias, 'rows': 0, 'increases': 0, 'reward': 0.0, 'adjustment': 0.0, 'last_state': None,
+            'forwards_in': 0, 'forwards_out': 0, 'fee_msat': 0, 'volume_msat': 0}
 
-# Save the cumulative rewards and differences to a CSV file
-cumulative_rewards.to_csv('cumulative_rewards_analysis.csv', index=False)
+def new_run(timestamp):
+    return {'time': timestamp, 'rows': 0, 'increases': 0, 'reward': 0.0, 'rewards': dict.fromkeys(STRATEGIES, 0.0),
+            'forwards': 0, 'fee_msat': 0, 'volume_msat': 0}
 
-# Plot cumulative reward over time
-import matplotlib.pyplot as plt
+# Function to load the cache, starting again if it was built from another store or the store was reset
+def load_cache(path, source, position):
+    if path and os.path.isfile(path):
+        try:
+            with open(path) as file:
+                cache = json.load(file)
+            if cache.get('source') == source and cache.get('data_position', 0) <= position:
+                return cache
+            print("The data store changed since the cache was written; rebuilding the analysis.")
+        except (OSError, ValueError) as error:
+            print(f"Error loading analysis cache: {error}; rebuilding the analysis.")
+    return new_cache(source)
 
-plt.figure(figsize=(10, 6))
-plt.plot(cumulative_rewards['Run'], cumulative_rewards['Cumulative Reward'], label='Cumulative Reward')
-plt.xlabel('Date')
-plt.ylabel('Cumulative Reward')
-plt.title('Cumulative Reward Over Time')
-plt.legend()
-plt.grid(True)
-plt.savefig('cumulative_reward_over_time_analysis.png')
-plt.show()
+# Function to write the cache atomically, so an interrupted run leaves the previous one in place
+def save_cache(path, cache):
+    temp_path = path + '.tmp'
+    with open(temp_path, mode='w') as file:
+        json.dump(cache, file)
+    os.replace(temp_path, path)
 
-# Plot the difference in cumulative reward between runs
-plt.figure(figsize=(10, 6))
-plt.bar(cumulative_rewards['Run'], cumulative_rewards['Difference from Previous Run'], label='Difference from Previous Run')
-plt.xlabel('Date')
-plt.ylabel('Difference in Cumulative Reward')
-plt.title('Difference in Cumulative Reward Between Runs')
-plt.legend()
-plt.grid(True)
-plt.savefig('difference_in_cumulative_reward_between_runs.png')
-plt.show()
+# Function to fold one chunk of fee adjustment rows into the run, channel and reason aggregates
+def add_data_chunk(cache, data):
+    timestamps = data['timestamp']
+    if len(timestamps) == 0:
+        return
+    reward = np.nan_to_num(data['reward'])
+    increase = data['increase'].astype(np.int64)
 
+    # A row starts a new run when it is more than RUN_GAP after the previous one
+    previous = np.empty_like(timestamps)
+    previous[1:] = timestamps[:-1]
+    previous[0] = timestamps[0] - RUN_GAP - 1 if cache['last_timestamp'] is None else cache['last_timestamp']
+    starts = timestamps - previous > RUN_GAP
+    run_index = np.cumsum(starts) - 1
+    if not starts[0]:
+        run_index += 1  # The first rows continue the last cached run
+        first_run = len(cache['runs']) - 1
+    else:
+        first_run = len(cache['runs'])
+    cache['runs'].extend(new_run(int(timestamp)) for timestamp in timestamps[starts].tolist())
+    cache['last_timestamp'] = int(timestamps[-1])
 
-# In[ ]:
+    reasons, reason_index = np.unique(data['reason'].astype(str), return_inverse=True)
+    strategy_codes = np.array([STRATEGIES.index(reason_strategy(reason)) for reason in reasons.tolist()], dtype=np.int64)
+    num_runs = int(run_index[-1]) + 1
+    run_rows = np.bincount(run_index, minlength=num_runs)
+    run_increases = np.bincount(run_index, weights=increase, minlength=num_runs)
+    run_rewards = np.bincount(run_index * len(STRATEGIES) + strategy_codes[reason_index], weights=reward,
+                              minlength=num_runs * len(STRATEGIES)).reshape(num_runs, len(STRATEGIES))
+    for offset, run in enumerate(cache['runs'][first_run:first_run + num_runs]):
+        run['rows'] += int(run_rows[offset])
+        run['increases'] += int(run_increases[offset])
+        run['reward'] += float(run_rewards[offset].sum())
+        for strategy, value in zip(STRATEGIES, run_rewards[offset].tolist()):
+            run['rewards'][strategy] += value
 
+    chan_ids, chan_index = np.unique(data['chan_id'].astype(str), return_inverse=True)
+    chan_rows = np.bincount(chan_index, minlength=len(chan_ids))
+    chan_increases = np.bincount(chan_index, weights=increase, minlength=len(chan_ids))
+    chan_rewards = np.bincount(chan_index, weights=reward, minlength=len(chan_ids))
+    chan_adjustments = np.bincount(chan_index, weights=np.nan_to_num(data['adjustment_amount']), minlength=len(chan_ids))
+    # The last row per channel holds its latest alias and fee rate state
+    last_rows = np.full(len(chan_ids), -1)
+    np.maximum.at(last_rows, chan_index, np.arange(len(chan_index)))
+    for i, chan_id in enumerate(chan_ids.tolist()):
+        channel = cache['channels'].setdefault(chan_id, new_channel())
+        channel['alias'] = str(data['alias'][last_rows[i]])
+        channel['rows'] += int(chan_rows[i])
+        channel['increases'] += int(chan_increases[i])
+        channel['reward'] += float(chan_rewards[i])
+        channel['adjustment'] += float(chan_adjustments[i])
+        next_state = float(data['next_state'][last_rows[i]])
+        channel['last_state'] = None if np.isnan(next_state) else next_state
 
+    reason_rows = np.bincount(reason_index, minlength=len(reasons))
+    reason_increases = np.bincount(reason_index, weights=increase, minlength=len(reasons))
+    reason_rewards = np.bincount(reason_index, weights=reward, minlength=len(reasons))
+    for i, reason in enumerate(reasons.tolist()):
+        totals = cache['reasons'].setdefault(reason, {'strategy': reason_strategy(reason), 'rows': 0, 'increases': 0, 'reward': 0.0})
+        totals['rows'] += int(reason_rows[i])
+        totals['increases'] += int(reason_increases[i])
+        totals['reward'] += float(reason_rewards[i])
 
+# Function to fold one chunk of forwarding events into the channel and run aggregates. Fees and
+# outgoing volume are credited to the outgoing channel, and to the run in effect at the time.
+def add_event_chunk(cache, rows):
+    event_index, timestamp_ns, chan_id_in, chan_id_out, amt_in_msat, amt_out_msat, fee_msat = zip(*rows)
+    amt_out_msat = np.array(amt_out_msat, dtype=np.int64)
+    fee_msat = np.array(fee_msat, dtype=np.int64)
 
+    chan_ids, chan_index = np.unique(np.array(chan_id_out + chan_id_in, dtype=str), return_inverse=True)
+    out_index, in_index = chan_index[:len(rows)], chan_index[len(rows):]
+    forwards_out = np.bincount(out_index, minlength=len(chan_ids))
+    forwards_in = np.bincount(in_index, minlength=len(chan_ids))
+    # Sums of int64 weights stay exact in float64 up to about 9000 BTC per channel and chunk
+    fees = np.bincount(out_index, weights=fee_msat, minlength=len(chan_ids))
+    volume = np.bincount(out_index, weights=amt_out_msat, minlength=len(chan_ids))
+    for i, chan_id in enumerate(chan_ids.tolist()):
+        channel = cache['channels'].setdefault(chan_id, new_channel())
+        channel['forwards_in'] += int(forwards_in[i])
+        channel['forwards_out'] += int(forwards_out[i])
+        channel['fee_msat'] += int(fees[i])
+        channel['volume_msat'] += int(volume[i])
+
+    if cache['runs']:
+        run_times = np.array([run['time'] for run in cache['runs']], dtype=np.int64)
+        run_index = np.searchsorted(run_times, np.array(timestamp_ns, dtype=np.int64) // 1000000000, side='right') - 1
+        attributed = run_index >= 0  # Events before the first run belong to no run
+        run_index = run_index[attributed]
+        forwards = np.bincount(run_index, minlength=len(run_times))
+        run_fees = np.bincount(run_index, weights=fee_msat[attributed], minlength=len(run_times))
+        run_volume = np.bincount(run_index, weights=amt_out_msat[attributed], minlength=len(run_times))
+        for i in np.flatnonzero(forwards).tolist():
+            run = cache['runs'][i]
+            run['forwards'] += int(forwards[i])
+            run['fee_msat'] += int(run_fees[i])
+            run['volume_msat'] += int(run_volume[i])
+    cache['event_index'] = event_index[-1]
+
+# Function to bring the cache up to date with the data store and the event store
+def update_cache(cache, store, event_store_file, chunk_rows=None):
+    chunk_rows = ANALYSIS_CHUNK_ROWS if chunk_rows is None else chunk_rows
+    new_rows = new_events = 0
+    for data, rows, position in store.read_chunks(after=cache['data_position'], columns=DATA_FIELDS, chunk_rows=chunk_rows):
+        add_data_chunk(cache, data)
+        cache['data_position'] = position
+        new_rows += rows
+    # Opening the event store creates it, so a node without one is left alone
+    if event_store_file and os.path.isfile(event_store_file):
+        with ForwardingEventStore(event_store_file) as event_store:
+            for rows in event_store.get_event_chunks(cache['event_index'], chunk_rows):
+                add_event_chunk(cache, rows)
+                new_events += len(rows)
+    return new_rows, new_events
+
+# Function to total the reason aggregates by strategy
+def strategy_totals(cache):
+    totals = {strategy: {'rows': 0, 'increases': 0, 'reward': 0.0} for strategy in STRATEGIES}
+    for reason in cache['reasons'].values():
+        for field in ('rows', 'increases', 'reward'):
+            totals[reason['strategy']][field] += reason[field]
+    return totals
+
+def top_channels(cache, count):
+    return sorted(cache['channels'].items(), key=lambda item: (item[1]['fee_msat'], item[1]['reward']), reverse=True)[:count]
+
+def write_csv(path, header, rows):
+    with open(path, mode='w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+# Function to write the run, channel, reason and cumulative reward tables
+def write_tables(cache, output_dir):
+    runs = cache['runs']
+    cumulative = np.cumsum([run['reward'] for run in runs])
+    write_csv(os.path.join(output_dir, 'cumulative_rewards_analysis.csv'), ['Run', 'Cumulative Reward', 'Difference from Previous Run'],
+              [(format_time(run['time']), total, run['reward'] if i else 0.0) for i, (run, total) in enumerate(zip(runs, cumulative.tolist()))])
+    write_csv(os.path.join(output_dir, 'analysis_runs.csv'),
+              ['Run', 'Rows', 'Increases', 'Reward'] + [f"Reward ({strategy})" for strategy in STRATEGIES] + ['Forwards', 'Fees (msat)', 'Volume (msat)'],
+              [[format_time(run['time']), run['rows'], run['increases'], run['reward']] + [run['rewards'][strategy] for strategy in STRATEGIES] +
+               [run['forwards'], run['fee_msat'], run['volume_msat']] for run in runs])
+    write_csv(os.path.join(output_dir, 'analysis_channels.csv'),
+              ['Channel ID', 'Alias', 'Rows', 'Increases', 'Reward', 'Adjustment', 'Last State', 'Forwards In', 'Forwards Out', 'Fees (msat)', 'Volume (msat)'],
+              [[chan_id, channel['alias'], channel['rows'], channel['increases'], channel['reward'], channel['adjustment'], channel['last_state'],
+                channel['forwards_in'], channel['forwards_out'], channel['fee_msat'], channel['volume_msat']]
+               for chan_id, channel in sorted(cache['channels'].items())])
+    write_csv(os.path.join(output_dir, 'analysis_reasons.csv'), ['Reason', 'Strategy', 'Rows', 'Increases', 'Reward'],
+              [[reason, totals['strategy'], totals['rows'], totals['increases'], totals['reward']] for reason, totals in sorted(cache['reasons'].items())])
+
+# Function to render the plots to PNG files, without a display
+def write_plots(cache, output_dir, top):
+    try:
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+    except ImportError:
+        print("matplotlib is not installed; skipping the plots.")
+        return []
+    runs = cache['runs']
+    dates = [datetime.fromtimestamp(run['time'], timezone.utc) for run in runs]
+    rewards = np.array([run['reward'] for run in runs])
+    paths = []
+
+    def save(figure, name):
+        path = os.path.join(output_dir, name)
+        figure.savefig(path)
+        plt.close(figure)
+        paths.append(path)
+
+    figure, axes = plt.subplots(figsize=(10, 6))
+    axes.plot(dates, np.cumsum(rewards), label='Cumulative Reward')
+    axes.set(xlabel='Date', ylabel='Cumulative Reward', title='Cumulative Reward Over Time')
+    axes.legend()
+    axes.grid(True)
+    save(figure, 'cumulative_reward_over_time_analysis.png')
+
+    figure, axes = plt.subplots(figsize=(10, 6))
+    axes.bar(dates, np.where(np.arange(len(rewards)) > 0, rewards, 0), label='Difference from Previous Run')
+    axes.set(xlabel='Date', ylabel='Difference in Cumulative Reward', title='Difference in Cumulative Reward Between Runs')
+    axes.legend()
+    axes.grid(True)
+    save(figure, 'difference_in_cumulative_reward_between_runs.png')
+
+    figure, axes = plt.subplots(figsize=(10, 6))
+    for strategy in STRATEGIES:
+        strategy_rewards = np.array([run['rewards'][strategy] for run in runs])
+        if strategy_rewards.any():
+            axes.plot(dates, np.cumsum(strategy_rewards), label=strategy)
+    axes.set(xlabel='Date', ylabel='Cumulative Reward', title='Cumulative Reward by Strategy')
+    axes.legend()
+    axes.grid(True)
+    save(figure, 'cumulative_reward_by_strategy.png')
+
+    channels = top_channels(cache, top)
+    figure, axes = plt.subplots(figsize=(10, 6))
+    axes.barh([channel['alias'] or chan_id for chan_id, channel in reversed(channels)],
+              [channel['fee_msat'] / 1000 for chan_id, channel in reversed(channels)])
+    axes.set(xlabel='Fees (sat)', title=f"Top {len(channels)} Channels by Fees")
+    figure.tight_layout()
+    save(figure, 'top_channels_by_fees.png')
+    return paths
+
+def print_summary(cache, top):
+    runs = cache['runs']
+    print(f"{len(runs)} runs, {sum(run['rows'] for run in runs)} adjustments on {len(cache['channels'])} channels, "
+          f"total reward {sum(run['reward'] for run in runs):.2f}")
+    if runs:
+        print(f"From {format_time(runs[0]['time'])} to {format_time(runs[-1]['time'])} (UTC)")
+    print(f"\n{'strategy':<12} {'rows':>10} {'increases':>10} {'reward':>16} {'reward/row':>12}")
+    for strategy, totals in strategy_totals(cache).items():
+        if totals['rows']:
+            print(f"{strategy:<12} {totals['rows']:>10} {totals['increases']:>10} {totals['reward']:>16.2f} {totals['reward'] / totals['rows']:>12.2f}")
+    print(f"\n{'channel':<20} {'alias':<24} {'rows':>8} {'reward':>16} {'forwards':>9} {'fees (sat)':>12} {'volume (sat)':>14}")
+    for chan_id, channel in top_channels(cache, top):
+        print(f"{chan_id:<20} {channel['alias'][:24]:<24} {channel['rows']:>8} {channel['reward']:>16.2f} {channel['forwards_out']:>9} "
+              f"{channel['fee_msat'] / 1000:>12.3f} {channel['volume_msat'] / 1000:>14.0f}")
+
+def main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description="Analyze the fee adjustments collected by fee_setting_agent.py")
+    parser.add_argument('--rebuild', action='store_true', help="Ignore the cache and read the whole history again")
+    parser.add_argument('--no-plots', action='store_true', help="Only write the CSV tables")
+    parser.add_argument('--output-dir', default=OUTPUT_DIR, help="Folder for the tables and plots")
+    parser.add_argument('--top', type=int, default=TOP_CHANNELS, help="Number of channels to print and plot")
+    parser.add_argument('--cache', default=ANALYSIS_CACHE_FILE, help="Cache file, or '' for no cache")
+    options = parser.parse_args(argv)
+
+    store = agent.get_data_store()
+    source = f"{agent.DATA_BACKEND}:{os.path.abspath(agent.get_data_store_path())}"
+    cache = new_cache(source) if options.rebuild else load_cache(options.cache, source, store.position())
+    new_rows, new_events = update_cache(cache, store, agent.EVENT_STORE_FILE)
+    agent.close_data_store()
+    print(f"Read {new_rows} new rows and {new_events} new forwarding events.")
+    if options.cache:
+        save_cache(options.cache, cache)
+
+    os.makedirs(options.output_dir, exist_ok=True)
+    write_tables(cache, options.output_dir)
+    print_summary(cache, options.top)
+    if not options.no_plots:
+        for path in write_plots(cache, options.output_dir, options.top):
+            print(f"Wrote {path}")
+
+if __name__ == "__main__":
+    main()
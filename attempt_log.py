@@ -0,0 +1,137 @@
+# Append-only SQLite log of rebalance attempts, and a per-pair model fitted on it
+# that picks the lowest fee limit likely to succeed.
+#
+# The model buckets each pair's attempts by fee limit (in ppm of the amount) and
+# estimates the success probability per bucket, made non-decreasing in the fee
+# limit. The log keeps those bucket counts up to date as attempts are appended, so
+# fitting reads one row per pair and bucket however long the log grows, and the
+# model is updated in memory as new attempts are recorded.
+
+import sqlite3
+import threading
+import time
+
+BUCKET_PPM = 50  # Width of the fee limit buckets kept by the log, in ppm of the amount
+
+ATTEMPT_COLUMNS = ['timestamp', 'source', 'target', 'amount', 'fee_limit', 'fee_paid', 'route_length', 'failure_reason', 'duration', 'succeeded']
+
+class AttemptLog:
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS rebalance_attempts (
+                id INTEGER PRIMARY KEY,
+                timestamp REAL NOT NULL,
+                source TEXT NOT NULL,
+                target TEXT NOT NULL,
+                amount INTEGER NOT NULL,
+                fee_limit INTEGER NOT NULL,
+                fee_paid INTEGER,
+                route_length INTEGER,
+                failure_reason TEXT,
+                duration REAL NOT NULL,
+                succeeded INTEGER NOT NULL
+            )""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS rebalance_attempts_pair ON rebalance_attempts (source, target)")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS rebalance_attempt_buckets (
+                source TEXT NOT NULL,
+                target TEXT NOT NULL,
+                bucket INTEGER NOT NULL,
+                attempts INTEGER NOT NULL,
+                successes INTEGER NOT NULL,
+                PRIMARY KEY (source, target, bucket)
+            ) WITHOUT ROWID""")
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def append(self, source, target, amount, fee_limit, succeeded, fee_paid=None, route_length=None, failure_reason=None, duration=0.0, timestamp=None):
+        self.append_many([{'timestamp': time.time() if timestamp is None else timestamp, 'source': source, 'target': target,
+                           'amount': amount, 'fee_limit': fee_limit, 'fee_paid': fee_paid, 'route_length': route_length,
+                           'failure_reason': failure_reason, 'duration': duration, 'succeeded': int(bool(succeeded))}])
+
+    def append_many(self, records):
+        with self.lock, self.conn:
+            for record in records:
+                self.conn.execute(f"INSERT INTO rebalance_attempts ({', '.join(ATTEMPT_COLUMNS)}) VALUES ({', '.join('?' * len(ATTEMPT_COLUMNS))})",
+                                  tuple(record[column] for column in ATTEMPT_COLUMNS))
+                if record['amount'] > 0:
+                    self.conn.execute(
+                        "INSERT INTO rebalance_attempt_buckets (source, target, bucket, attempts, successes) VALUES (?, ?, ?, 1, ?) "
+                        "ON CONFLICT (source, target, bucket) DO UPDATE SET attempts = attempts + 1, successes = successes + excluded.successes",
+                        (record['source'], record['target'], fee_limit_bucket(record['amount'], record['fee_limit'], BUCKET_PPM), int(bool(record['succeeded']))))
+
+    # Attempt and success counts per (source, target, fee limit bucket)
+    def bucket_counts(self, bucket_ppm=BUCKET_PPM):
+        with self.lock:
+            if bucket_ppm == BUCKET_PPM:
+                return self.conn.execute("SELECT source, target, bucket, attempts, successes FROM rebalance_attempt_buckets").fetchall()
+            return self.conn.execute(
+                "SELECT source, target, CAST(fee_limit * 1000000 / amount / ? AS INTEGER) AS bucket, COUNT(*), SUM(succeeded) "
+                "FROM rebalance_attempts WHERE amount > 0 GROUP BY source, target, bucket", (bucket_ppm,)).fetchall()
+
+    # Attempts, successes, and amount and fees of the successes that reported a fee, per (source, target)
+    def pair_totals(self):
+        with self.lock:
+            return self.conn.execute(
+                "SELECT source, target, COUNT(*), SUM(succeeded), "
+                "SUM(CASE WHEN succeeded AND fee_paid IS NOT NULL THEN amount ELSE 0 END), "
+                "SUM(CASE WHEN succeeded AND fee_paid IS NOT NULL THEN fee_paid ELSE 0 END) "
+                "FROM rebalance_attempts GROUP BY source, target").fetchall()
+
+def fee_limit_bucket(amount, fee_limit, bucket_ppm):
+    return int(fee_limit * 1000000 / amount / bucket_ppm)
+
+class FeeLimitModel:
+    def __init__(self, bucket_ppm=BUCKET_PPM, target_probability=0.5, min_attempts=3, prior_successes=0.5, prior_failures=1.0):
+        self.bucket_ppm = bucket_ppm
+        self.target_probability = target_probability  # Lowest acceptable estimated success probability
+        self.min_attempts = min_attempts  # Pairs with fewer attempts have no estimate
+        self.prior_successes = prior_successes
+        self.prior_failures = prior_failures
+        self.counts = {}  # (source, target) -> {bucket: [attempts, successes]}
+
+    def fit(self, attempt_log):
+        self.counts = {}
+        for source, target, bucket, attempts, successes in attempt_log.bucket_counts(self.bucket_ppm):
+            self.counts.setdefault((source, target), {})[bucket] = [attempts, successes]
+        return self
+
+    def update(self, source, target, amount, fee_limit, succeeded):
+        if amount <= 0:
+            return
+        bucket = fee_limit_bucket(amount, fee_limit, self.bucket_ppm)
+        counts = self.counts.setdefault((source, target), {}).setdefault(bucket, [0, 0])
+        counts[0] += 1
+        counts[1] += int(bool(succeeded))
+
+    # Estimated success probability at each fee limit bucket, made non-decreasing:
+    # anything that succeeded at a fee limit would also have succeeded at a higher one
+    def success_curve(self, source, target):
+        buckets = self.counts.get((source, target))
+        if not buckets or sum(attempts for attempts, successes in buckets.values()) < self.min_attempts:
+            return []
+        curve = []
+        best = 0.0
+        for bucket in sorted(buckets):
+            attempts, successes = buckets[bucket]
+            best = max(best, (successes + self.prior_successes) / (attempts + self.prior_successes + self.prior_failures))
+            curve.append((bucket, best))
+        return curve
+
+    # Function to pick the lowest fee limit, in satoshis, likely to succeed for this pair and amount.
+    # Returns None when the pair has too little history for an estimate.
+    def fee_limit(self, source, target, amount):
+        for bucket, probability in self.success_curve(source, target):
+            if probability >= self.target_probability:
+                return max(1, (bucket + 1) * self.bucket_ppm * amount // 1000000)
+        return None
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Benchmark for the forwarding-event aggregation used by fee_setting_agent.py.
+# Compares the single-pass aggregator against the old per-channel rescans on
+# synthetic fwdinghistory output, up to 1M events.
+# Usage: python benchmarks/bench_aggregation.py
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import fee_setting_agent
+
+fee_setting_agent.DEBUG = False
+
+NUM_CHANNELS = 300
+EVENT_COUNTS = [10000, 100000, 1000000]
+LEGACY_MAX_EVENTS = 100000  # The old rescans are too slow to run beyond this
+SEED = 42
+
+# Function to generate synthetic forwarding events shaped like lncli fwdinghistory output
+def generate_events(num_events, chan_ids, rng):
+    events = []
+    for _ in range(num_events):
+        amt_out = rng.randint(1000, 10000000) * 1000
+        fee = rng.randint(0, 5000)
+        events.append({
+            'chan_id_in': rng.choice(chan_ids),
+            'chan_id_out': rng.choice(chan_ids),
+            'amt_in_msat': str(amt_out + fee),
+            'amt_out_msat': str(amt_out),
+            'fee_msat': str(fee),
+        })
+    return events
+
+# The previous reward computation: three full scans of the event list per channel
+def legacy_reward(chan_id, forwarding_events):
+    total_fees = sum(int(event['fee_msat']) for event in forwarding_events if event['chan_id_out'] == chan_id)
+    total_volume = sum(int(event['amt_in_msat']) for event in forwarding_events if event['chan_id_in'] == chan_id) + \
+                   sum(int(event['amt_out_msat']) for event in forwarding_events if event['chan_id_out'] == chan_id)
+    return total_fees + (total_volume / 10000)
+
+def main():
+    rng = random.Random(SEED)
+    chan_ids = [str(rng.getrandbits(63)) for _ in range(NUM_CHANNELS)]
+
+    print(f"{'events':>10} {'aggregate (s)':>14} {'rewards (s)':>12} {'legacy (s)':>11} {'speedup':>9}")
+    for num_events in EVENT_COUNTS:
+        events = generate_events(num_events, chan_ids, rng)
+
+        start = time.perf_counter()
+        channel_stats = fee_setting_agent.aggregate_forwarding_events(events)
+        aggregate_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        rewards = {chan_id: fee_setting_agent.reward_function_per_channel(chan_id, channel_stats) for chan_id in chan_ids}
+        reward_time = time.perf_counter() - start
+
+        if num_events <= LEGACY_MAX_EVENTS:
+            start = time.perf_counter()
+            legacy_rewards = {chan_id: legacy_reward(chan_id, events) for chan_id in chan_ids}
+            legacy_time = time.perf_counter() - start
+            assert legacy_rewards == rewards, "Aggregated rewards differ from the legacy computation"
+            speedup = f"{legacy_time / (aggregate_time + reward_time):.1f}x"
+            legacy = f"{legacy_time:.3f}"
+        else:
+            speedup = legacy = "-"
+
+        print(f"{num_events:>10} {aggregate_time:>14.3f} {reward_time:>12.3f} {legacy:>11} {speedup:>9}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Benchmark for the fee adjustment data stores (data_store.py): a year of hourly runs is
+# written to the CSV store and migrated to the SQLite and columnar stores, then read back whole, for one channel, for one
+# month, and incrementally after the last run, as training does.
+# Usage: python benchmarks/bench_data_store.py [channels]   (default 50)
+
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from data_store import ColumnarDataStore, CsvDataStore, SqliteDataStore, migrate_csv
+
+DAYS = 365
+RUNS_PER_DAY = 24
+START_TIME = 1700000000
+SEED = 42
+
+# Function to generate one run's rows per hour, in the form collect_data appends them
+def generate_runs(num_channels):
+    rng = np.random.default_rng(SEED)
+    chan_ids = [str(700000 * 2 ** 40 + i * 2 ** 16 + 1) for i in range(num_channels)]
+    for run in range(DAYS * RUNS_PER_DAY):
+        state = rng.integers(0, 100, num_channels) / 100
+        increase = rng.random(num_channels) < 0.5
+        reward = rng.random(num_channels) * 1000000
+        yield [(START_TIME + run * 3600, state[i], chan_id, f"peer-{i}", bool(increase[i]), 'Q-Learning decision',
+                0.01 if increase[i] else 0.005, reward[i], round(state[i] + (0.01 if increase[i] else -0.005), 6))
+               for i, chan_id in enumerate(chan_ids)]
+
+def time_reads(store, chan_id):
+    timings = {}
+    start = time.perf_counter()
+    columns, rows, position = store.read()
+    timings['all columns'] = time.perf_counter() - start
+    start = time.perf_counter()
+    store.read(columns=['state', 'increase', 'reward', 'next_state'])
+    timings['training columns'] = time.perf_counter() - start
+    start = time.perf_counter()
+    store.read(chan_ids=[chan_id])
+    timings['one channel'] = time.perf_counter() - start
+    start = time.perf_counter()
+    store.read(start=START_TIME + 180 * 86400, end=START_TIME + 210 * 86400)
+    timings['one month'] = time.perf_counter() - start
+    start = time.perf_counter()
+    store.read(after=position)
+    timings['incremental, no new rows'] = time.perf_counter() - start
+    return rows, timings
+
+def main():
+    num_channels = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    with tempfile.TemporaryDirectory() as directory:
+        csv_store = CsvDataStore(os.path.join(directory, 'fee_adjustment_data.csv'))
+        start = time.perf_counter()
+        for rows in generate_runs(num_channels):
+            csv_store.append(rows)
+        print(f"Wrote {DAYS * RUNS_PER_DAY} runs of {num_channels} channels to CSV in {time.perf_counter() - start:.1f}s")
+
+        stores = {'csv': csv_store, 'sqlite': SqliteDataStore(os.path.join(directory, 'fee_adjustment_data.db')),
+                  'columnar': ColumnarDataStore(os.path.join(directory, 'fee_adjustment_data'))}
+        for name in ('sqlite', 'columnar'):
+            start = time.perf_counter()
+            copied, first_position = migrate_csv(csv_store.path, stores[name])
+            print(f"Migrated {copied} rows to {name} in {time.perf_counter() - start:.1f}s")
+
+        chan_id = str(700000 * 2 ** 40 + 1)
+        results = {name: time_reads(store, chan_id) for name, store in stores.items()}
+        for name, (rows, timings) in results.items():
+            assert rows == results['csv'][0], f"{name} read {rows} rows, csv {results['csv'][0]}"
+        print(f"{'read':>26}" + ''.join(f" {name + ' (s)':>12}" for name in stores))
+        for read in results['csv'][1]:
+            print(f"{read:>26}" + ''.join(f" {results[name][1][read]:>12.3f}" for name in stores))
+        stores['sqlite'].close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Benchmark for fitting the rebalance fee limit model (attempt_log.py) on a large attempt log.
+# Usage: python benchmarks/bench_fee_model.py
+
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from attempt_log import AttemptLog, FeeLimitModel
+
+RECORD_COUNTS = [10000, 100000, 500000]
+NUM_CHANNELS = 300
+NUM_PAIRS = 5000  # Distinct (source, target) pairs that have been tried
+SEED = 42
+
+# Function to generate synthetic attempts where each pair needs a fixed fee rate to succeed
+def generate_records(num_records, rng):
+    chan_ids = [str(rng.getrandbits(60)) for _ in range(NUM_CHANNELS)]
+    pairs = [tuple(rng.sample(chan_ids, 2)) for _ in range(NUM_PAIRS)]
+    required_ppm = {}
+    now = time.time()
+    for i in range(num_records):
+        source, target = rng.choice(pairs)
+        ppm = required_ppm.setdefault((source, target), rng.randint(50, 1500))
+        amount = rng.choice([100000, 250000, 500000])
+        fee_limit = amount * rng.randint(20, 2000) // 1000000
+        succeeded = fee_limit >= amount * ppm // 1000000
+        yield {'timestamp': now - num_records + i, 'source': source, 'target': target, 'amount': amount, 'fee_limit': fee_limit,
+               'fee_paid': amount * ppm // 1000000 if succeeded else None, 'route_length': 4 if succeeded else None,
+               'failure_reason': None if succeeded else 'FAILURE_REASON_NO_ROUTE', 'duration': 1.0, 'succeeded': int(succeeded)}
+
+def main():
+    rng = random.Random(SEED)
+    print(f"{'records':>9} {'append (s)':>11} {'fit (s)':>8} {'pairs':>7} {'lookup (us)':>12}")
+    for num_records in RECORD_COUNTS:
+        with tempfile.TemporaryDirectory() as directory, AttemptLog(os.path.join(directory, 'attempts.db')) as attempt_log:
+            start = time.perf_counter()
+            attempt_log.append_many(generate_records(num_records, rng))
+            append_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            model = FeeLimitModel().fit(attempt_log)
+            fit_time = time.perf_counter() - start
+
+            pairs = list(model.counts)
+            start = time.perf_counter()
+            for source, target in pairs:
+                model.fee_limit(source, target, 500000)
+            lookup_time = (time.perf_counter() - start) / len(pairs)
+
+            print(f"{num_records:>9} {append_time:>11.3f} {fit_time:>8.3f} {len(pairs):>7} {lookup_time * 1e6:>12.1f}")
+
+if __name__ == "__main__":
+    main()
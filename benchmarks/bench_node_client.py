@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Benchmark for the node client backends in node_client.py, run offline against fake_lnd.py.
+# Measures the per-call cost of getchaninfo through a fresh lncli-style process per call
+# versus lnd's REST API over one persistent connection.
+# Usage: python benchmarks/bench_node_client.py
+
+import os
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from fake_lnd import FakeNode, serve_rest
+from node_client import LncliBackend, RestBackend
+
+NUM_CHANNELS = 50
+CALLS = 100
+
+def time_calls(client, chan_ids):
+    start = time.perf_counter()
+    for i in range(CALLS):
+        client.call('getchaninfo', chan_ids[i % len(chan_ids)])
+    return (time.perf_counter() - start) / CALLS
+
+def main():
+    node = FakeNode(NUM_CHANNELS, 0)
+    chan_ids = list(node.channels)
+
+    # The fake lncli regenerates the same seeded node in every process
+    lncli = LncliBackend(f"{sys.executable} {os.path.join(ROOT, 'fake_lnd.py')} --channels {NUM_CHANNELS} --events 0")
+    server = serve_rest(node)
+    rest = RestBackend(f"127.0.0.1:{server.server_address[1]}")
+
+    print(f"{'backend':>10} {'ms per call':>12}")
+    for name, client in [('lncli', lncli), ('rest', rest), ('in-process', node)]:
+        print(f"{name:>10} {time_calls(client, chan_ids) * 1000:>12.3f}")
+
+    rest.close()
+    server.shutdown()
+
+if __name__ == "__main__":
+    main()
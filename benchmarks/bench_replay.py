@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Times replay.py sweeping a grid of fee agent settings over a synthetic forwarding history:
+# days of forwards routed by simulator.FeeMarket, written to a temporary event store. The
+# sweep is run on one process and on all of them, and the best settings are printed.
+# Usage: python benchmarks/bench_replay.py [--days 90] [--channels 100] [--workers N]
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import fee_setting_agent as agent
+import replay
+from event_store import ForwardingEventStore
+from fake_lnd import forwarding_event_dicts
+from simulator import FeeMarket
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the counterfactual replay of fee strategies")
+    parser.add_argument('--days', type=int, default=90)
+    parser.add_argument('--channels', type=int, default=100)
+    parser.add_argument('--workers', type=int, default=replay.REPLAY_WORKERS)
+    parser.add_argument('--seed', type=int, default=0)
+    options = parser.parse_args(argv)
+
+    market = FeeMarket(options.channels, options.seed)
+    start = market.now
+    for _ in range(options.days):
+        market.step()
+    chan_ids = [str(700000 * 2 ** 40 + i * 2 ** 16 + 1) for i in range(options.channels)]
+    grid = replay.build_grid(replay.STRATEGIES, [0.05, 0.1, 0.2], [0.9], [0.0, 0.1], [0.005, 0.01, 0.02], [0.005, 0.01], [0, 2, 5])
+    model = {'model': replay.ELASTICITY_MODEL, 'reference_ppm': replay.REFERENCE_PPM, 'exponent': replay.ELASTICITY_EXPONENT,
+             'max_multiplier': replay.MAX_DEMAND_MULTIPLIER}
+
+    with tempfile.TemporaryDirectory() as folder:
+        agent.DATA_BACKEND = "sqlite"
+        agent.DATA_STORE_FILE = os.path.join(folder, 'fee_adjustment_data.db')
+        with ForwardingEventStore(os.path.join(folder, 'forwarding_events.db')) as store:
+            events = market.events[:market.num_events]
+            store.add_events(forwarding_event_dicts(events, chan_ids), 0, len(events))
+            started = time.perf_counter()
+            history = replay.load_history(store, agent.get_data_store(), options.days, market.now)
+            print(f"{len(history['events'])} forwards over {options.days} days on {options.channels} channels since {start}, "
+                  f"loaded in {time.perf_counter() - started:.2f}s")
+        agent.close_data_store()
+
+    for workers in sorted({1, options.workers}):
+        started = time.perf_counter()
+        results, recorded_sat = replay.run_sweep(history, grid, model, workers=workers)
+        seconds = time.perf_counter() - started
+        print(f"{len(grid)} settings on {workers} processes: {seconds:.1f}s, {seconds / len(grid) * workers:.2f}s per setting per process")
+    replay.print_results(results, recorded_sat, 5)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Times route_planner.py on a fake network the size of the public Lightning graph
+# (15,000 nodes, 80,000 channels): building the graph from describegraph, saving and
+# loading the cache, applying channel updates, and planning circular routes between
+# random pairs of our channels. The first route search builds the fee columns, so the
+# searches are reported apart from it.
+# Usage: python benchmarks/bench_route_planner.py [--nodes 15000] [--channels 80000]
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from fake_lnd import FakeNode
+from route_planner import ChannelGraph, RoutePlanner
+
+def timed(function, *args):
+    started = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - started
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the circular route planner")
+    parser.add_argument('--nodes', type=int, default=15000)
+    parser.add_argument('--channels', type=int, default=80000)
+    parser.add_argument('--our-channels', type=int, default=100)
+    parser.add_argument('--amount', type=int, default=500000, help="Route amount in satoshis")
+    parser.add_argument('--fee-limit', type=int, default=500, help="Fee limit in satoshis")
+    parser.add_argument('--routes', type=int, default=3, help="Routes wanted per search")
+    parser.add_argument('--searches', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    options = parser.parse_args(argv)
+
+    node = FakeNode(options.our_channels, 0, seed=options.seed, network_nodes=options.nodes, network_channels=options.channels)
+    described, describe_seconds = timed(node.call, 'describegraph')
+    graph, build_seconds = timed(ChannelGraph.from_describegraph, described)
+    print(f"Graph of {graph.num_nodes} nodes and {graph.num_edges} channel directions")
+    print(f"describegraph {describe_seconds:.3f}s, build {build_seconds:.3f}s")
+
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'channel_graph.npz')
+        _, save_seconds = timed(graph.save, path)
+        graph, load_seconds = timed(ChannelGraph.load, path)
+        print(f"Cache {os.path.getsize(path) / 1e6:.1f} MB, save {save_seconds:.3f}s, load {load_seconds:.3f}s")
+
+    # Policy updates to existing channels, as subscribechannelgraph sends them
+    rng = np.random.default_rng(options.seed)
+    updates = [{'channel_updates': [{'chan_id': edge['channel_id'], 'advertising_node': edge['node1_pub'], 'connecting_node': edge['node2_pub'],
+                                     'capacity': edge['capacity'], 'routing_policy': dict(edge['node1_policy'], fee_rate_milli_msat=str(rng.integers(0, 1000)))}]}
+               for edge in rng.choice(described['edges'], 1000)]
+    started = time.perf_counter()
+    for update in updates:
+        graph.apply_update(update)
+    print(f"{len(updates)} channel updates {(time.perf_counter() - started) * 1000:.1f}ms")
+
+    planner = RoutePlanner(graph, node.pubkey)
+    peers = [channel['remote_pubkey'] for channel in node.channels.values()]
+    _, first_seconds = timed(planner.circular_routes, peers[0], peers[1], options.amount, options.fee_limit, options.routes)
+    seconds, found = [], []
+    for _ in range(options.searches):
+        first_hop, last_hop = rng.choice(len(peers), 2, replace=False)
+        routes, elapsed = timed(planner.circular_routes, peers[first_hop], peers[last_hop], options.amount, options.fee_limit, options.routes)
+        seconds.append(elapsed * 1000)
+        found.append(len(routes))
+    print(f"First search {first_seconds * 1000:.1f}ms (builds the fee columns)")
+    print(f"{options.searches} searches for {options.routes} routes of {options.amount} sats within {options.fee_limit} sats: "
+          f"median {np.median(seconds):.2f}ms, p95 {np.percentile(seconds, 95):.2f}ms, max {max(seconds):.2f}ms, "
+          f"{np.mean(found):.1f} routes found on average")
+
+if __name__ == "__main__":
+    main()
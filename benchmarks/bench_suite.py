@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# End-to-end benchmark suite for fee_setting_agent.py (rule based, global Q-table and
+# per-channel Q-table) and rebalance.py, run offline against seeded fake nodes
+# (fake_lnd.py) of 10 to 5,000 channels with 1k to 10M forwarding events. Each scenario
+# runs in a fresh process, so its peak memory is its own, and records the time of every
+# run, the peak resident memory and the node commands issued. Results are written as JSON
+# with the commit and versions they were measured on, and two result files can be compared.
+#
+#   python benchmarks/bench_suite.py                          # quick preset
+#   python benchmarks/bench_suite.py --preset full --output after.json
+#   python benchmarks/bench_suite.py --channels 1000 --events 1000000 --scripts fee_rule
+#   python benchmarks/bench_suite.py --compare before.json after.json
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+from datetime import datetime, timezone
+
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from fleet import run_in_process  # The tools themselves are imported in each scenario's process
+
+PRESETS = {
+    'quick': {'channels': [10, 100], 'events': [1000, 100000]},
+    'standard': {'channels': [10, 100, 1000], 'events': [1000, 100000, 1000000]},
+    'full': {'channels': [10, 100, 1000, 5000], 'events': [1000, 100000, 1000000, 10000000]},
+}
+SCRIPTS = ['fee_rule', 'fee_qtable', 'fee_qstore', 'rebalance']
+FEE_MODES = {'fee_rule': dict(QTABLE=False), 'fee_qtable': dict(QTABLE=True, Q_STORE=False), 'fee_qstore': dict(QTABLE=True, Q_STORE=True)}
+START_TIME = 1700000000  # Fake node clock, so every scenario sees the same history
+RUN_INTERVAL = 3600  # Seconds the node clock moves between fee agent runs, past the channel cooldown
+REGRESSION_THRESHOLD = 1.2  # Ratio of new to baseline time or memory reported as a regression
+MIN_REGRESSION_SECONDS = 0.05  # Smaller differences in time are noise, whatever the ratio
+
+# Function to get the peak resident memory of this process, in MB
+def peak_rss_mb():
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)  # Bytes on macOS, KB on Linux
+
+# Function to run fee_setting_agent.py against the node, with a cold first run that fetches
+# the whole history and warm runs after it
+def run_fee_agent(node, script, runs, seed):
+    import fee_setting_agent as agent
+    from simulator import agent_settings
+    settings = dict(NODE=node, CLOCK=lambda: node.now, PROMPT=False, DEBUG=False, DRY_RUN=False, **FEE_MODES[script])
+    seconds = []
+    with agent_settings(**settings):
+        np.random.seed(seed)  # Exploration in the agent's action selection
+        for run in range(runs):
+            started = time.perf_counter()
+            agent.run_phase()
+            seconds.append(time.perf_counter() - started)
+            node.now += RUN_INTERVAL
+        agent.close_event_store()
+        agent.close_data_store()
+    return seconds, {}
+
+# Function to run rebalance.py's main loop against the node
+def run_rebalancer(node, rounds):
+    import rebalance
+    rebalance.client = node
+    rebalance.ATTEMPTED_MAX = rounds
+    started = time.perf_counter()
+    rebalance.main()
+    return [time.perf_counter() - started], {'rebalances': rebalance.SUCCEEDED_COUNT, 'rebalanced_sat': rebalance.REBALANCED_AMOUNT,
+                                             'rounds': rebalance.ATTEMPTED_COUNT}
+
+# Function to run one scenario in a scratch folder; called in a fresh process
+def run_scenario(scenario):
+    from fake_lnd import FakeNode
+    with tempfile.TemporaryDirectory() as workdir, open(os.devnull, 'w') as devnull:
+        os.chdir(workdir)  # The scripts' data files are relative to the working folder
+        started = time.perf_counter()
+        node = FakeNode(scenario['channels'], scenario['events'], seed=scenario['seed'], now=START_TIME)
+        build_seconds = time.perf_counter() - started
+        baseline_rss = peak_rss_mb()
+        with redirect_stdout(devnull):
+            if scenario['script'] == 'rebalance':
+                seconds, outcome = run_rebalancer(node, scenario['rounds'])
+            else:
+                seconds, outcome = run_fee_agent(node, scenario['script'], scenario['runs'], scenario['seed'])
+        os.chdir(ROOT)
+    return dict(scenario, build_seconds=round(build_seconds, 4), run_seconds=[round(value, 4) for value in seconds],
+                seconds=round(sum(seconds), 4), peak_rss_mb=round(peak_rss_mb(), 1), node_rss_mb=round(baseline_rss, 1),
+                commands=dict(sorted(node.calls.items())), total_commands=sum(node.calls.values()), **outcome)
+
+def scenario_key(result):
+    return (result['script'], result['channels'], result['events'])
+
+# Function to list the scenarios to run; the rebalancer does not read forwarding history,
+# so it runs once per channel count
+def build_scenarios(channels, events, scripts, runs, rounds, seed):
+    scenarios = []
+    for script in scripts:
+        for num_channels in channels:
+            for num_events in ([0] if script == 'rebalance' else events):
+                scenarios.append({'script': script, 'channels': num_channels, 'events': num_events, 'seed': seed,
+                                  'runs': 1 if script == 'rebalance' else runs, 'rounds': rounds if script == 'rebalance' else 0})
+    return scenarios
+
+# Function to describe where results were measured, so files from different versions can be told apart
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'commit': commit, 'created': datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"), 'python': platform.python_version(),
+            'numpy': np.__version__, 'platform': platform.platform(), 'processor': platform.processor() or platform.machine()}
+
+def print_header():
+    print(f"{'script':<11} {'channels':>8} {'events':>9} {'build (s)':>9} {'runs (s)':>18} {'peak (MB)':>9} {'node (MB)':>9} {'commands':>9}")
+
+def print_result(result):
+    runs = ' '.join(f"{value:.3f}" for value in result['run_seconds'])
+    print(f"{result['script']:<11} {result['channels']:>8} {result['events']:>9} {result['build_seconds']:>9.3f} {runs:>18} "
+          f"{result['peak_rss_mb']:>9.1f} {result['node_rss_mb']:>9.1f} {result['total_commands']:>9}", flush=True)
+
+# Function to compare two result files scenario by scenario, returning the number of regressions
+def compare(baseline_path, results_path):
+    with open(baseline_path) as file:
+        baseline = json.load(file)
+    with open(results_path) as file:
+        current = json.load(file)
+    before = {scenario_key(result): result for result in baseline['results']}
+    print(f"Comparing {results_path} ({current['environment']['commit']}) with {baseline_path} ({baseline['environment']['commit']})")
+    print(f"{'script':<11} {'channels':>8} {'events':>9} {'time':>8} {'memory':>8} {'commands':>9}")
+    regressions = 0
+    for result in current['results']:
+        previous = before.get(scenario_key(result))
+        if previous is None:
+            continue
+        time_ratio = result['seconds'] / max(previous['seconds'], 1e-9)
+        memory_ratio = result['peak_rss_mb'] / max(previous['peak_rss_mb'], 1e-9)
+        commands = result['total_commands'] - previous['total_commands']
+        slower = time_ratio > REGRESSION_THRESHOLD and result['seconds'] - previous['seconds'] > MIN_REGRESSION_SECONDS
+        flag = ' <- regression' if slower or memory_ratio > REGRESSION_THRESHOLD or commands > 0 else ''
+        regressions += bool(flag)
+        print(f"{result['script']:<11} {result['channels']:>8} {result['events']:>9} {time_ratio:>7.2f}x {memory_ratio:>7.2f}x {commands:>+9}{flag}")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark fee_setting_agent.py and rebalance.py against fake nodes")
+    parser.add_argument('--preset', choices=PRESETS, default='quick')
+    parser.add_argument('--channels', type=int, nargs='+', help="Channel counts, instead of the preset's")
+    parser.add_argument('--events', type=int, nargs='+', help="Forwarding event counts, instead of the preset's")
+    parser.add_argument('--scripts', nargs='+', choices=SCRIPTS, default=SCRIPTS)
+    parser.add_argument('--runs', type=int, default=2, help="Fee agent runs per scenario; the first fetches the whole history")
+    parser.add_argument('--rounds', type=int, default=20, help="Rebalance rounds per scenario (ATTEMPTED_MAX)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=1, help="Run each scenario this many times and keep the fastest")
+    parser.add_argument('--output', default='bench_suite_results.json', help="File to write the results to, as JSON")
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'RESULTS'), help="Compare two result files instead of running")
+    options = parser.parse_args(argv)
+
+    if options.compare:
+        return 1 if compare(*options.compare) else 0
+
+    channels = options.channels or PRESETS[options.preset]['channels']
+    events = options.events or PRESETS[options.preset]['events']
+    scenarios = build_scenarios(channels, events, options.scripts, options.runs, options.rounds, options.seed)
+    results = []
+    print_header()
+    # One process per scenario run, so peak memory and imported state never carry over
+    for scenario in scenarios:
+        repeats = [run_in_process(run_scenario, scenario) for repeat in range(options.repeat)]
+        results.append(min(repeats, key=lambda result: result['seconds']))
+        print_result(results[-1])
+    with open(options.output, mode='w') as file:
+        json.dump({'suite': 'bench_suite', 'environment': environment(), 'results': results}, file, indent=2)
+    print(f"Wrote {len(results)} results to {options.output}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Benchmark for Q-table training from the fee adjustment data file (fee_setting_agent.py).
+# Compares the original row-by-row csv.DictReader trainer with the bulk loader, the
+# incremental checkpointed run, and one epoch of vectorized experience replay.
+# Usage: python benchmarks/bench_training.py [rows]   (default 10,000,000)
+
+import csv
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import fee_setting_agent
+
+LEGACY_MAX_ROWS = 1000000  # The original trainer is timed on at most this many rows and extrapolated
+SEED = 42
+
+# Function to write a synthetic data file in the format written by collect_data
+def generate_data_file(path, num_rows):
+    rng = np.random.default_rng(SEED)
+    chunk = 1000000
+    for start in range(0, num_rows, chunk):
+        size = min(chunk, num_rows - start)
+        state = rng.integers(0, 100, size) / 100
+        increase = rng.random(size) < 0.5
+        pd.DataFrame({
+            'Date': '2024-06-28 12:00:00',
+            'State': state,
+            'Channel ID': rng.integers(10 ** 17, 10 ** 18, size),
+            'Alias': 'peer',
+            'Increase': increase,
+            'Reason': 'Q-Learning decision',
+            'Adjustment Amount': np.where(increase, 0.01, 0.005),
+            'Reward': rng.random(size) * 1000000,
+            'Next State': np.round(np.where(increase, state + 0.01, np.maximum(state - 0.005, 0)), 6),
+        }).to_csv(path, mode='a', header=start == 0, index=False)
+
+# The original trainer, limited to the first max_rows rows
+def legacy_train(path, max_rows):
+    Q = np.zeros((fee_setting_agent.num_states, fee_setting_agent.num_actions))
+    alpha, gamma = fee_setting_agent.alpha, fee_setting_agent.gamma
+    with open(path, mode='r') as file:
+        for i, row in enumerate(csv.DictReader(file)):
+            if i == max_rows:
+                break
+            state = min(int(float(row['State']) * 100), Q.shape[0] - 1)
+            next_state = min(int(float(row['Next State']) * 100), Q.shape[0] - 1)
+            action = int(row['Increase'] == 'True')
+            reward = float(row['Reward']) / 1000000
+            Q[state, action] = (1 - alpha) * Q[state, action] + alpha * (reward + gamma * np.max(Q[next_state]))
+    return Q
+
+def main():
+    num_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 10000000
+    with tempfile.TemporaryDirectory() as directory:
+        fee_setting_agent.DEBUG = False
+        fee_setting_agent.DATA_BACKEND = "csv"
+        fee_setting_agent.DATA_FILE = os.path.join(directory, 'fee_adjustment_data.csv')
+        fee_setting_agent.Q_TABLE_FILE = os.path.join(directory, 'q_table.npy')
+        fee_setting_agent.Q_CHECKPOINT_FILE = os.path.join(directory, 'q_table_checkpoint.json')
+
+        start = time.perf_counter()
+        generate_data_file(fee_setting_agent.DATA_FILE, num_rows)
+        print(f"Generated {num_rows} rows in {time.perf_counter() - start:.1f}s")
+
+        legacy_rows = min(num_rows, LEGACY_MAX_ROWS)
+        start = time.perf_counter()
+        legacy_Q = legacy_train(fee_setting_agent.DATA_FILE, legacy_rows)
+        legacy_time = (time.perf_counter() - start) * num_rows / legacy_rows
+        print(f"Row-by-row trainer: {legacy_time:.1f}s" + (" (extrapolated)" if legacy_rows < num_rows else ""))
+
+        fee_setting_agent.load_q_table()
+        start = time.perf_counter()
+        fee_setting_agent.train_from_data()
+        full_time = time.perf_counter() - start
+        fee_setting_agent.save_q_table()
+        print(f"Bulk trainer, all rows: {full_time:.1f}s ({legacy_time / full_time:.1f}x)")
+        if legacy_rows == num_rows:
+            assert np.array_equal(legacy_Q, fee_setting_agent.Q), "Bulk trainer differs from the row-by-row trainer"
+
+        fee_setting_agent.load_q_table()
+        start = time.perf_counter()
+        fee_setting_agent.train_from_data()
+        print(f"Incremental run with no new rows: {time.perf_counter() - start:.3f}s")
+
+        states, actions, rewards, next_states, rows, offset = fee_setting_agent.load_training_data()
+        start = time.perf_counter()
+        fee_setting_agent.replay_q_updates(states, actions, rewards, next_states, epochs=1, seed=SEED)
+        print(f"Experience replay, one epoch: {time.perf_counter() - start:.1f}s")
+
+if __name__ == "__main__":
+    main()
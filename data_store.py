@@ -0,0 +1,451 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Storage backends for the fee adjustment data that fee_setting_agent.py records on every
+# run and reads back for training and analysis.
+#
+#   CsvDataStore      - the original fee_adjustment_data.csv text file
+#   SqliteDataStore   - typed columns in SQLite, indexed on date and on channel ID
+#   ColumnarDataStore - append-only binary files, one per typed column, partitioned by month
+#
+# All read into a dict of NumPy arrays, one per column, filtered by date range and channel
+# ID, starting after the position returned by an earlier read, so training only reads new
+# rows. Existing CSV files can be migrated once, along with the Q-table checkpoint:
+#
+#   python data_store.py fee_adjustment_data.csv fee_adjustment_data --backend columnar --checkpoint q_table_checkpoint.json
+
+import argparse
+import csv
+import io
+import json
+import os
+import sqlite3
+from datetime import datetime
+
+import numpy as np
+
+DATA_COLUMNS = ['timestamp', 'state', 'chan_id', 'alias', 'increase', 'reason', 'adjustment_amount', 'reward', 'next_state']
+CSV_HEADER = ['Date', 'State', 'Channel ID', 'Alias', 'Increase', 'Reason', 'Adjustment Amount', 'Reward', 'Next State']
+CSV_COLUMNS = dict(zip(DATA_COLUMNS, CSV_HEADER))
+FLOAT_COLUMNS = {'state', 'adjustment_amount', 'reward', 'next_state'}
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+# Column types in the columnar store; alias and reason are stored as codes into a dictionary of their values
+COLUMN_TYPES = {'timestamp': np.int64, 'state': np.float64, 'chan_id': np.uint64, 'alias': np.uint32, 'increase': np.bool_,
+                'reason': np.uint32, 'adjustment_amount': np.float64, 'reward': np.float64, 'next_state': np.float64}
+DICTIONARY_COLUMNS = ['alias', 'reason']
+MIGRATION_CHUNK_ROWS = 100000
+CHUNK_ROWS = 1000000  # Rows per chunk for read_chunks
+CSV_ROW_BYTES = 128  # Approximate size of a CSV row, to turn CHUNK_ROWS into a block size
+
+# Function to convert a data file column to floats, with NaN for values that do not parse
+def column_to_float(column):
+    import pandas as pd
+    if pd.api.types.is_numeric_dtype(column):
+        return column.to_numpy(dtype=np.float64)
+    values = np.full(len(column), np.nan)
+    for i, value in enumerate(column.tolist()):
+        try:
+            values[i] = float(value)
+        except (TypeError, ValueError):
+            pass
+    return values
+
+def _parse_date(date):
+    try:
+        return datetime.strptime(date, DATE_FORMAT).timestamp()
+    except (TypeError, ValueError):
+        return np.nan
+
+# Function to convert the CSV's local time date strings to Unix timestamps; each run shares
+# one date string, so only the distinct values are parsed
+def dates_to_timestamps(dates):
+    import pandas as pd
+    codes, uniques = pd.factorize(dates)
+    parsed = np.array([_parse_date(date) for date in uniques], dtype=np.float64)
+    timestamps = np.where(codes >= 0, parsed[codes] if len(parsed) else np.nan, np.nan)
+    return np.nan_to_num(timestamps, nan=0).astype(np.int64)
+
+def _empty_columns(columns):
+    return {column: np.zeros(0, dtype=np.float64 if column in FLOAT_COLUMNS else np.int64 if column == 'timestamp' else
+                             bool if column == 'increase' else object) for column in columns}
+
+# Function to keep only the rows in a date range and set of channels
+def _filter(result, start=None, end=None, chan_ids=None):
+    mask = np.ones(len(next(iter(result.values()))), dtype=bool)
+    if start is not None:
+        mask &= result['timestamp'] >= start
+    if end is not None:
+        mask &= result['timestamp'] < end
+    if chan_ids is not None:
+        mask &= np.isin(result['chan_id'], [str(chan_id) for chan_id in chan_ids])
+    if mask.all():
+        return result, len(mask)
+    return {column: values[mask] for column, values in result.items()}, int(mask.sum())
+
+def _filter_columns(columns, start=None, end=None, chan_ids=None):
+    return list(dict.fromkeys(list(columns) + (['timestamp'] if start is not None or end is not None else []) +
+                              (['chan_id'] if chan_ids is not None else [])))
+
+class CsvDataStore:
+    def __init__(self, path):
+        self.path = path
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # Rows are (timestamp, state, chan_id, alias, increase, reason, adjustment_amount, reward, next_state)
+    def append(self, rows):
+        file_exists = os.path.isfile(self.path)
+        with open(self.path, mode='a', newline='') as file:
+            writer = csv.writer(file)
+            if not file_exists:
+                writer.writerow(CSV_HEADER)
+            for timestamp, *values in rows:
+                writer.writerow([datetime.fromtimestamp(timestamp).strftime(DATE_FORMAT)] + values)
+
+    # The position is the file size, so a read can resume at the byte after the last row read
+    def position(self):
+        return os.path.getsize(self.path) if os.path.isfile(self.path) else 0
+
+    # Function to read rows after a position, returning the columns, the number of rows and the position after them
+    def read(self, after=0, start=None, end=None, chan_ids=None, columns=DATA_COLUMNS):
+        if not os.path.isfile(self.path):
+            return _empty_columns(columns), 0, 0
+        usecols = _filter_columns(columns, start, end, chan_ids)
+        with open(self.path, mode='rb') as file:
+            header = file.readline().decode().strip().split(',')
+            file.seek(max(after, file.tell()))
+            if file.peek(1) == b'':
+                return _empty_columns(columns), 0, file.tell()
+            result = self._parse(file, header, usecols)
+            position = file.seek(0, os.SEEK_END)
+
+        result, rows = _filter(result, start, end, chan_ids)
+        return {column: result[column] for column in columns}, rows, position
+
+    # Function to read rows after a position in chunks of whole lines, yielding the columns,
+    # the number of rows and the position after each chunk
+    def read_chunks(self, after=0, columns=DATA_COLUMNS, chunk_rows=CHUNK_ROWS):
+        if not os.path.isfile(self.path):
+            return
+        with open(self.path, mode='rb') as file:
+            header = file.readline().decode().strip().split(',')
+            position = file.seek(max(after, file.tell()))
+            while True:
+                block = file.read(chunk_rows * CSV_ROW_BYTES)
+                if not block:
+                    break
+                if not block.endswith(b'\n'):
+                    block += file.readline()
+                position += len(block)
+                if block.strip():
+                    result = self._parse(io.BytesIO(block), header, columns)
+                    yield result, len(result[columns[0]]), position
+
+    def _parse(self, source, header, columns):
+        import pandas as pd  # Only reading needs pandas, so it is not imported at startup
+        data = pd.read_csv(source, header=None, names=header, usecols=[CSV_COLUMNS[column] for column in columns],
+                           dtype={CSV_COLUMNS[column]: str for column in columns if column not in FLOAT_COLUMNS},
+                           na_values=['None'], keep_default_na=False, float_precision='round_trip')
+        result = {}
+        for column in columns:
+            values = data[CSV_COLUMNS[column]]
+            if column in FLOAT_COLUMNS:
+                result[column] = column_to_float(values)
+            elif column == 'timestamp':
+                result[column] = dates_to_timestamps(values)
+            elif column == 'increase':
+                result[column] = values.to_numpy() == 'True'
+            else:
+                result[column] = values.to_numpy(dtype=object)
+        return result
+
+class SqliteDataStore:
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS fee_adjustments (
+                row_id INTEGER PRIMARY KEY,
+                timestamp INTEGER NOT NULL,
+                state REAL,
+                chan_id TEXT NOT NULL,
+                alias TEXT,
+                increase INTEGER NOT NULL,
+                reason TEXT,
+                adjustment_amount REAL,
+                reward REAL,
+                next_state REAL
+            )""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS fee_adjustments_timestamp ON fee_adjustments (timestamp)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS fee_adjustments_channel ON fee_adjustments (chan_id, timestamp)")
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def append(self, rows):
+        with self.conn:
+            self.conn.executemany(f"INSERT INTO fee_adjustments ({', '.join(DATA_COLUMNS)}) VALUES ({', '.join('?' * len(DATA_COLUMNS))})",
+                                  ((int(timestamp), state, str(chan_id), alias, int(bool(increase)), reason, adjustment_amount, reward, next_state)
+                                   for timestamp, state, chan_id, alias, increase, reason, adjustment_amount, reward, next_state in rows))
+
+    # The position is the last row ID, so a read can resume at the next row
+    def position(self):
+        return self.conn.execute("SELECT COALESCE(MAX(row_id), 0) FROM fee_adjustments").fetchone()[0]
+
+    # Function to read rows after a position, returning the columns, the number of rows and the position after them.
+    # Date and channel filters use the indexes.
+    def read(self, after=0, start=None, end=None, chan_ids=None, columns=DATA_COLUMNS):
+        position = self.position()
+        conditions, params = ["row_id > ?", "row_id <= ?"], [after, position]
+        if start is not None:
+            conditions.append("timestamp >= ?")
+            params.append(int(start))
+        if end is not None:
+            conditions.append("timestamp < ?")
+            params.append(int(end))
+        if chan_ids is not None:
+            chan_ids = [str(chan_id) for chan_id in chan_ids]
+            conditions.append(f"chan_id IN ({', '.join('?' * len(chan_ids))})")
+            params.extend(chan_ids)
+        rows = self.conn.execute(f"SELECT {', '.join(columns)} FROM fee_adjustments WHERE {' AND '.join(conditions)} ORDER BY row_id", params).fetchall()
+        return self._to_columns(columns, rows), len(rows), position
+
+    # Function to read rows after a position in chunks, yielding the columns, the number of rows
+    # and the position after each chunk
+    def read_chunks(self, after=0, columns=DATA_COLUMNS, chunk_rows=CHUNK_ROWS):
+        end = self.position()
+        while after < end:
+            rows = self.conn.execute(f"SELECT row_id, {', '.join(columns)} FROM fee_adjustments WHERE row_id > ? AND row_id <= ? ORDER BY row_id LIMIT ?",
+                                     (after, end, chunk_rows)).fetchall()
+            if not rows:
+                break
+            after = rows[-1][0]
+            yield self._to_columns(columns, [row[1:] for row in rows]), len(rows), after
+
+    def _to_columns(self, columns, rows):
+        if not rows:
+            return _empty_columns(columns)
+        result = {}
+        for column, values in zip(columns, zip(*rows)):
+            if column in FLOAT_COLUMNS:
+                result[column] = np.array(values, dtype=np.float64)  # NULL becomes NaN
+            elif column == 'timestamp':
+                result[column] = np.array(values, dtype=np.int64)
+            elif column == 'increase':
+                result[column] = np.array(values, dtype=bool)
+            else:
+                result[column] = np.array(values, dtype=object)
+        return result
+
+class ColumnarDataStore:
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.meta_path = os.path.join(path, 'meta.json')
+        self.meta = {'partitions': [], 'dictionaries': {column: [] for column in DICTIONARY_COLUMNS}}
+        if os.path.isfile(self.meta_path):
+            with open(self.meta_path) as file:
+                self.meta = json.load(file)
+        self.codes = {column: {value: code for code, value in enumerate(values)} for column, values in self.meta['dictionaries'].items()}
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # The metadata is replaced atomically, after the column files are written, so its row counts
+    # only ever cover complete rows
+    def _save_meta(self):
+        with open(self.meta_path + '.tmp', mode='w') as file:
+            json.dump(self.meta, file)
+        os.replace(self.meta_path + '.tmp', self.meta_path)
+
+    def _column_file(self, partition, column):
+        return os.path.join(self.path, partition['name'], f"{column}.bin")
+
+    def _encode(self, column, values):
+        if column in DICTIONARY_COLUMNS:
+            codes = self.codes[column]
+            for value in values:
+                if str(value) not in codes:
+                    codes[str(value)] = len(codes)
+                    self.meta['dictionaries'][column].append(str(value))
+            return np.array([codes[str(value)] for value in values], dtype=np.uint32)
+        if column == 'chan_id':
+            return np.array([int(value) for value in values], dtype=np.uint64)
+        return np.array(values, dtype=COLUMN_TYPES[column])  # None becomes NaN in float columns
+
+    # Rows are split into runs of the same month (UTC), each appended to that month's partition
+    def append(self, rows):
+        if not rows:
+            return
+        columns = {column: self._encode(column, values) for column, values in zip(DATA_COLUMNS, zip(*rows))}
+        months = columns['timestamp'].astype('datetime64[s]').astype('datetime64[M]')
+        bounds = [0] + (np.flatnonzero(months[1:] != months[:-1]) + 1).tolist() + [len(rows)]
+        for first, last in zip(bounds[:-1], bounds[1:]):
+            self._append_partition(str(months[first]), {column: values[first:last] for column, values in columns.items()})
+        self._save_meta()
+
+    def _append_partition(self, name, columns):
+        timestamps = columns['timestamp']
+        partitions = self.meta['partitions']
+        # Positions count rows in append order, so rows dated before the last partition still go into it
+        if not partitions or name > partitions[-1]['name']:
+            partitions.append({'name': name, 'rows': 0, 'min_time': int(timestamps.min()), 'max_time': int(timestamps.max())})
+            os.makedirs(os.path.join(self.path, name), exist_ok=True)
+        partition = partitions[-1]
+
+        for column, values in columns.items():
+            path = self._column_file(partition, column)
+            # Drop anything written after the last complete append, e.g. by an interrupted run
+            expected = partition['rows'] * values.itemsize
+            if os.path.isfile(path) and os.path.getsize(path) != expected:
+                os.truncate(path, expected)
+            with open(path, mode='ab') as file:
+                file.write(values.tobytes())
+        partition['rows'] += len(timestamps)
+        partition['min_time'] = min(partition['min_time'], int(timestamps.min()))
+        partition['max_time'] = max(partition['max_time'], int(timestamps.max()))
+
+    # The position is the number of rows appended
+    def position(self):
+        return sum(partition['rows'] for partition in self.meta['partitions'])
+
+    # Function to read rows after a position, returning the columns, the number of rows and the position after them.
+    # Partitions outside the date range are not read.
+    def read(self, after=0, start=None, end=None, chan_ids=None, columns=DATA_COLUMNS):
+        needed = _filter_columns(columns, start, end, chan_ids)
+        pieces = {column: [] for column in needed}
+        first = 0
+        for partition in self.meta['partitions']:
+            count, skip = partition['rows'], max(after - first, 0)
+            first += count
+            if skip >= count or (start is not None and partition['max_time'] < start) or (end is not None and partition['min_time'] >= end):
+                continue
+            for column in needed:
+                pieces[column].append(self._read_column(partition, column, skip, count - skip))
+        position = first
+        if not pieces[needed[0]]:
+            return _empty_columns(columns), 0, position
+
+        data = {column: np.concatenate(arrays) for column, arrays in pieces.items()}
+        mask = None
+        if start is not None:
+            mask = data['timestamp'] >= start
+        if end is not None:
+            mask = (data['timestamp'] < end) if mask is None else mask & (data['timestamp'] < end)
+        if chan_ids is not None:
+            in_channels = np.isin(data['chan_id'], np.array([int(chan_id) for chan_id in chan_ids], dtype=np.uint64))
+            mask = in_channels if mask is None else mask & in_channels
+        if mask is not None:
+            data = {column: values[mask] for column, values in data.items()}
+        return self._decode(data, columns), len(next(iter(data.values()))), position
+
+    # Function to read rows after a position in chunks, yielding the columns, the number of rows
+    # and the position after each chunk
+    def read_chunks(self, after=0, columns=DATA_COLUMNS, chunk_rows=CHUNK_ROWS):
+        first = 0
+        for partition in list(self.meta['partitions']):
+            count = partition['rows']
+            for skip in range(max(after - first, 0), count, chunk_rows):
+                rows = min(chunk_rows, count - skip)
+                data = {column: self._read_column(partition, column, skip, rows) for column in columns}
+                yield self._decode(data, columns), rows, first + skip + rows
+            first += count
+
+    def _read_column(self, partition, column, skip, count):
+        dtype = np.dtype(COLUMN_TYPES[column])
+        return np.fromfile(self._column_file(partition, column), dtype=dtype, count=count, offset=skip * dtype.itemsize)
+
+    # Function to turn stored codes and channel IDs back into strings
+    def _decode(self, data, columns):
+        result = {}
+        for column in columns:
+            values = data[column]
+            if column in DICTIONARY_COLUMNS:
+                result[column] = np.array(self.meta['dictionaries'][column], dtype=object)[values]
+            elif column == 'chan_id':
+                unique, inverse = np.unique(values, return_inverse=True)
+                result[column] = np.array([str(value) for value in unique.tolist()], dtype=object)[inverse]
+            else:
+                result[column] = values
+        return result
+
+# Function to open the data store for a backend name, as configured in fee_setting_agent.py
+def open_data_store(backend="sqlite", path="fee_adjustment_data.db"):
+    if backend == "csv":
+        return CsvDataStore(path)
+    if backend == "sqlite":
+        return SqliteDataStore(path)
+    if backend == "columnar":
+        return ColumnarDataStore(path)
+    raise ValueError(f"Unknown data store backend: {backend}")
+
+# Function to copy every row of a CSV data file into another store, in order, keeping rows with
+# values that do not parse (as NULL) so row counts match the CSV. Returns the number of rows copied
+# and the store position before the copy.
+def migrate_csv(csv_path, store):
+    import pandas as pd
+    first_position = store.position()
+    copied = 0
+    with open(csv_path, mode='rb') as file:
+        for chunk in pd.read_csv(file, dtype={'Increase': str, 'Channel ID': str, 'Alias': str, 'Reason': str}, na_values=['None'],
+                                 keep_default_na=False, float_precision='round_trip', chunksize=MIGRATION_CHUNK_ROWS):
+            columns = [dates_to_timestamps(chunk['Date']).tolist()]
+            for column in DATA_COLUMNS[1:]:
+                values = chunk[CSV_COLUMNS[column]]
+                if column in FLOAT_COLUMNS:
+                    values = column_to_float(values)
+                    columns.append([None if np.isnan(value) else value for value in values.tolist()])
+                elif column == 'increase':
+                    columns.append((values.to_numpy() == 'True').tolist())
+                else:
+                    columns.append(values.tolist())
+            store.append(list(zip(*columns)))
+            copied += len(chunk)
+    return copied, first_position
+
+# Function to point a Q-table checkpoint, counted in CSV rows, at the same rows in the migrated store
+def migrate_checkpoint(checkpoint_path, first_position, backend):
+    with open(checkpoint_path) as file:
+        checkpoint = json.load(file)
+    if checkpoint.get('backend', 'csv') != 'csv':
+        return checkpoint
+    checkpoint = {'rows_applied': checkpoint['rows_applied'], 'offset': first_position + checkpoint['rows_applied'], 'backend': backend}
+    with open(checkpoint_path, mode='w') as file:
+        json.dump(checkpoint, file)
+    return checkpoint
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Migrate a fee adjustment CSV file to another data store")
+    parser.add_argument('csv_file')
+    parser.add_argument('store_path', help="Directory for the columnar store, or file for the SQLite store")
+    parser.add_argument('--backend', choices=['columnar', 'sqlite'], default='columnar')
+    parser.add_argument('--checkpoint', metavar='FILE', help="Q-table checkpoint to update, so training resumes where it left off")
+    options = parser.parse_args(argv)
+    with open_data_store(options.backend, options.store_path) as store:
+        copied, first_position = migrate_csv(options.csv_file, store)
+    print(f"Copied {copied} rows from {options.csv_file} to {options.store_path}")
+    if options.checkpoint and os.path.isfile(options.checkpoint):
+        checkpoint = migrate_checkpoint(options.checkpoint, first_position, options.backend)
+        print(f"Updated {options.checkpoint}: {checkpoint['rows_applied']} rows applied, up to position {checkpoint['offset']}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+# Local SQLite store of forwarding events fetched from lncli fwdinghistory.
+# Events are appended page by page as they are fetched, so each run only has to
+# download events newer than the last stored offset, and aggregation windows are
+# answered locally from an index on the event timestamp. Windows are loaded as
+# ForwardingEvents, a compact in-memory model of the events for aggregation.
+
+import sqlite3
+
+import numpy as np
+
+EVENT_COLUMNS = ['timestamp_ns', 'chan_id_in', 'chan_id_out', 'amt_in_msat', 'amt_out_msat', 'fee_msat']
+# One forward in 40 bytes, with channels as indexes into a sorted array of channel IDs
+EVENT_DTYPE = np.dtype([('timestamp_ns', np.int64), ('chan_in', np.int32), ('chan_out', np.int32),
+                        ('amt_in_msat', np.int64), ('amt_out_msat', np.int64), ('fee_msat', np.int64)])
+
+STORE_ROW_DTYPE = np.dtype([(column, np.int64) for column in ['event_index'] + EVENT_COLUMNS])
+
+# Function to parse channel IDs, given as strings or integers, to uint64 in one vectorized step
+def parse_chan_ids(values):
+    if not len(values):
+        return np.zeros(0, dtype=np.uint64)
+    if isinstance(values, np.ndarray) and values.dtype.kind in 'iu':
+        return values.astype(np.uint64)
+    return np.asarray(values, dtype=np.str_).astype(np.uint64)
+
+# Forwarding events as one structured array in time order, instead of a dict of strings per
+# event. Channel IDs are interned once as uint64 in chan_ids, and events refer to them by
+# their dense index, so per-channel sums are bincounts. Time windows are views of the same
+# array, found by binary search, and share its chan_ids.
+class ForwardingEvents:
+    __slots__ = ('events', 'chan_ids')
+
+    def __init__(self, events=None, chan_ids=None):
+        self.events = events if events is not None else np.zeros(0, dtype=EVENT_DTYPE)
+        self.chan_ids = chan_ids if chan_ids is not None else np.zeros(0, dtype=np.uint64)
+
+    # Function to build the events from columns, as read from the store or fwdinghistory
+    @classmethod
+    def from_columns(cls, timestamp_ns, chan_id_in, chan_id_out, amt_in_msat, amt_out_msat, fee_msat):
+        count = len(timestamp_ns)
+        chan_ids, index = np.unique(np.concatenate([parse_chan_ids(chan_id_in), parse_chan_ids(chan_id_out)]), return_inverse=True)
+        events = np.zeros(count, dtype=EVENT_DTYPE)
+        events['timestamp_ns'] = np.asarray(timestamp_ns).astype(np.int64) if count else 0
+        events['chan_in'], events['chan_out'] = index[:count], index[count:]
+        for column, values in (('amt_in_msat', amt_in_msat), ('amt_out_msat', amt_out_msat), ('fee_msat', fee_msat)):
+            events[column] = np.asarray(values).astype(np.int64) if count else 0
+        if count and (np.diff(events['timestamp_ns']) < 0).any():
+            events = events[np.argsort(events['timestamp_ns'], kind='stable')]
+        return cls(events, chan_ids)
+
+    # Function to build the events from dicts in fwdinghistory form, whose numbers are strings
+    @classmethod
+    def from_dicts(cls, forwarding_events):
+        columns = [[event.get(column) or int(event.get('timestamp', 0)) * 1000000000 for event in forwarding_events] if column == 'timestamp_ns'
+                   else [event[column] for event in forwarding_events] for column in EVENT_COLUMNS]
+        return cls.from_columns(*columns)
+
+    def __len__(self):
+        return len(self.events)
+
+    # Function to add later events, merging the channel IDs of both
+    def extend(self, other):
+        if not len(other):
+            return self
+        chan_ids = np.union1d(self.chan_ids, other.chan_ids)
+        events = np.concatenate([self.events, other.events])
+        for part, part_ids in ((events[:len(self)], self.chan_ids), (events[len(self):], other.chan_ids)):
+            index = np.searchsorted(chan_ids, part_ids).astype(np.int32)
+            part['chan_in'], part['chan_out'] = index[part['chan_in']], index[part['chan_out']]
+        if len(self) and self.events['timestamp_ns'][-1] > other.events['timestamp_ns'][0]:
+            events = events[np.argsort(events['timestamp_ns'], kind='stable')]
+        return ForwardingEvents(events, chan_ids)
+
+    # Function to get the events between start_time and end_time (seconds), or all events from
+    # start_time when end_time is None, without copying them
+    def window(self, start_time, end_time=None):
+        timestamps = self.events['timestamp_ns']
+        start = np.searchsorted(timestamps, start_time * 1000000000)
+        end = np.searchsorted(timestamps, end_time * 1000000000) if end_time is not None else len(timestamps)
+        return ForwardingEvents(self.events[start:end], self.chan_ids)
+
+    # Function to get the dense index of each of the given channel IDs, or -1 for channels with no events
+    def index_of(self, chan_ids):
+        chan_ids = parse_chan_ids(chan_ids)
+        index = np.minimum(np.searchsorted(self.chan_ids, chan_ids), max(len(self.chan_ids) - 1, 0))
+        found = self.chan_ids[index] == chan_ids if len(self.chan_ids) else np.zeros(len(chan_ids), dtype=bool)
+        return np.where(found, index, -1)
+
+    # Function to sum the events per channel: fees, amount in, amount out, forwards in and
+    # forwards out, as rows of an array indexed like chan_ids
+    def totals(self):
+        events, num_channels = self.events, len(self.chan_ids)
+        totals = np.zeros((5, num_channels), dtype=np.int64)
+        np.add.at(totals[0], events['chan_out'], events['fee_msat'])
+        np.add.at(totals[1], events['chan_in'], events['amt_in_msat'])
+        np.add.at(totals[2], events['chan_out'], events['amt_out_msat'])
+        totals[3] = np.bincount(events['chan_in'], minlength=num_channels)
+        totals[4] = np.bincount(events['chan_out'], minlength=num_channels)
+        return totals
+
+    # Function to get the per-channel sums in the form of aggregate_forwarding_events, for the
+    # channels with events in this window
+    def channel_stats(self):
+        totals = self.totals()
+        active = np.flatnonzero(totals[3] + totals[4])
+        return {str(chan_id): {'fees': fees, 'amt_in': amt_in, 'amt_out': amt_out, 'count_in': count_in, 'count_out': count_out}
+                for chan_id, fees, amt_in, amt_out, count_in, count_out in zip(self.chan_ids[active].tolist(), *totals[:, active].tolist())}
+
+class ForwardingEventStore:
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        self.cached = None  # ForwardingEvents read so far, from cached_start, up to event index cached_index
+        self.cached_start = 0
+        self.cached_index = -1
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS forwarding_events (
+                event_index INTEGER PRIMARY KEY,
+                timestamp_ns INTEGER NOT NULL,
+                chan_id_in TEXT NOT NULL,
+                chan_id_out TEXT NOT NULL,
+                amt_in_msat INTEGER NOT NULL,
+                amt_out_msat INTEGER NOT NULL,
+                fee_msat INTEGER NOT NULL
+            )""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS forwarding_events_timestamp ON forwarding_events (timestamp_ns)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS store_meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _get_meta(self, key, default=None):
+        row = self.conn.execute("SELECT value FROM store_meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def _set_meta(self, key, value):
+        self.conn.execute("INSERT OR REPLACE INTO store_meta (key, value) VALUES (?, ?)", (key, value))
+
+    # lnd counts index offsets from the start of the queried time range, so every
+    # query against this store uses the same start time, fixed on first sync
+    def start_time(self, default):
+        start_time = self._get_meta('start_time')
+        if start_time is None:
+            start_time = default
+            self._set_meta('start_time', start_time)
+            self.conn.commit()
+        return start_time
+
+    def last_offset(self):
+        return self._get_meta('last_offset', 0)
+
+    # Append one page of events and advance the stored offset in a single transaction
+    def add_events(self, forwarding_events, first_index, last_offset):
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO forwarding_events (event_index, timestamp_ns, chan_id_in, chan_id_out, amt_in_msat, amt_out_msat, fee_msat) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                ((first_index + i, int(event.get('timestamp_ns') or int(event['timestamp']) * 1000000000), event['chan_id_in'], event['chan_id_out'],
+                  int(event['amt_in_msat']), int(event['amt_out_msat']), int(event['fee_msat']))
+                 for i, event in enumerate(forwarding_events)))
+            self._set_meta('last_offset', last_offset)
+
+    # Return the events between start_time and end_time (seconds), in fwdinghistory form
+    def get_events(self, start_time, end_time):
+        cursor = self.conn.execute(
+            f"SELECT {', '.join(EVENT_COLUMNS)} FROM forwarding_events WHERE timestamp_ns >= ? AND timestamp_ns < ? ORDER BY timestamp_ns",
+            (start_time * 1000000000, end_time * 1000000000))
+        return [dict(zip(EVENT_COLUMNS, row)) for row in cursor]
+
+    # Read events as ForwardingEvents, with the largest event index read. SQLite converts the
+    # channel IDs to integers, which hold short channel IDs up to block 8,388,607, and the rows
+    # go straight into one array, without a Python object per value
+    def _read_events(self, condition, value, last_index):
+        cursor = self.conn.execute(
+            "SELECT event_index, timestamp_ns, CAST(chan_id_in AS INTEGER), CAST(chan_id_out AS INTEGER), amt_in_msat, amt_out_msat, fee_msat "
+            f"FROM forwarding_events WHERE {condition} ORDER BY event_index", (value,))
+        rows = np.fromiter(cursor, dtype=STORE_ROW_DTYPE)
+        return ForwardingEvents.from_columns(*(rows[column] for column in EVENT_COLUMNS)), int(rows['event_index'].max()) if len(rows) else last_index
+
+    # Return the events between start_time and end_time (seconds) as ForwardingEvents. Events
+    # are kept in memory once read, so a later window, as in daemon mode, only reads the events
+    # stored since and drops those before its start
+    def get_forwarding_events(self, start_time, end_time):
+        start_ns = start_time * 1000000000
+        if self.cached is None or start_ns < self.cached_start:
+            self.cached, self.cached_index = self._read_events("timestamp_ns >= ?", start_ns, -1)
+        else:
+            new_events, self.cached_index = self._read_events("event_index > ?", self.cached_index, self.cached_index)
+            self.cached = self.cached.extend(new_events).window(start_time, None)
+        self.cached_start = start_ns
+        return self.cached.window(start_time, end_time)
+
+    # Yield the events after event_index in chunks of at most chunk_rows, as lists of
+    # (event_index, timestamp_ns, chan_id_in, chan_id_out, amt_in_msat, amt_out_msat, fee_msat) rows
+    def get_event_chunks(self, after_index, chunk_rows):
+        while True:
+            rows = self.conn.execute(
+                f"SELECT event_index, {', '.join(EVENT_COLUMNS)} FROM forwarding_events WHERE event_index > ? ORDER BY event_index LIMIT ?",
+                (after_index, chunk_rows)).fetchall()
+            if not rows:
+                return
+            after_index = rows[-1][0]
+            yield rows
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Event-driven fee adjustment for fee_setting_agent.py. Instead of polling the forwarding
+# history, this consumes lnd's HTLC and channel event streams as they arrive and keeps
+# rolling, exponentially decaying flow counters per channel. When a channel's net flow
+# crosses FLOW_THRESHOLD, its fee is adjusted straight away with the agent's rule based
+# adjustments, subject to the same per-channel cooldown, and its counters start again from zero,
+# so only new flow adjusts it again.
+#
+#   python event_stream.py                    # live, needs NODE_BACKEND = "rest"
+#   python event_stream.py --fake --dry-run   # replay a fake node's history
+#   python event_stream.py --replay events.jsonl   # no node needed; prints the fee changes it would make
+
+import argparse
+import json
+import threading
+from queue import Queue
+
+import fee_setting_agent as agent
+from instrumentation import configure_logging
+from node_client import NodeError
+
+# Configuration parameters
+FLOW_HALF_LIFE = 3 * 86400  # Seconds after which a forward counts for half as much, standing in for the fixed aggregation window
+FLOW_THRESHOLD = 5  # Decayed net forwards (outgoing minus incoming) in either direction that trigger a fee adjustment
+SEED_FROM_HISTORY = True  # Start the counters from the forwarding history of the last AGGREGATION_DAYS
+RECORD_FILE = None  # Set to a file name to record every event received, as JSON lines that can be replayed with --replay
+
+COUNTER_FIELDS = ['count_in', 'count_out', 'amt_in', 'amt_out', 'fees']
+
+# Rolling per-channel forwarding counters. Each channel keeps only its last update time and
+# one decayed value per field, so memory does not grow with the number of events.
+class FlowCounters:
+    def __init__(self, half_life=None):
+        self.half_life = FLOW_HALF_LIFE if half_life is None else half_life
+        self.channels = {}  # chan_id -> [timestamp, count_in, count_out, amt_in, amt_out, fees]
+
+    def _decayed(self, chan_id, now):
+        counters = self.channels.get(chan_id)
+        if counters is None:
+            counters = self.channels[chan_id] = [now, 0.0, 0.0, 0.0, 0.0, 0.0]
+        elif now > counters[0]:
+            factor = 0.5 ** ((now - counters[0]) / self.half_life)
+            counters[1:] = [value * factor for value in counters[1:]]
+            counters[0] = now
+        return counters
+
+    # Function to start the counters from aggregated forwarding history, as returned by aggregate_forwarding_events
+    def seed(self, channel_stats, now):
+        for chan_id, stats in channel_stats.items():
+            self.channels[chan_id] = [now] + [float(stats[field]) for field in COUNTER_FIELDS]
+
+    def add_forward(self, chan_id_in, chan_id_out, amt_in_msat, amt_out_msat, fee_msat, timestamp):
+        incoming = self._decayed(chan_id_in, timestamp)
+        incoming[1] += 1
+        incoming[3] += amt_in_msat
+        outgoing = self._decayed(chan_id_out, timestamp)
+        outgoing[2] += 1
+        outgoing[4] += amt_out_msat
+        outgoing[5] += fee_msat
+
+    def net_flow(self, chan_id, now):
+        counters = self._decayed(chan_id, now)
+        return counters[2] - counters[1]
+
+    # Function to get the counters in the form of aggregate_forwarding_events, for rule_based_adjustments
+    def stats(self, chan_ids, now):
+        return {chan_id: dict(zip(COUNTER_FIELDS, self._decayed(chan_id, now)[1:])) for chan_id in chan_ids}
+
+    # Function to start a channel's counters again from zero, once its flow has been acted on
+    def reset(self, chan_id, now):
+        self.channels[chan_id] = [now, 0.0, 0.0, 0.0, 0.0, 0.0]
+
+    def remove(self, chan_id):
+        self.channels.pop(chan_id, None)
+
+# Pairs each forwarded HTLC with its settlement or failure. Only HTLCs in flight are kept.
+class HtlcTracker:
+    def __init__(self):
+        self.pending = {}
+
+    # Function to handle one HTLC event; returns the settled forward, if this event settled one
+    def handle(self, event):
+        if event.get('event_type') != 'FORWARD':
+            return None
+        # lnd's REST API leaves out fields with zero values, such as the first HTLC ID on a channel
+        key = (event.get('incoming_channel_id', '0'), event.get('incoming_htlc_id', '0'),
+               event.get('outgoing_channel_id', '0'), event.get('outgoing_htlc_id', '0'))
+        if 'forward_event' in event:
+            info = event['forward_event'].get('info', {})
+            self.pending[key] = (int(info.get('incoming_amt_msat', 0)), int(info.get('outgoing_amt_msat', 0)))
+        elif 'settle_event' in event:
+            amounts = self.pending.pop(key, None)
+            if amounts:
+                amt_in_msat, amt_out_msat = amounts
+                return key[0], key[2], amt_in_msat, amt_out_msat, amt_in_msat - amt_out_msat, int(event.get('timestamp_ns', 0)) / 1e9
+        elif 'forward_fail_event' in event or 'link_fail_event' in event:
+            self.pending.pop(key, None)
+        return None
+
+# Adjusts fees on the node's channels, or, given the channels as channel_aliases, only plans
+# the adjustments without a node, as when replaying recorded events
+class EventDrivenAdjuster:
+    def __init__(self, counters, threshold=None, channel_aliases=None):
+        self.counters = counters
+        self.threshold = FLOW_THRESHOLD if threshold is None else threshold
+        self.tracker = HtlcTracker()
+        self.plan_only = channel_aliases is not None
+        self.channel_aliases = agent.get_all_channels() if channel_aliases is None else channel_aliases
+        self.clock = agent.current_time()  # Time of the latest event
+        self.forwards = 0
+        self.adjustments = 0
+
+    # Function to handle an HTLC event, adjusting fees on the channels whose net flow crossed the threshold
+    def handle_htlc_event(self, event):
+        forward = self.tracker.handle(event)
+        if forward is None:
+            return {}
+        chan_id_in, chan_id_out, amt_in_msat, amt_out_msat, fee_msat, timestamp = forward
+        self.clock = max(self.clock, timestamp)
+        self.counters.add_forward(chan_id_in, chan_id_out, amt_in_msat, amt_out_msat, fee_msat, timestamp)
+        self.forwards += 1
+        triggered = [chan_id for chan_id in dict.fromkeys((chan_id_in, chan_id_out))
+                     if chan_id in self.channel_aliases and abs(self.counters.net_flow(chan_id, timestamp)) >= self.threshold]
+        return self.adjust(triggered) if triggered else {}
+
+    # Function to handle a channel event: opened and closed channels change the set of channels to adjust
+    def handle_channel_event(self, event):
+        if event.get('type') in ('OPEN_CHANNEL', 'CLOSED_CHANNEL') and not self.plan_only:
+            self.channel_aliases = agent.get_all_channels()
+        if event.get('type') == 'CLOSED_CHANNEL':
+            chan_id = event.get('closed_channel', {}).get('chan_id')
+            self.counters.remove(chan_id)
+            if self.plan_only:
+                self.channel_aliases.pop(chan_id, None)
+
+    # Function to adjust fees on the given channels from their rolling counters, with the rule based adjustments.
+    # The adjusted channels' counters are reset, so only new flow beyond the threshold adjusts them again.
+    def adjust(self, chan_ids):
+        actions = agent.apply_cooldowns(agent.rule_based_adjustments(self.counters.stats(chan_ids, self.clock),
+                                                                     {chan_id: self.channel_aliases[chan_id] for chan_id in chan_ids}))
+        if not actions:
+            return {}
+        for action in actions:
+            self.counters.reset(action[0], self.clock)
+        if self.plan_only:
+            # Without the node's current policies only the direction of each change is known
+            for chan_id, alias, increase, reason, adjustment_amount in actions:
+                print(f"Would {'raise' if increase else 'lower'} the fee on {alias} by {adjustment_amount}: {reason}")
+                agent.FEE_UPDATE_TIMES[chan_id] = self.clock  # In memory only, so the cooldowns apply as they would have
+            self.adjustments += len(actions)
+            return {}
+        fee_rates = agent.apply_fee_adjustments(actions)
+        agent.record_fee_updates(fee_rates)
+        self.adjustments += sum(new_fee_rate != current_fee_rate for current_fee_rate, new_fee_rate in fee_rates.values())
+        return fee_rates
+
+# Function to merge lnd's HTLC and channel event streams into one, read by a thread per stream
+def subscribe_events(client):
+    queue = Queue()
+
+    def pump(kind, command):
+        try:
+            for event in client.subscribe(command):
+                queue.put((kind, event))
+        except NodeError as error:
+            queue.put(('error', f"{command}: {error}"))
+        queue.put(('end', command))
+
+    for kind, command in (('htlc', 'subscribehtlcevents'), ('channel', 'subscribechannelevents')):
+        threading.Thread(target=pump, args=(kind, command), daemon=True).start()
+    open_streams = 2
+    while open_streams:
+        kind, event = queue.get()
+        if kind == 'error':
+            raise Exception(f"Error in event subscription {event}")
+        if kind == 'end':
+            open_streams -= 1
+            continue
+        yield kind, event
+
+# Function to read events recorded with RECORD_FILE
+def read_recorded_events(path):
+    with open(path) as file:
+        for line in file:
+            if line.strip():
+                record = json.loads(line)
+                yield record['kind'], record['event']
+
+# Function to list the channels seen in recorded events, in the form of get_all_channels, for
+# replaying them without a node
+def recorded_channels(path):
+    channels = {}
+    for kind, event in read_recorded_events(path):
+        if kind == 'htlc' and event.get('event_type') == 'FORWARD':
+            for chan_id in (event.get('incoming_channel_id', '0'), event.get('outgoing_channel_id', '0')):
+                channels.setdefault(chan_id, (None, chan_id, None, None))
+    return channels
+
+# Function to feed events through the adjuster, recording them if RECORD_FILE is set
+def run_event_stream(events, adjuster):
+    record = open(RECORD_FILE, mode='a') if RECORD_FILE else None
+    try:
+        for kind, event in events:
+            if record:
+                record.write(json.dumps({'kind': kind, 'event': event}) + '\n')
+            if kind == 'htlc':
+                adjuster.handle_htlc_event(event)
+            else:
+                adjuster.handle_channel_event(event)
+    finally:
+        if record:
+            record.close()
+    print(f"Event stream ended after {adjuster.forwards} forwards and {adjuster.adjustments} fee adjustments.")
+
+def main(argv=None):
+    global RECORD_FILE
+    parser = argparse.ArgumentParser(description="Adjust channel fees as HTLC events arrive")
+    parser.add_argument('--dry-run', action='store_true', help="Print the planned fee changes without applying them")
+    parser.add_argument('--replay', metavar='FILE', help="Replay events recorded with --record instead of subscribing, "
+                                                             "printing the fee changes it would make; needs no node")
+    parser.add_argument('--record', metavar='FILE', help="Record every event received to this file")
+    parser.add_argument('--fake', action='store_true', help="Use an offline fake node, replaying its forwarding history as events")
+    options = parser.parse_args(argv)
+    configure_logging(agent.DEBUG)
+    # Recorded events are out of date, so replaying them only plans fee changes, never applies them
+    agent.DRY_RUN = agent.DRY_RUN or options.dry_run or bool(options.replay)
+    RECORD_FILE = options.record or RECORD_FILE
+    agent.PROMPT = False  # Events are handled unattended
+
+    counters = FlowCounters()
+    if options.replay:
+        adjuster = EventDrivenAdjuster(counters, channel_aliases=recorded_channels(options.replay))
+        events = read_recorded_events(options.replay)
+    else:
+        if options.fake:
+            from fake_lnd import FakeNode
+            agent.NODE = FakeNode()
+        client = agent.get_node_client()
+        if not options.fake:
+            agent.load_fee_update_times()
+            if SEED_FROM_HISTORY:
+                counters.seed(agent.aggregate_forwarding_events(agent.get_forwarding_history(agent.AGGREGATION_DAYS)), agent.current_time())
+        adjuster = EventDrivenAdjuster(counters)
+        events = subscribe_events(client)
+    live = not (options.fake or options.replay)
+    if not live:
+        # Replayed events carry their original timestamps, so cooldowns follow the event clock
+        adjuster.clock = 0
+        agent.CLOCK = lambda: adjuster.clock
+
+    try:
+        run_event_stream(events, adjuster)
+    except KeyboardInterrupt:
+        print("Interrupted.")
+    if live and not agent.DRY_RUN:
+        agent.save_fee_update_times()
+
+if __name__ == "__main__":
+    main()
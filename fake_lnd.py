@@ -0,0 +1,576 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Offline stand-in for an LND node, for testing and benchmarking without a real node.
+# FakeNode answers the same calls as the backends in node_client.py from a
+# deterministic, seeded in-memory node. It can also be served over HTTP for
+# RestBackend, or run as a command line replacement for lncli:
+#
+#   python fake_lnd.py --channels 50 --events 10000 listchannels
+#   python fake_lnd.py --serve 8080
+
+import argparse
+import base64
+import hashlib
+import json
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+from event_store import EVENT_DTYPE
+from node_client import NodeClient, NodeError
+
+BOOLEAN_FLAGS = {'pending_only', 'allow_self_payment', 'force', 'json', 'keysend'}
+# Forwarding events are kept as one EVENT_DTYPE structured array, with channels as indexes
+# into a list of channel IDs, so nodes with millions of events stay small and quick to build
+
+# Function to turn rows of an EVENT_DTYPE array into events in fwdinghistory form
+def forwarding_event_dicts(events, chan_ids):
+    return [{'timestamp': str(timestamp_ns // 10 ** 9), 'timestamp_ns': str(timestamp_ns),
+             'chan_id_in': chan_ids[chan_in], 'chan_id_out': chan_ids[chan_out],
+             'amt_in_msat': str(amt_in), 'amt_out_msat': str(amt_out), 'fee_msat': str(fee)}
+            for timestamp_ns, chan_in, chan_out, amt_in, amt_out, fee in events.tolist()]
+
+# The rest of the network is kept the same way: channels between relay nodes and our peers,
+# as indexes into a list of pubkeys, with node1 the lower pubkey as in lnd. Policy fields
+# hold node1's policy then node2's, and balance1 is the part of the capacity on node1's side.
+NETWORK_DTYPE = np.dtype([('node1', np.int32), ('node2', np.int32), ('capacity', np.int64), ('balance1', np.int64),
+                          ('base_fee_msat', np.int64, (2,)), ('fee_rate_ppm', np.int64, (2,))])
+NETWORK_CHAN_BASE = 600000 * 2 ** 40  # Network channel IDs, below those of our channels
+KEYSEND_RECORD = '5482373484'  # Custom record that carries a keysend preimage
+
+def _pubkey(rng):
+    return '02' + ''.join(rng.choice('0123456789abcdef') for _ in range(64))
+
+def _txid(rng):
+    return ''.join(rng.choice('0123456789abcdef') for _ in range(64))
+
+class FakeNode(NodeClient):
+    def __init__(self, num_channels=10, num_events=1000, seed=0, days=7, now=None, payment_latency=0.0, network_nodes=None, network_channels=None):
+        self.rng = random.Random(seed)
+        self.now = int(now if now is not None else time.time())
+        self.pubkey = _pubkey(self.rng)
+        self.alias = f"fake-node-{seed}"
+        self.calls = Counter()
+        self.payment_latency = payment_latency  # Seconds each payment call takes, as a stand-in for pathfinding
+        self.lock = threading.Lock()
+
+        self.channels = {}
+        self.policies = {}
+        self.peer_policies = {}
+        self.peer_aliases = {}
+        for i in range(num_channels):
+            chan_id = str(700000 * 2 ** 40 + i * 2 ** 16 + 1)
+            capacity = self.rng.choice([1000000, 2000000, 5000000, 10000000])
+            local_balance = self.rng.randint(0, capacity)
+            remote_pubkey = _pubkey(self.rng)
+            self.peer_aliases[remote_pubkey] = f"peer-{i}"
+            self.channels[chan_id] = {
+                'chan_id': chan_id,
+                'channel_point': f"{_txid(self.rng)}:{i % 4}",
+                'remote_pubkey': remote_pubkey,
+                'peer_alias': f"peer-{i}",
+                'capacity': str(capacity),
+                'local_balance': str(local_balance),
+                'remote_balance': str(capacity - local_balance),
+                'active': True,
+            }
+            self.policies[chan_id] = {'fee_base_msat': '0', 'fee_rate_milli_msat': str(self.rng.choice([0, 10, 50, 100, 500])),
+                                      'time_lock_delta': 40, 'min_htlc': '1000', 'disabled': False}
+            self.peer_policies[chan_id] = {'fee_base_msat': '1000', 'fee_rate_milli_msat': str(self.rng.randint(0, 2000)),
+                                           'time_lock_delta': 80, 'min_htlc': '1000', 'disabled': False}
+
+        self.chan_ids = list(self.channels)
+        count = num_events if self.chan_ids else 0
+        event_rng = np.random.default_rng(seed)
+        self.events = np.zeros(count, dtype=EVENT_DTYPE)
+        self.events['timestamp_ns'] = np.sort(event_rng.integers((self.now - days * 86400) * 10 ** 9, self.now * 10 ** 9, count))
+        self.events['chan_in'] = event_rng.integers(0, len(self.chan_ids), count)
+        self.events['chan_out'] = event_rng.integers(0, len(self.chan_ids), count)
+        fee_ppm = np.array([int(self.policies[chan_id]['fee_rate_milli_msat']) for chan_id in self.chan_ids], dtype=np.int64)
+        self.events['amt_out_msat'] = event_rng.integers(1000, 2000000, count, endpoint=True) * 1000
+        self.events['fee_msat'] = self.events['amt_out_msat'] * fee_ppm[self.events['chan_out']] // 1000000
+        self.events['amt_in_msat'] = self.events['amt_out_msat'] + self.events['fee_msat']
+
+        self.invoices = {}
+        self.payments = []
+        self._build_network(seed, max(10, 2 * num_channels) if network_nodes is None else network_nodes, network_channels)
+
+    # Function to build the rest of the network: relay nodes joined to each other and to our
+    # peers by random channels, each with its capacity split at random between its two sides
+    def _build_network(self, seed, num_nodes, num_channels):
+        rng = np.random.default_rng(seed + 1)
+        peers = [channel['remote_pubkey'] for channel in self.channels.values()]
+        relays = ['03' + hashlib.sha256(f"relay-{seed}-{i}".encode()).hexdigest() for i in range(num_nodes)]
+        self.network_pubkeys = peers + relays
+        count = len(self.network_pubkeys)
+        if num_channels is None:
+            num_channels = 4 * count
+        self.network = np.zeros(num_channels if count > 1 else 0, dtype=NETWORK_DTYPE)
+        if not len(self.network):
+            return
+        # Every peer gets at least one channel into the network, the rest join random nodes
+        first = np.arange(len(self.network)) % count
+        other = rng.integers(0, count - 1, len(self.network))
+        other += other >= first
+        pubkeys = np.array(self.network_pubkeys)
+        swap = pubkeys[first] > pubkeys[other]
+        self.network['node1'] = np.where(swap, other, first)
+        self.network['node2'] = np.where(swap, first, other)
+        self.network['capacity'] = rng.choice([1000000, 2000000, 5000000, 10000000, 16000000], len(self.network))
+        self.network['balance1'] = rng.integers(0, self.network['capacity'], endpoint=True)
+        self.network['base_fee_msat'] = rng.choice([0, 0, 1000], (len(self.network), 2))
+        self.network['fee_rate_ppm'] = rng.choice([0, 1, 10, 25, 50, 100, 250, 500, 1000, 2500], (len(self.network), 2))
+        self.network_links = None  # (pubkey, pubkey) -> network channel indexes, built on first use
+
+    def call(self, command, *args, **flags):
+        handler = getattr(self, f"_{command}", None)
+        if handler is None:
+            raise NodeError(f"unknown command {command}")
+        if command in ('payinvoice', 'sendpayment', 'sendtoroute') and self.payment_latency:
+            time.sleep(self.payment_latency)
+        with self.lock:
+            self.calls[command] += 1
+            return handler(*args, **flags)
+
+    # Replays the forwarding history as HTLC events: a forward and its settlement for each
+    # event, plus a failed forward after every tenth. There are no channel or graph events to replay.
+    def subscribe(self, command):
+        if command not in ('subscribehtlcevents', 'subscribechannelevents', 'subscribechannelgraph'):
+            raise NodeError(f"unknown subscription {command}")
+        with self.lock:
+            self.calls[command] += 1
+            events = self.events.copy() if command == 'subscribehtlcevents' else self.events[:0]
+        return self._htlc_events(events)
+
+    def _htlc_events(self, events, batch_size=10000):
+        for first in range(0, len(events), batch_size):
+            for i, event in enumerate(forwarding_event_dicts(events[first:first + batch_size], self.chan_ids), first):
+                yield from self._htlc_event(i, event)
+
+    def _htlc_event(self, i, event):
+        htlc = {'incoming_channel_id': event['chan_id_in'], 'outgoing_channel_id': event['chan_id_out'], 'incoming_htlc_id': str(2 * i),
+                'outgoing_htlc_id': str(2 * i), 'timestamp_ns': event['timestamp_ns'], 'event_type': 'FORWARD'}
+        info = {'incoming_amt_msat': event['amt_in_msat'], 'outgoing_amt_msat': event['amt_out_msat']}
+        yield dict(htlc, forward_event={'info': info})
+        yield dict(htlc, settle_event={'preimage': ''})
+        if i % 10 == 9:
+            failed = dict(htlc, incoming_htlc_id=str(2 * i + 1), outgoing_htlc_id=str(2 * i + 1))
+            yield dict(failed, forward_event={'info': info})
+            yield dict(failed, forward_fail_event={})
+
+    def _getinfo(self):
+        return {'identity_pubkey': self.pubkey, 'alias': self.alias, 'num_active_channels': len(self.channels),
+                'block_height': 800000 + (self.now - 1600000000) // 600}
+
+    def _listchannels(self, **flags):
+        return {'channels': [dict(channel) for channel in self.channels.values()]}
+
+    def _feereport(self):
+        return {'channel_fees': [{'chan_id': chan_id, 'channel_point': channel['channel_point'],
+                                  'base_fee_msat': self.policies[chan_id]['fee_base_msat'],
+                                  'fee_per_mil': self.policies[chan_id]['fee_rate_milli_msat'],
+                                  'fee_rate': int(self.policies[chan_id]['fee_rate_milli_msat']) / 1000000}
+                                 for chan_id, channel in self.channels.items()]}
+
+    def _edge(self, chan_id):
+        channel = self.channels[chan_id]
+        # Like lnd, order the two ends of the edge by pubkey
+        ours = (self.pubkey, dict(self.policies[chan_id]))
+        theirs = (channel['remote_pubkey'], dict(self.peer_policies[chan_id]))
+        node1, node2 = sorted([ours, theirs])
+        return {'channel_id': chan_id, 'chan_point': channel['channel_point'], 'capacity': channel['capacity'],
+                'node1_pub': node1[0], 'node2_pub': node2[0], 'node1_policy': node1[1], 'node2_policy': node2[1]}
+
+    def _getchaninfo(self, chan_id):
+        if chan_id not in self.channels:
+            raise NodeError("edge not found")
+        return self._edge(chan_id)
+
+    def _network_edges(self):
+        pubkeys = self.network_pubkeys
+        for i, (node1, node2, capacity, balance1, base_fees, fee_rates) in enumerate(self.network.tolist()):
+            policies = [{'fee_base_msat': str(base_fee), 'fee_rate_milli_msat': str(fee_rate), 'time_lock_delta': 40,
+                         'min_htlc': '1000', 'max_htlc_msat': str(capacity * 990), 'disabled': False}
+                        for base_fee, fee_rate in zip(base_fees, fee_rates)]
+            yield {'channel_id': str(NETWORK_CHAN_BASE + i * 2 ** 16), 'chan_point': f"{hashlib.sha256(str(i).encode()).hexdigest()}:0",
+                   'capacity': str(capacity), 'node1_pub': pubkeys[node1], 'node2_pub': pubkeys[node2],
+                   'node1_policy': policies[0], 'node2_policy': policies[1]}
+
+    def _describegraph(self):
+        nodes = [{'pub_key': self.pubkey, 'alias': self.alias}]
+        nodes += [{'pub_key': pubkey, 'alias': alias} for pubkey, alias in self.peer_aliases.items()]
+        nodes += [{'pub_key': pubkey, 'alias': f"relay-{i}"} for i, pubkey in enumerate(self.network_pubkeys[len(self.peer_aliases):])]
+        return {'nodes': nodes, 'edges': [self._edge(chan_id) for chan_id in self.channels] + list(self._network_edges())}
+
+    def _getnodeinfo(self, pub_key):
+        if pub_key == self.pubkey:
+            alias = self.alias
+        elif pub_key in self.peer_aliases:
+            alias = self.peer_aliases[pub_key]
+        else:
+            raise NodeError("unable to find node")
+        return {'node': {'pub_key': pub_key, 'alias': alias}}
+
+    # Offsets count from the first event at or after start_time, as in lnd
+    def _fwdinghistory(self, start_time=0, end_time=None, index_offset=0, max_events=100):
+        timestamps = self.events['timestamp_ns']
+        first, last = np.searchsorted(timestamps, [int(start_time) * 10 ** 9, int(end_time or self.now) * 10 ** 9])
+        first = min(first + int(index_offset), last)
+        page = forwarding_event_dicts(self.events[first:min(first + int(max_events), last)], self.chan_ids)
+        return {'forwarding_events': page, 'last_offset_index': int(index_offset) + len(page)}
+
+    def _updatechanpolicy(self, base_fee_msat=0, fee_rate=0, time_lock_delta=40, min_htlc_msat=None, chan_point=None):
+        targets = [chan_id for chan_id, channel in self.channels.items() if chan_point in (None, channel['channel_point'])]
+        if chan_point is not None and not targets:
+            return {'failed_updates': [{'outpoint': chan_point, 'reason': 'NOT_FOUND', 'update_error': 'channel not found'}]}
+        for chan_id in targets:
+            policy = self.policies[chan_id]
+            policy['fee_base_msat'] = str(base_fee_msat)
+            policy['fee_rate_milli_msat'] = str(int(round(float(fee_rate) * 1000000)))
+            policy['time_lock_delta'] = int(time_lock_delta)
+            if min_htlc_msat is not None:
+                policy['min_htlc'] = str(min_htlc_msat)
+        return {'failed_updates': []}
+
+    def _listinvoices(self, pending_only=False, **flags):
+        invoices = [invoice for invoice in self.invoices.values() if not pending_only or invoice['state'] == 'OPEN']
+        return {'invoices': [dict(invoice) for invoice in invoices]}
+
+    # Invoices of amount 0 take whatever amount they are paid
+    def _addinvoice(self, amt, memo='', expiry=86400):
+        r_hash = hashlib.sha256(f"{self.pubkey}{len(self.invoices)}{memo}".encode()).hexdigest()
+        payment_request = f"lnbcrt{amt}fake{r_hash[:40]}"
+        payment_addr = hashlib.sha256(r_hash.encode()).hexdigest()
+        self.invoices[r_hash] = {'r_hash': r_hash, 'payment_request': payment_request, 'value': str(amt), 'memo': memo, 'state': 'OPEN',
+                                 'payment_addr': payment_addr, 'creation_date': str(self.now), 'expiry': str(expiry)}
+        return {'r_hash': r_hash, 'payment_request': payment_request, 'add_index': str(len(self.invoices)), 'payment_addr': payment_addr}
+
+    def _cancelinvoice(self, r_hash):
+        if r_hash not in self.invoices:
+            raise NodeError("unable to locate invoice")
+        self.invoices[r_hash]['state'] = 'CANCELED'
+        return {}
+
+    # Fee the network charges to route amt_sat from one of our channels back into another
+    def route_fee(self, outgoing_chan_id, last_hop, amt_sat):
+        digest = hashlib.sha256(f"{outgoing_chan_id}{last_hop}".encode()).digest()
+        fee_ppm = 50 + int.from_bytes(digest[:2], 'big') % 1500
+        return amt_sat * fee_ppm // 1000000
+
+    def _payinvoice(self, payment_request, amt=None, fee_limit=None, outgoing_chan_id=None, last_hop=None, **flags):
+        invoice = next((invoice for invoice in self.invoices.values() if invoice['payment_request'] == payment_request), None)
+        if invoice is None or invoice['state'] != 'OPEN':
+            raise NodeError("invoice not found or not open")
+        if int(invoice['value']) == 0 and not amt:
+            raise NodeError("amount must be specified when paying a zero amount invoice")
+        result = self._pay_circular(int(invoice['value']) or int(amt), fee_limit, outgoing_chan_id, last_hop, invoice['r_hash'])
+        if result['status'] == 'SUCCEEDED':
+            invoice['state'] = 'SETTLED'
+        return result
+
+    # Keysend, which the fake node only sends to itself
+    def _sendpayment(self, dest=None, amt=None, keysend=False, fee_limit=None, outgoing_chan_id=None, last_hop=None, **flags):
+        if not keysend:
+            raise NodeError("the fake node only sends keysend payments with sendpayment")
+        if dest != self.pubkey:
+            return {'status': 'FAILED', 'failure_reason': 'FAILURE_REASON_NO_ROUTE'}
+        preimage = hashlib.sha256(f"{self.pubkey}keysend{len(self.payments)}".encode()).digest()
+        return self._pay_circular(int(amt), fee_limit, outgoing_chan_id, last_hop, hashlib.sha256(preimage).hexdigest())
+
+    # Pays amt from one of our channels back into another, at the fee route_fee gives
+    def _pay_circular(self, amt, fee_limit, outgoing_chan_id, last_hop, payment_hash):
+        incoming = next((channel for channel in self.channels.values() if channel['remote_pubkey'] == last_hop), None)
+        outgoing = self.channels.get(str(outgoing_chan_id))
+        if incoming is None or outgoing is None:
+            return {'status': 'FAILED', 'failure_reason': 'FAILURE_REASON_NO_ROUTE'}
+        fee = self.route_fee(outgoing['chan_id'], last_hop, amt)
+        if fee_limit is not None and fee > int(fee_limit):
+            return {'status': 'FAILED', 'failure_reason': 'FAILURE_REASON_NO_ROUTE'}
+        if int(outgoing['local_balance']) < amt + fee or int(incoming['remote_balance']) < amt:
+            return {'status': 'FAILED', 'failure_reason': 'FAILURE_REASON_INSUFFICIENT_BALANCE'}
+        outgoing['local_balance'] = str(int(outgoing['local_balance']) - amt - fee)
+        outgoing['remote_balance'] = str(int(outgoing['remote_balance']) + amt + fee)
+        incoming['local_balance'] = str(int(incoming['local_balance']) + amt)
+        incoming['remote_balance'] = str(int(incoming['remote_balance']) - amt)
+        self.payments.append({'outgoing_chan_id': outgoing['chan_id'], 'incoming_chan_id': incoming['chan_id'], 'amount': amt, 'fee': fee})
+        return {'status': 'SUCCEEDED', 'fee_sat': str(fee), 'value_sat': str(amt), 'payment_hash': payment_hash,
+                'htlcs': [{'status': 'SUCCEEDED', 'route': {'total_fees': str(fee), 'hops': [
+                    {'chan_id': outgoing['chan_id']}, {'chan_id': '0'}, {'chan_id': incoming['chan_id']}]}}]}
+
+    # Function to find the channel a route takes from one node to the next: (chan_id, capacity,
+    # base fee, fee rate, network channel index or None, direction), the fees being those the
+    # sending node charges
+    def _route_link(self, source, target):
+        if target == self.pubkey:
+            chan_id = next((chan_id for chan_id, channel in self.channels.items() if channel['remote_pubkey'] == source), None)
+            if chan_id is None:
+                return None
+            policy = self.peer_policies[chan_id]
+            return chan_id, int(self.channels[chan_id]['capacity']), int(policy['fee_base_msat']), int(policy['fee_rate_milli_msat']), None, None
+        if self.network_links is None:
+            self.network_links = {}
+            for i, (node1, node2) in enumerate(zip(self.network['node1'].tolist(), self.network['node2'].tolist())):
+                self.network_links.setdefault((self.network_pubkeys[node1], self.network_pubkeys[node2]), []).append((i, 0))
+                self.network_links.setdefault((self.network_pubkeys[node2], self.network_pubkeys[node1]), []).append((i, 1))
+        links = self.network_links.get((source, target))
+        if not links:
+            return None
+        # Like lnd, take the largest of parallel channels
+        i, direction = max(links, key=lambda link: self.network['capacity'][link[0]])
+        channel = self.network[i]
+        return (str(NETWORK_CHAN_BASE + i * 2 ** 16), int(channel['capacity']), int(channel['base_fee_msat'][direction]),
+                int(channel['fee_rate_ppm'][direction]), i, direction)
+
+    # Builds a circular route back to this node, with each hop's fee worked back from the destination
+    def _buildroute(self, amt=None, hops='', outgoing_chan_id=None, final_cltv_delta=40, payment_addr=None, **flags):
+        pubkeys = hops.split(',') if isinstance(hops, str) else list(hops)
+        outgoing = self.channels.get(str(outgoing_chan_id))
+        if not pubkeys or pubkeys[-1] != self.pubkey:
+            raise NodeError("the fake node only builds routes back to itself")
+        if outgoing is None or outgoing['remote_pubkey'] != pubkeys[0]:
+            raise NodeError("outgoing channel does not lead to the first hop")
+        links = [(outgoing['chan_id'], int(outgoing['capacity']), 0, 0)]
+        for source, target in zip(pubkeys, pubkeys[1:]):
+            link = self._route_link(source, target)
+            if link is None:
+                raise NodeError(f"no channel from {source} to {target}")
+            links.append(link[:4])
+        amt_msat = int(amt) * 1000
+        carried = [amt_msat] * len(links)
+        for i in range(len(links) - 2, -1, -1):
+            base_fee, fee_rate = links[i + 1][2:4]
+            carried[i] = carried[i + 1] + base_fee + carried[i + 1] * fee_rate // 1000000
+        route_hops = []
+        for i, (chan_id, capacity, _, _) in enumerate(links):
+            forward = carried[i + 1] if i + 1 < len(links) else amt_msat
+            route_hops.append({'chan_id': chan_id, 'chan_capacity': str(capacity), 'amt_to_forward': str(forward // 1000),
+                               'fee': str((carried[i] - forward) // 1000), 'expiry': 0, 'amt_to_forward_msat': str(forward),
+                               'fee_msat': str(carried[i] - forward), 'pub_key': pubkeys[i]})
+        if payment_addr:
+            route_hops[-1]['mpp_record'] = {'payment_addr': payment_addr, 'total_amt_msat': str(amt_msat)}
+        return {'route': {'total_time_lock': 0, 'total_fees': str((carried[0] - amt_msat) // 1000), 'total_amt': str(carried[0] // 1000),
+                          'hops': route_hops, 'total_fees_msat': str(carried[0] - amt_msat), 'total_amt_msat': str(carried[0])}}
+
+    # Pays a route from buildroute, to an invoice or as keysend. A hop fails for TEMPORARY_CHANNEL_FAILURE
+    # when the sending side of its channel holds too little, reported from that node as in lnd's failure_source_index
+    def _sendtoroute(self, payment_hash=None, routes=None, **flags):
+        route = json.loads(routes) if isinstance(routes, str) else routes
+        route = route.get('route', route)
+        invoice = self.invoices.get(payment_hash)
+        hops = route['hops']
+        attempt = {'attempt_id': str(len(self.payments) + self.calls['sendtoroute']), 'route': route}
+        amt = int(hops[-1]['amt_to_forward_msat']) // 1000
+        preimage = (hops[-1].get('custom_records') or {}).get(KEYSEND_RECORD)
+        if invoice is not None:
+            payment_addr = (hops[-1].get('mpp_record') or {}).get('payment_addr')
+            known = invoice['state'] == 'OPEN' and payment_addr == invoice['payment_addr'] and amt >= int(invoice['value'])
+        else:
+            known = preimage is not None and hashlib.sha256(bytes.fromhex(preimage)).hexdigest() == payment_hash
+        if not known:
+            return dict(attempt, status='FAILED', failure={'code': 'INCORRECT_OR_UNKNOWN_PAYMENT_DETAILS', 'failure_source_index': len(hops)})
+        outgoing = self.channels.get(hops[0]['chan_id'])
+        incoming = self.channels.get(hops[-1]['chan_id'])
+        nodes = [self.pubkey] + [hop['pub_key'] for hop in hops]
+        moves = []
+        for i, hop in enumerate(hops):
+            carried = (int(hop['amt_to_forward_msat']) + int(hop['fee_msat'])) // 1000
+            if i == 0:
+                available = int(outgoing['local_balance']) if outgoing else 0
+            elif i == len(hops) - 1:
+                available = int(incoming['remote_balance']) if incoming else 0
+            else:
+                # Any of the parallel channels between the two nodes, as the route names it
+                self._route_link(nodes[i], nodes[i + 1])
+                links = self.network_links.get((nodes[i], nodes[i + 1]), [])
+                link = next(((index, direction) for index, direction in links if str(NETWORK_CHAN_BASE + index * 2 ** 16) == str(hop['chan_id'])), None)
+                if link is None:
+                    available = 0
+                else:
+                    channel = self.network[link[0]]
+                    available = int(channel['balance1']) if link[1] == 0 else int(channel['capacity'] - channel['balance1'])
+                    moves.append((link[0], carried if link[1] == 0 else -carried))
+            if available < carried:
+                return dict(attempt, status='FAILED', failure={'code': 'TEMPORARY_CHANNEL_FAILURE', 'failure_source_index': i})
+        fee = int(route['total_fees_msat']) // 1000
+        total = int(route['total_amt_msat']) // 1000
+        outgoing['local_balance'] = str(int(outgoing['local_balance']) - total)
+        outgoing['remote_balance'] = str(int(outgoing['remote_balance']) + total)
+        incoming['local_balance'] = str(int(incoming['local_balance']) + amt)
+        incoming['remote_balance'] = str(int(incoming['remote_balance']) - amt)
+        for i, amount in moves:
+            self.network['balance1'][i] -= amount
+        if invoice is not None:
+            invoice['state'] = 'SETTLED'
+        self.payments.append({'outgoing_chan_id': outgoing['chan_id'], 'incoming_chan_id': incoming['chan_id'], 'amount': amt, 'fee': fee})
+        return dict(attempt, status='SUCCEEDED', preimage=preimage or hashlib.sha256(payment_hash.encode()).hexdigest())
+
+# REST path -> function(match, query, body) returning (command, args, flags)
+REST_HANDLERS = [
+    ('GET', r'/v1/getinfo', lambda match, query, body: ('getinfo', (), {})),
+    ('GET', r'/v1/channels', lambda match, query, body: ('listchannels', (), {})),
+    ('GET', r'/v1/fees', lambda match, query, body: ('feereport', (), {})),
+    ('GET', r'/v1/graph', lambda match, query, body: ('describegraph', (), {})),
+    ('GET', r'/v1/graph/edge/(\d+)', lambda match, query, body: ('getchaninfo', (match.group(1),), {})),
+    ('GET', r'/v1/graph/node/(\w+)', lambda match, query, body: ('getnodeinfo', (match.group(1),), {})),
+    ('GET', r'/v1/invoices', lambda match, query, body: ('listinvoices', (), {'pending_only': query.get('pending_only') == ['true']})),
+    ('POST', r'/v1/switch', lambda match, query, body: ('fwdinghistory', (), {
+        'start_time': body.get('start_time', 0), 'end_time': body.get('end_time') or None,
+        'index_offset': body.get('index_offset', 0), 'max_events': body.get('num_max_events', 100)})),
+    ('POST', r'/v1/chanpolicy', lambda match, query, body: ('updatechanpolicy', (), {
+        'base_fee_msat': body.get('base_fee_msat', 0), 'fee_rate': body.get('fee_rate', 0),
+        'time_lock_delta': body.get('time_lock_delta', 40), 'min_htlc_msat': body.get('min_htlc_msat'),
+        'chan_point': None if body.get('global') else f"{body['chan_point']['funding_txid_str']}:{body['chan_point']['output_index']}"})),
+    ('POST', r'/v1/invoices', lambda match, query, body: ('addinvoice', (int(body.get('value', 0)),), {
+        'memo': body.get('memo', ''), 'expiry': int(body.get('expiry') or 86400)})),
+    ('POST', r'/v2/invoices/cancel', lambda match, query, body: ('cancelinvoice', (_hex(body['payment_hash']),), {})),
+    ('POST', r'/v1/channels/transactions', lambda match, query, body: _send_payment_sync(body)),
+    ('POST', r'/v2/router/route', lambda match, query, body: ('buildroute', (), {
+        'amt': int(body['amt_msat']) // 1000, 'outgoing_chan_id': body.get('outgoing_chan_id'),
+        'hops': ','.join(_hex(pubkey) for pubkey in body.get('hop_pubkeys', [])),
+        'final_cltv_delta': body.get('final_cltv_delta', 40),
+        'payment_addr': _hex(body['payment_addr']) if body.get('payment_addr') else None})),
+    ('POST', r'/v2/router/route/send', lambda match, query, body: ('sendtoroute', (), {
+        'payment_hash': _hex(body['payment_hash']), 'routes': _route_bytes(body['route'], _hex)})),
+]
+
+# Reshapes responses to what lnd's REST API returns, with bytes in base64
+REST_RESPONSES = {
+    'addinvoice': lambda response: _invoice_bytes(response),
+    'listinvoices': lambda response: {'invoices': [_invoice_bytes(invoice) for invoice in response['invoices']]},
+    'buildroute': lambda response: {'route': _route_bytes(response['route'], _base64)},
+    # SendPaymentSync reports failures in payment_error rather than a status
+    'payinvoice': lambda response: _payment_error(response),
+    'sendpayment': lambda response: _payment_error(response),
+}
+
+def _hex(value):
+    return base64.b64decode(value).hex()
+
+def _base64(value):
+    return base64.b64encode(bytes.fromhex(value)).decode()
+
+def _invoice_bytes(invoice):
+    return dict(invoice, **{key: _base64(invoice[key]) for key in ('r_hash', 'payment_addr') if invoice.get(key)})
+
+# Function to convert the bytes fields a route's final hop may carry with the given function
+def _route_bytes(route, convert):
+    route = json.loads(json.dumps(route))
+    final_hop = route['hops'][-1]
+    if (final_hop.get('mpp_record') or {}).get('payment_addr'):
+        final_hop['mpp_record']['payment_addr'] = convert(final_hop['mpp_record']['payment_addr'])
+    if final_hop.get('custom_records'):
+        final_hop['custom_records'] = {key: convert(value) for key, value in final_hop['custom_records'].items()}
+    return route
+
+def _payment_error(response):
+    if response['status'] != 'SUCCEEDED':
+        return {'payment_error': response.get('failure_reason', '')}
+    return {'payment_error': '', 'payment_route': response['htlcs'][0]['route']}
+
+# SendPaymentSync pays an invoice, or sends a keysend payment when given a destination instead
+def _send_payment_sync(body):
+    flags = {'fee_limit': body.get('fee_limit', {}).get('fixed'), 'outgoing_chan_id': body.get('outgoing_chan_id'),
+             'last_hop': _hex(body['last_hop_pubkey']) if body.get('last_hop_pubkey') else None,
+             'allow_self_payment': body.get('allow_self_payment', False)}
+    if body.get('payment_request'):
+        return 'payinvoice', (body['payment_request'],), dict(flags, amt=int(body.get('amt') or 0) or None)
+    return 'sendpayment', (), dict(flags, dest=_hex(body['dest']), amt=int(body['amt']), keysend=KEYSEND_RECORD in body.get('dest_custom_records', {}))
+
+def _rest_handler(node):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+        def _handle(self, method):
+            url = urlparse(self.path)
+            length = int(self.headers.get('Content-Length') or 0)
+            body = json.loads(self.rfile.read(length)) if length else {}
+            status, response = 404, {'message': 'not found'}
+            for route_method, pattern, handler in REST_HANDLERS:
+                match = re.fullmatch(pattern, url.path)
+                if route_method == method and match:
+                    command, args, flags = handler(match, parse_qs(url.query), body)
+                    try:
+                        status, response = 200, node.call(command, *args, **flags)
+                    except NodeError as error:
+                        status, response = 500, {'message': str(error)}
+                    if command in REST_RESPONSES and status == 200:
+                        response = REST_RESPONSES[command](response)
+                    break
+            data = json.dumps(response).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            self._handle('GET')
+
+        def do_POST(self):
+            self._handle('POST')
+
+    return Handler
+
+# Function to serve a fake node over HTTP in a background thread; returns the server
+def serve_rest(node, host='127.0.0.1', port=0):
+    server = ThreadingHTTPServer((host, port), _rest_handler(node))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# Function to split lncli style arguments into positional arguments and flags
+def parse_lncli_args(argv):
+    args, flags = [], {}
+    i = 0
+    while i < len(argv):
+        if argv[i].startswith('--'):
+            name = argv[i][2:]
+            if name in BOOLEAN_FLAGS or i + 1 == len(argv) or argv[i + 1].startswith('--'):
+                flags[name] = True
+                i += 1
+            else:
+                flags[name] = argv[i + 1]
+                i += 2
+        else:
+            args.append(argv[i])
+            i += 1
+    return args, flags
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fake LND node for offline testing")
+    parser.add_argument('--channels', type=int, default=10)
+    parser.add_argument('--events', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--serve', type=int, metavar='PORT', help="Serve the REST API on this port")
+    parser.add_argument('command', nargs=argparse.REMAINDER)
+    options = parser.parse_args(argv)
+    node = FakeNode(options.channels, options.events, options.seed)
+
+    if options.serve is not None:
+        server = serve_rest(node, port=options.serve)
+        print(f"Fake lnd REST API listening on port {server.server_address[1]}")
+        threading.Event().wait()
+        return
+
+    if not options.command:
+        parser.error("a command is required")
+    args, flags = parse_lncli_args(options.command[1:])
+    try:
+        print(json.dumps(node.call(options.command[0], *args, **flags), indent=4))
+    except NodeError as error:
+        print(f"[lncli] {error}", file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -4,21 +4,56 @@
 # In[ ]:
 
 
+import argparse
 import json
-import subprocess
+import logging
 from datetime import datetime, timedelta
-import csv
 import os
+import signal
+import threading
+import time
 import numpy as np
-import pandas as pd
+
+from alias_cache import AliasCache
+from data_store import migrate_checkpoint, migrate_csv, open_data_store
+from event_store import ForwardingEvents, ForwardingEventStore
+from instrumentation import InstrumentedClient, Metrics, configure_logging, profiled
+from node_client import NodeError, create_node_client
+from q_store import SparseQTable, encode_states
 
 # Configuration parameters
-DEBUG = True
+DEBUG = True  # Log debug messages; when False they are dropped before being formatted
 PROMPT = True  # Set this to False to disable user prompts for unattended execution
 QTABLE = True  # Set to True to use Q-Learning, False to use rule-based adjustments
+NODE_BACKEND = "lncli"  # "lncli" to run the lncli binary, "rest" to use lnd's REST API over a persistent connection
 LNCLI_PATH = "/usr/local/bin/lncli"  # Adjust this path as necessary
+REST_HOST = "localhost:8080"  # lnd REST API address, used when NODE_BACKEND is "rest"
+MACAROON_PATH = "~/.lnd/data/chain/bitcoin/mainnet/admin.macaroon"  # Used when NODE_BACKEND is "rest"
+TLS_CERT_PATH = "~/.lnd/tls.cert"  # Used when NODE_BACKEND is "rest"
 AGGREGATION_DAYS = 7  # Number of days to aggregate forwarding history
-DATA_FILE = "fee_adjustment_data.csv"  # File to store data for AI training
+DATA_BACKEND = "columnar"  # "columnar" stores the data for AI training as typed columns partitioned by month in DATA_STORE_DIR, "sqlite" in DATA_STORE_FILE with indexes on date and channel, "csv" as text rows in DATA_FILE
+DATA_STORE_DIR = "fee_adjustment_data"  # Data for AI training, when DATA_BACKEND is "columnar"
+DATA_STORE_FILE = "fee_adjustment_data.db"  # Data for AI training, when DATA_BACKEND is "sqlite"
+DATA_FILE = "fee_adjustment_data.csv"  # File to store data for AI training, when DATA_BACKEND is "csv"
+EVENT_STORE_FILE = "forwarding_events.db"  # Local store of forwarding history, fetched incrementally
+FWDINGHISTORY_PAGE_SIZE = 10000  # Maximum number of events to fetch per fwdinghistory call
+BATCH_UPDATES = True  # Read all policies with one feereport call and apply fee updates as a batch
+DRY_RUN = False  # Set to True to print the planned policy changes without applying them
+TIME_LOCK_DELTA = 40  # Example value; adjust as needed
+MIN_HTLC_MSAT = 1000  # Example value; adjust as needed
+FEE_INCREASE = 0.01  # Fee rate increase per adjustment, in sats per 1000 sats (0.01 is 10 ppm)
+FEE_DECREASE = 0.005  # Fee rate decrease per adjustment, in sats per 1000 sats (0.005 is 5 ppm)
+RULE_FLOW_THRESHOLD = 0  # Net forwards (outgoing minus incoming) a channel must go beyond, either way, for a rule based change; at 0 these are the original rules, and a net flow of exactly 0, as on an inactive channel, lowers the fee; above 0, channels within it with some net flow are left alone
+ALIAS_CACHE_FILE = "node_aliases.db"  # Persistent cache of peer aliases, shared with rebalance.py
+ALIAS_CACHE_TTL = 7 * 86400  # Seconds before a cached alias is fetched again
+ALIAS_CACHE_MAX_ENTRIES = 10000  # Least recently used aliases are evicted beyond this
+CHANNEL_COOLDOWN = 1800  # Minimum seconds between fee changes on a channel, so each policy update can propagate through gossip; keep it below DAEMON_INTERVAL, or channels changed on one run skip the next
+FEE_UPDATE_TIMES_FILE = "fee_update_times.json"  # When each channel's fee policy was last changed, for the cooldown
+DAEMON_INTERVAL = 3600  # Seconds between fee adjustment runs in daemon mode
+CHECKPOINT_INTERVAL = 6 * 3600  # Seconds between saving the Q-table and fee update times in daemon mode
+METRICS_FILE = None  # Set to a file name to append per-run node command and stage timings, as JSON lines
+PROMETHEUS_FILE = None  # Set to a file name to write the timings in Prometheus text format, e.g. for node_exporter's textfile collector
+PROFILE_DIR = None  # Set to a folder to save a cProfile profile of every run
 
 # Q-Learning parameters
 alpha = 0.1  # Learning rate
@@ -27,99 +62,186 @@ epsilon = 0.1  # Exploration-exploitation trade-off parameter
 num_states = 101  # Number of possible states (0% to 100% in increments of 1%)
 num_actions = 2  # Number of possible actions (increase or decrease fee)
 Q = np.zeros((num_states, num_actions))  # Initialize Q-table
-
-# Function to run shell commands with confirmation
-def run_command(command):
-    result = subprocess.run(command, shell=True, capture_output=True, text=True, executable='/bin/bash')
-    return result.stdout.strip(), result.stderr.strip()
-
-def run_command_with_confirmation(command):
-    if DEBUG:
-        print(f"Prepared command: {command}")
+Q_TABLE_FILE = "q_table.npy"  # File to save the Q-table between runs
+Q_CHECKPOINT_FILE = "q_table_checkpoint.json"  # Rows of the training data already applied to the saved Q-table
+REPLAY_EPOCHS = 0  # Set above 0 to also run experience replay over the whole data file for this many epochs
+REPLAY_BATCH_SIZE = 4096  # Rows per vectorized experience replay update
+TRAINING_CHECKPOINT = None  # Checkpoint to save with the Q-table after training
+Q_STORE = False  # Set to True for a per-channel Q-table over fee rate, liquidity and flow direction; False for the global table indexed by fee rate
+Q_STORE_DIR = "q_store"  # Directory to save the per-channel Q-table between runs
+Q_STORE_TABLE = None  # Per-channel Q-table, loaded by load_q_store
+
+NODE = None  # Node client, created on first use
+NODE_PUBKEY = None  # Our node's public key, fetched once per run
+EVENT_STORE = None  # Forwarding event store, opened on first use
+DATA_STORE = None  # Training data store, opened on first use
+FEE_UPDATE_TIMES = {}  # Last fee policy change per channel, loaded by load_fee_update_times
+CLOCK = None  # Function returning the current Unix time, or None for the system clock; simulator.py sets its simulated clock
+METRICS = None  # Node command and stage timings, created on first use
+
+logger = logging.getLogger("fee_setting_agent")
+
+# Function to get the current Unix time
+def current_time():
+    return int(CLOCK() if CLOCK else datetime.now().timestamp())
+
+# Function to get the timings of node commands and run stages
+def get_metrics():
+    global METRICS
+    if METRICS is None:
+        METRICS = Metrics("fee_setting_agent", METRICS_FILE, PROMETHEUS_FILE)
+    return METRICS
+
+# Function to time a stage of the run: fetch, aggregate, decide, apply or persist
+def stage(name):
+    return get_metrics().stage(name)
+
+# Function to get the node client for the configured backend, timing every command
+def get_node_client():
+    global NODE
+    if NODE is None:
+        NODE = InstrumentedClient(create_node_client(NODE_BACKEND, LNCLI_PATH, REST_HOST, MACAROON_PATH, TLS_CERT_PATH), get_metrics())
+    return NODE
+
+# Function to run node commands, with confirmation
+def run_command(command, *args, **flags):
+    try:
+        return get_node_client().call(command, *args, **flags), None
+    except NodeError as error:
+        return None, str(error)
+
+def run_command_with_confirmation(command, *args, **flags):
+    logger.debug("Prepared command: %s", get_node_client().format_command(command, *args, **flags))
     if PROMPT:
         user_input = input("Do you want to execute this command? (yes/no): ")
         if user_input.lower() != 'yes':
             print("Skipping command execution.")
             return None
-    result, error = run_command(command)
+    result, error = run_command(command, *args, **flags)
     if error:
         print(f"Error executing command: {error}")
     return result
 
 # Function to get node's public key
 def get_node_pubkey():
-    command = f"{LNCLI_PATH} getinfo"
-    result, error = run_command(command)
+    global NODE_PUBKEY
+    if NODE_PUBKEY is None:
+        result, error = run_command('getinfo')
+        if error:
+            raise Exception(f"Error getting node public key: {error}")
+        NODE_PUBKEY = result['identity_pubkey']
+    return NODE_PUBKEY
+
+# Function to fetch forwarding events newer than the last stored offset, one page at a time
+def sync_forwarding_history(store, days=None):
+    days = AGGREGATION_DAYS if days is None else days
+    end_time = current_time()
+    start_time = store.start_time(end_time - (days * 86400))
+    offset = store.last_offset()
+    while True:
+        page, error = run_command('fwdinghistory', start_time=start_time, end_time=end_time, index_offset=offset, max_events=FWDINGHISTORY_PAGE_SIZE)
+        if error:
+            raise Exception(f"Error getting forwarding history: {error}")
+        forwarding_events = page['forwarding_events']
+        if not forwarding_events:
+            break
+        store.add_events(forwarding_events, offset, int(page['last_offset_index']))
+        logger.debug("Stored %d forwarding events from offset %d", len(forwarding_events), offset)
+        offset = int(page['last_offset_index'])
+        if len(forwarding_events) < FWDINGHISTORY_PAGE_SIZE:
+            break
+
+# Function to get the forwarding event store, kept open between runs in daemon mode
+def get_event_store():
+    global EVENT_STORE
+    if EVENT_STORE is None:
+        EVENT_STORE = ForwardingEventStore(EVENT_STORE_FILE)
+    return EVENT_STORE
+
+def close_event_store():
+    global EVENT_STORE
+    if EVENT_STORE is not None:
+        EVENT_STORE.close()
+        EVENT_STORE = None
+
+# Function to get forwarding history for the last specified number of days, as ForwardingEvents
+def get_forwarding_history(days=None):
+    days = AGGREGATION_DAYS if days is None else days
+    store = get_event_store()
+    sync_forwarding_history(store, days)
+    end_time = current_time()
+    return store.get_forwarding_events(end_time - (days * 86400), end_time)
+
+# Function to fetch a peer's alias with getnodeinfo, on an alias cache miss; None if it fails
+def fetch_alias(pubkey):
+    result, error = run_command('getnodeinfo', pubkey)
     if error:
-        raise Exception(f"Error getting node public key: {error}")
-    return json.loads(result)['identity_pubkey']
-
-# Function to get forwarding history for the last specified number of days
-def get_forwarding_history(days=AGGREGATION_DAYS):
-    end_time = int(datetime.now().timestamp())
-    start_time = end_time - (days * 86400)
-    command = f"{LNCLI_PATH} fwdinghistory --start_time {start_time} --end_time {end_time}"
-    result, error = run_command(command)
-    if error:
-        raise Exception(f"Error getting forwarding history: {error}")
-    return json.loads(result)['forwarding_events']
+        return None
+    return result['node'].get('alias', '')
 
 # Function to get all channels and their aliases
 def get_all_channels():
-    command = f"{LNCLI_PATH} listchannels"
-    result, error = run_command(command)
+    result, error = run_command('listchannels')
     if error:
         raise Exception(f"Error getting channel list: {error}")
-    channels = json.loads(result)['channels']
-    return {channel['chan_id']: (channel['remote_pubkey'], channel.get('peer_alias', 'Unknown'), float(channel.get('fee_rate_milli_msat', 0))/1000) for channel in channels}
-
-# Function to adjust fees based on forwarding history
-def rule_based_adjustments(forwarding_events, channel_aliases):
-    channel_adjustments = {chan_id: {'alias': alias, 'increase': 0, 'reason': ''} for chan_id, (pubkey, alias, fee_rate) in channel_aliases.items()}
-    
-    # Aggregate transactions for each channel
-    for event in forwarding_events:
-        chan_id_in = event['chan_id_in']
-        chan_id_out = event['chan_id_out']
-
-        if chan_id_in in channel_adjustments:
-            channel_adjustments[chan_id_in]['increase'] -= 1
-        if chan_id_out in channel_adjustments:
-            channel_adjustments[chan_id_out]['increase'] += 1
+    channels = result['channels']
+
+    # Older lnd versions do not include peer_alias, so fall back to the alias cache
+    missing = [channel['remote_pubkey'] for channel in channels if not channel.get('peer_alias')]
+    aliases = {}
+    if missing:
+        with AliasCache(ALIAS_CACHE_FILE, ALIAS_CACHE_TTL, ALIAS_CACHE_MAX_ENTRIES) as cache:
+            aliases = cache.get_many(missing, fetch_alias)
+    return {channel['chan_id']: (channel['remote_pubkey'], channel.get('peer_alias') or aliases.get(channel['remote_pubkey']) or 'Unknown', float(channel.get('fee_rate_milli_msat', 0))/1000,
+                                 int(channel.get('local_balance', 0)) / max(int(channel.get('capacity', 0)), 1)) for channel in channels}
+
+# Function to aggregate forwarding events per channel in a single pass, from ForwardingEvents
+# or a list of events in fwdinghistory form
+def aggregate_forwarding_events(forwarding_events):
+    if not isinstance(forwarding_events, ForwardingEvents):
+        forwarding_events = ForwardingEvents.from_dicts(forwarding_events)
+    return forwarding_events.channel_stats()
+
+# Function to adjust fees based on the aggregated forwarding history
+def rule_based_adjustments(channel_stats, channel_aliases):
+    channel_adjustments = {chan_id: {'alias': alias, 'increase': 0, 'reason': ''} for chan_id, (pubkey, alias, fee_rate, local_ratio) in channel_aliases.items()}
+
+    # Net direction of transactions for each channel
+    for chan_id, adjustment in channel_adjustments.items():
+        stats = channel_stats.get(chan_id)
+        if stats:
+            adjustment['increase'] = stats['count_out'] - stats['count_in']
 
     actions = []
 
     for chan_id, adjustment in channel_adjustments.items():
-        if adjustment['increase'] > 0:
+        if adjustment['increase'] > RULE_FLOW_THRESHOLD:
             adjustment['reason'] = 'More outgoing transactions'
-            actions.append((chan_id, adjustment['alias'], True, adjustment['reason'], 0.01))
-        elif adjustment['increase'] < 0:
+            actions.append((chan_id, adjustment['alias'], True, adjustment['reason'], FEE_INCREASE))
+        elif adjustment['increase'] < -RULE_FLOW_THRESHOLD:
             adjustment['reason'] = 'More incoming transactions'
-            actions.append((chan_id, adjustment['alias'], False, adjustment['reason'], 0.005))
-        else:
+            actions.append((chan_id, adjustment['alias'], False, adjustment['reason'], FEE_DECREASE))
+        elif adjustment['increase'] == 0:
             adjustment['reason'] = 'Inactive channel'
-            if DEBUG:
-                print(f"Channel {chan_id} ({adjustment['alias']}) has no activity. Considering for fee reduction.")
-            actions.append((chan_id, adjustment['alias'], False, adjustment['reason'], 0.005))
+            logger.debug("Channel %s (%s) has no activity. Considering for fee reduction.", chan_id, adjustment['alias'])
+            actions.append((chan_id, adjustment['alias'], False, adjustment['reason'], FEE_DECREASE))
 
     return actions
 
 # Function to adjust fees
 def adjust_fee(chan_id, alias, increase=True, reason='', adjustment_amount=0.01):
-    time_lock_delta = 40  # Example value; adjust as needed
-    min_htlc_msat = 1000  # Example value; adjust as needed
+    time_lock_delta = TIME_LOCK_DELTA
+    min_htlc_msat = MIN_HTLC_MSAT
 
     my_node_pubkey = get_node_pubkey()
 
-    channel_info_command = f"{LNCLI_PATH} getchaninfo {chan_id}"
-    channel_info_result = run_command_with_confirmation(channel_info_command)
-    if channel_info_result is None:
+    channel_info = run_command_with_confirmation('getchaninfo', chan_id)
+    if channel_info is None:
         print(f"Skipping fee adjustment for {alias} due to user input.")
         return
 
-    channel_info = json.loads(channel_info_result)
-    if DEBUG:
-        print(f"Channel Info for {alias}: {json.dumps(channel_info, indent=2)}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Channel Info for %s: %s", alias, json.dumps(channel_info, indent=2))
 
     if channel_info['node1_pub'] == my_node_pubkey:
         current_policy = channel_info['node1_policy']
@@ -130,35 +252,26 @@ def adjust_fee(chan_id, alias, increase=True, reason='', adjustment_amount=0.01)
         return
 
     current_fee_rate = float(current_policy.get('fee_rate_milli_msat', 0)) / 1000
+    new_fee_rate = compute_new_fee_rate(current_fee_rate, increase, adjustment_amount)
 
-    if increase:
-        new_fee_rate = current_fee_rate + adjustment_amount
-        if DEBUG:
-            print(f"Increasing fee rate for channel {chan_id} ({alias}). Current fee rate: {current_fee_rate}, New fee rate: {new_fee_rate}, Reason: {reason}")
-    else:
-        new_fee_rate = max(0, current_fee_rate - adjustment_amount)
-        if DEBUG:
-            print(f"Decreasing fee rate for channel {chan_id} ({alias}). Current fee rate: {current_fee_rate}, New fee rate: {new_fee_rate}, Reason: {reason}")
+    logger.debug("%s fee rate for channel %s (%s). Current fee rate: %s, New fee rate: %s, Reason: %s",
+                 "Increasing" if increase else "Decreasing", chan_id, alias, current_fee_rate, new_fee_rate, reason)
 
-    new_fee_rate = round(new_fee_rate, 6)
     new_fee_rate_milli_msat = round(new_fee_rate / 1000, 6)  # Ensure correct conversion to milli msats
 
-    if DEBUG:
-        print(f"Current fee rate for channel {chan_id} ({alias}): {current_fee_rate}")
-        print(f"New fee rate for channel {chan_id} ({alias}): {new_fee_rate}")
+    logger.debug("Current fee rate for channel %s (%s): %s", chan_id, alias, current_fee_rate)
+    logger.debug("New fee rate for channel %s (%s): %s", chan_id, alias, new_fee_rate)
 
-    command = f"{LNCLI_PATH} updatechanpolicy --base_fee_msat 0 --fee_rate {new_fee_rate_milli_msat} --time_lock_delta {time_lock_delta} --min_htlc_msat {min_htlc_msat} --chan_point {channel_info['chan_point']}"
+    policy_flags = dict(base_fee_msat=0, fee_rate=new_fee_rate_milli_msat, time_lock_delta=time_lock_delta, min_htlc_msat=min_htlc_msat, chan_point=channel_info['chan_point'])
 
-    if DEBUG:
-        print(f"Prepared command for {alias}: {command}")
+    logger.debug("Prepared command for %s: %s", alias, get_node_client().format_command('updatechanpolicy', **policy_flags))
     if PROMPT:
         user_input = input("Do you want to execute this command? (yes/no): ")
         if user_input.lower() != 'yes':
             print(f"Skipping command execution for {alias}.")
             return
-    result = run_command_with_confirmation(command)
-    if result:
-        result_json = json.loads(result)
+    result_json = run_command_with_confirmation('updatechanpolicy', **policy_flags)
+    if result_json:
         if 'failed_updates' in result_json and result_json['failed_updates']:
             print(f"Failed updates for {alias}: {result_json['failed_updates']}")
         else:
@@ -166,179 +279,524 @@ def adjust_fee(chan_id, alias, increase=True, reason='', adjustment_amount=0.01)
 
     return current_fee_rate, new_fee_rate
 
-# Function to calculate rewards using the provided forwarding events
-def reward_function_per_channel(chan_id, forwarding_events):
-    total_fees = sum(int(event['fee_msat']) for event in forwarding_events if event['chan_id_out'] == chan_id)
-    total_volume = sum(int(event['amt_in_msat']) for event in forwarding_events if event['chan_id_in'] == chan_id) + \
-                   sum(int(event['amt_out_msat']) for event in forwarding_events if event['chan_id_out'] == chan_id)
+# Function to calculate the new fee rate for an adjustment
+def compute_new_fee_rate(current_fee_rate, increase, adjustment_amount):
+    if increase:
+        new_fee_rate = current_fee_rate + adjustment_amount
+    else:
+        new_fee_rate = max(0, current_fee_rate - adjustment_amount)
+    return round(new_fee_rate, 6)
+
+# Function to read our own policy for every channel with a single feereport call
+def get_own_policies():
+    result, error = run_command('feereport')
+    if error:
+        raise Exception(f"Error getting fee report: {error}")
+    return {fees['chan_id']: {'channel_point': fees['channel_point'], 'fee_rate': float(fees.get('fee_per_mil', 0)) / 1000}
+            for fees in result['channel_fees']}
+
+# Function to print the planned policy changes as a diff of old vs. new fee rates
+def print_policy_diff(plan):
+    print("Planned fee policy changes:")
+    for chan_id, alias, current_fee_rate, new_fee_rate, reason in plan:
+        marker = ' ' if new_fee_rate == current_fee_rate else ('+' if new_fee_rate > current_fee_rate else '-')
+        print(f"{marker} {chan_id} ({alias}): {current_fee_rate} -> {new_fee_rate}  [{reason}]")
+
+# Function to apply fee adjustments for all channels as a batch
+def adjust_fees_batch(actions, policies=None):
+    if policies is None:
+        policies = get_own_policies()
+    plan = []
+    for chan_id, alias, increase, reason, adjustment_amount in actions:
+        if chan_id not in policies:
+            print(f"Error: No policy found for channel {chan_id} ({alias}), skipping.")
+            continue
+        current_fee_rate = policies[chan_id]['fee_rate']
+        plan.append((chan_id, alias, current_fee_rate, compute_new_fee_rate(current_fee_rate, increase, adjustment_amount), reason))
+
+    print_policy_diff(plan)
+    results = {chan_id: (current_fee_rate, new_fee_rate) for chan_id, alias, current_fee_rate, new_fee_rate, reason in plan}
+    if DRY_RUN:
+        print("Dry run, no fee policies were changed.")
+        return results
+
+    # Group channels by target policy; unchanged channels need no update
+    groups = {}
+    for chan_id, alias, current_fee_rate, new_fee_rate, reason in plan:
+        if new_fee_rate != current_fee_rate:
+            groups.setdefault(new_fee_rate, []).append((chan_id, alias))
+    if not groups:
+        print("No fee policy changes needed.")
+        return results
 
-    if DEBUG:
-        print(f"Calculating rewards for channel {chan_id}:")
-        print(f"  Total fees: {total_fees}")
-        print(f"  Total volume: {total_volume}")
+    if PROMPT:
+        user_input = input(f"Do you want to apply {sum(len(group) for group in groups.values())} fee policy changes? (yes/no): ")
+        if user_input.lower() != 'yes':
+            print("Skipping fee policy changes.")
+            return {chan_id: (current_fee_rate, current_fee_rate) for chan_id, (current_fee_rate, new_fee_rate) in results.items()}
+
+    for new_fee_rate, group in groups.items():
+        policy_flags = dict(base_fee_msat=0, fee_rate=round(new_fee_rate / 1000, 6), time_lock_delta=TIME_LOCK_DELTA, min_htlc_msat=MIN_HTLC_MSAT)
+        # updatechanpolicy takes one channel point, or none for every channel at once
+        if len(group) == len(policies):
+            targets = [(None, 'all channels', group)]
+        else:
+            targets = [(policies[chan_id]['channel_point'], alias, [(chan_id, alias)]) for chan_id, alias in group]
+        for chan_point, alias, members in targets:
+            logger.debug("Prepared command for %s: %s", alias, get_node_client().format_command('updatechanpolicy', chan_point=chan_point, **policy_flags))
+            result, error = run_command('updatechanpolicy', chan_point=chan_point, **policy_flags)
+            failed = error or result.get('failed_updates')
+            if failed:
+                print(f"Failed updates for {alias}: {failed}")
+                for chan_id, member_alias in members:
+                    results[chan_id] = (results[chan_id][0], results[chan_id][0])
+            else:
+                print(f"Fee adjustment for {alias} executed successfully.")
+
+    return results
+
+# Function to apply fee adjustments, returning the fee rate before and after for each channel
+def apply_fee_adjustments(actions, policies=None):
+    if BATCH_UPDATES:
+        return adjust_fees_batch(actions, policies)
+    results = {}
+    for chan_id, alias, increase, reason, adjustment_amount in actions:
+        result = adjust_fee(chan_id, alias, increase, reason, adjustment_amount)
+        if result:
+            results[chan_id] = result
+    return results
+
+# Function to drop the actions for channels whose fee policy changed within the last CHANNEL_COOLDOWN seconds
+def apply_cooldowns(actions):
+    now = current_time()
+    ready = [action for action in actions if now - FEE_UPDATE_TIMES.get(action[0], 0) >= CHANNEL_COOLDOWN]
+    if len(ready) < len(actions):
+        logger.debug("Skipping %d channels whose fees changed in the last %d seconds.", len(actions) - len(ready), CHANNEL_COOLDOWN)
+    return ready
+
+# Function to record when each channel's fee policy was changed
+def record_fee_updates(fee_rates):
+    if DRY_RUN:
+        return
+    now = current_time()
+    for chan_id, (current_fee_rate, new_fee_rate) in fee_rates.items():
+        if new_fee_rate != current_fee_rate:
+            FEE_UPDATE_TIMES[chan_id] = now
+
+def load_fee_update_times():
+    global FEE_UPDATE_TIMES
+    FEE_UPDATE_TIMES = {}
+    if os.path.isfile(FEE_UPDATE_TIMES_FILE):
+        with open(FEE_UPDATE_TIMES_FILE) as file:
+            FEE_UPDATE_TIMES = json.load(file)
+
+def save_fee_update_times():
+    with open(FEE_UPDATE_TIMES_FILE, mode='w') as file:
+        json.dump(FEE_UPDATE_TIMES, file)
+
+# Function to calculate rewards using the aggregated forwarding events
+def reward_function_per_channel(chan_id, channel_stats):
+    stats = channel_stats.get(chan_id, {})
+    total_fees = stats.get('fees', 0)
+    total_volume = stats.get('amt_in', 0) + stats.get('amt_out', 0)
 
     reward = total_fees + (total_volume / 10000)  # Normalizing volume with a factor of 10000
-    print(f"  Calculated reward: {reward}")
+    logger.debug("Calculating rewards for channel %s:\n  Total fees: %s\n  Total volume: %s\n  Calculated reward: %s",
+                 chan_id, total_fees, total_volume, reward)
     return reward
 
+# Function to get the path of the training data for the configured backend
+def get_data_store_path():
+    return {"csv": DATA_FILE, "sqlite": DATA_STORE_FILE}.get(DATA_BACKEND, DATA_STORE_DIR)
+
+# Function to get the training data store for the configured backend. The first time a
+# columnar or SQLite store is opened next to an existing DATA_FILE, the CSV history and the
+# Q-table checkpoint are migrated to it, so training carries on from the same rows.
+def get_data_store():
+    global DATA_STORE
+    if DATA_STORE is None:
+        store = open_data_store(DATA_BACKEND, get_data_store_path())
+        if DATA_BACKEND != "csv" and store.position() == 0 and os.path.isfile(DATA_FILE):
+            migrate_data_file(store)
+        DATA_STORE = store
+    return DATA_STORE
+
+def migrate_data_file(store):
+    try:
+        copied, first_position = migrate_csv(DATA_FILE, store)
+    except ImportError:
+        store.close()
+        raise Exception(f"Error migrating {DATA_FILE} to the {DATA_BACKEND} data store: pandas is needed to read it; install pandas or set DATA_BACKEND to \"csv\"")
+    print(f"Migrated {copied} rows from {DATA_FILE} to the {DATA_BACKEND} data store in {get_data_store_path()}.")
+    if os.path.isfile(Q_CHECKPOINT_FILE):
+        migrate_checkpoint(Q_CHECKPOINT_FILE, first_position, DATA_BACKEND)
+
+def close_data_store():
+    global DATA_STORE
+    if DATA_STORE is not None:
+        DATA_STORE.close()
+        DATA_STORE = None
+
 # Function to collect and save data
 def collect_data(state, actions, rewards, next_state):
-    file_exists = os.path.isfile(DATA_FILE)
-    with open(DATA_FILE, mode='a', newline='') as file:
-        writer = csv.writer(file)
-        if not file_exists:
-            writer.writerow(['Date', 'State', 'Channel ID', 'Alias', 'Increase', 'Reason', 'Adjustment Amount', 'Reward', 'Next State'])
-        date_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        for action in actions:
-            chan_id, alias, increase, reason, adjustment_amount = action
-            reward = rewards[chan_id]
-            writer.writerow([date_str, state[chan_id], chan_id, alias, increase, reason, adjustment_amount, reward, next_state[chan_id]])
-
-def train_from_csv():
-    with open(DATA_FILE, mode='r') as file:
-        reader = csv.DictReader(file)
-        for row in reader:
-            try:
-                # Ensure states are correctly normalized to [0, 1] range before converting to integer indices
-                state = min(int(float(row['State']) * 100), Q.shape[0] - 1)
-                next_state = min(int(float(row['Next State']) * 100), Q.shape[0] - 1)
-                action = int(row['Increase'] == 'True')  # Converting action to 0 or 1
-                reward = float(row['Reward']) / 1000000  # Normalizing reward for stability
-
-                # Update the Q-table if indices are within valid range
-                old_value = Q[state, action]
-                next_max = np.max(Q[next_state])
-                new_value = (1 - alpha) * old_value + alpha * (reward + gamma * next_max)
-                Q[state, action] = new_value
-
-                if DEBUG:
-                    print(f"Training with data: State: {state}, Action: {action}, Reward: {reward}, Next State: {next_state}")
-                    print(f"Old Q-value: {old_value}, New Q-value: {new_value}")
-            except ValueError as e:
-                if DEBUG:
-                    print(f"ValueError: {e}, skipping this row.")
-
-# Function to select actions based on Q-table
-def select_actions_based_on_q_table(channel_aliases):
+    timestamp = current_time()
+    get_data_store().append([(timestamp, state[chan_id], chan_id, alias, increase, reason, adjustment_amount, rewards[chan_id], next_state[chan_id])
+                             for chan_id, alias, increase, reason, adjustment_amount in actions])
+
+# Function to load training rows from the data store in bulk, starting after a store position.
+# Returns the state, action, reward and next state arrays, the number of rows read
+# and the store position just past them.
+def load_training_data(offset=0):
+    data, rows, position = get_data_store().read(after=offset, columns=['state', 'increase', 'reward', 'next_state'])
+
+    # Rows that do not parse are skipped, as before
+    state, next_state, reward = data['state'], data['next_state'], data['reward']
+    valid = ~(np.isnan(state) | np.isnan(next_state) | np.isnan(reward))
+    if not valid.all():
+        logger.debug("Skipping %d rows that could not be parsed.", int((~valid).sum()))
+
+    # Ensure states are correctly normalized to [0, 1] range before converting to integer indices
+    states = np.minimum((state[valid] * 100).astype(np.int64), Q.shape[0] - 1)
+    next_states = np.minimum((next_state[valid] * 100).astype(np.int64), Q.shape[0] - 1)
+    actions = data['increase'][valid].astype(np.int64)  # Converting action to 0 or 1
+    rewards = reward[valid] / 1000000  # Normalizing reward for stability
+    return states, actions, rewards, next_states, rows, position
+
+# Function to apply Q-learning updates row by row, in file order
+def apply_q_updates(states, actions, rewards, next_states):
+    # Plain Python floats keep each update exactly as before, without per-element NumPy overhead
+    q = Q.tolist()
+    for state, action, reward, next_state in zip(states.tolist(), actions.tolist(), rewards.tolist(), next_states.tolist()):
+        q[state][action] = (1 - alpha) * q[state][action] + alpha * (reward + gamma * max(q[next_state]))
+    Q[:] = q
+
+# Function to run experience replay: several epochs of shuffled minibatches, each applied as one
+# vectorized update that averages the temporal difference errors per state and action
+def replay_q_updates(states, actions, rewards, next_states, epochs=None, batch_size=None, seed=None):
+    epochs = REPLAY_EPOCHS if epochs is None else epochs
+    batch_size = REPLAY_BATCH_SIZE if batch_size is None else batch_size
+    rng = np.random.default_rng(seed)
+    for epoch in range(epochs):
+        order = rng.permutation(len(states))
+        for start in range(0, len(order), batch_size):
+            batch = order[start:start + batch_size]
+            batch_states, batch_actions = states[batch], actions[batch]
+            errors = rewards[batch] + gamma * Q[next_states[batch]].max(axis=1) - Q[batch_states, batch_actions]
+            totals = np.zeros_like(Q)
+            counts = np.zeros_like(Q)
+            np.add.at(totals, (batch_states, batch_actions), errors)
+            np.add.at(counts, (batch_states, batch_actions), 1)
+            Q[:] += alpha * totals / np.maximum(counts, 1)
+
+# Function to read the training checkpoint: rows of the training data already applied to the saved Q-table
+def load_training_checkpoint():
+    if os.path.isfile(Q_TABLE_FILE) and os.path.isfile(Q_CHECKPOINT_FILE):
+        with open(Q_CHECKPOINT_FILE) as file:
+            return json.load(file)
+    return {'rows_applied': 0, 'offset': 0, 'backend': DATA_BACKEND}
+
+def save_training_checkpoint(checkpoint):
+    with open(Q_CHECKPOINT_FILE, mode='w') as file:
+        json.dump(checkpoint, file)
+
+# Function to train the Q-table on rows added to the training data since the last checkpoint
+def train_from_data():
+    global TRAINING_CHECKPOINT
+    store = get_data_store()
+    # In daemon mode the checkpoint of the Q-table in memory is ahead of the saved one
+    checkpoint = TRAINING_CHECKPOINT or load_training_checkpoint()
+    if checkpoint.get('backend', 'csv') != DATA_BACKEND:
+        # Keep a checkpoint from before a switch of backend until the data has been migrated
+        if store.position() == 0:
+            return
+        print(f"The Q-table checkpoint is for the {checkpoint.get('backend', 'csv')} data store, training on the {DATA_BACKEND} data store from the start.")
+        checkpoint = {'rows_applied': 0, 'offset': 0}
+    elif checkpoint['offset'] > store.position():
+        print("The training data is smaller than at the last checkpoint, training on it from the start.")
+        checkpoint = {'rows_applied': 0, 'offset': 0}
+
+    states, actions, rewards, next_states, rows, offset = load_training_data(checkpoint['offset'])
+    apply_q_updates(states, actions, rewards, next_states)
+    TRAINING_CHECKPOINT = {'rows_applied': checkpoint['rows_applied'] + rows, 'offset': offset, 'backend': DATA_BACKEND}
+    logger.debug("Trained on %d new rows, %d in total.", rows, TRAINING_CHECKPOINT['rows_applied'])
+
+    if REPLAY_EPOCHS:
+        states, actions, rewards, next_states, rows, offset = load_training_data()
+        replay_q_updates(states, actions, rewards, next_states)
+        logger.debug("Replayed %d rows for %d epochs.", rows, REPLAY_EPOCHS)
+
+# Function to select actions for all channels at once based on Q-values; by default the
+# global Q-table indexed by fee rate
+def select_actions_based_on_q_table(channel_aliases, q_values=None):
+    chan_ids = list(channel_aliases)
+    per_channel = q_values is not None
+    if q_values is None:
+        fee_rates = np.array([float(channel_aliases[chan_id][2]) for chan_id in chan_ids])
+        states = np.minimum((fee_rates * 100).astype(np.int64), Q.shape[0] - 1)
+        q_values = Q[states].reshape(len(chan_ids), num_actions)
+
+    explore = np.random.rand(len(chan_ids)) < epsilon
+    if per_channel:
+        # Most per-channel states have not been visited, with all action values 0, and every reward is
+        # positive; argmax would always take action 0 there, and then keep it once it has a value, so
+        # lowering fees whatever they earn. Ties are broken at random instead.
+        ties = q_values == q_values.max(axis=1, keepdims=True)
+        greedy = np.argmax(ties * np.random.rand(len(chan_ids), num_actions), axis=1)
+    else:
+        greedy = np.argmax(q_values, axis=1)
+    chosen = np.where(explore, np.random.randint(0, num_actions, len(chan_ids)), greedy)
+
     actions = []
-    for chan_id, (pubkey, alias, fee_rate) in channel_aliases.items():
-        state = min(int(float(fee_rate) * 100), Q.shape[0] - 1)
-        if np.random.rand() < epsilon:
-            action = np.random.randint(0, num_actions)
-            reason = "Random decision"
-        else:
-            action = np.argmax(Q[state])
-            reason = "Q-Learning decision"
+    debug = logger.isEnabledFor(logging.DEBUG)
+    for chan_id, action, random_decision in zip(chan_ids, chosen.tolist(), explore.tolist()):
+        alias = channel_aliases[chan_id][1]
+        reason = "Random decision" if random_decision else "Q-Learning decision"
         increase = action == 1
-        adjustment_amount = 0.01 if increase else 0.005
-        if DEBUG:
-            print(f"Channel ID: {chan_id}, Alias: {alias}, State: {state}, Action: {action}, Increase: {increase}, Reason: {reason}, Adjustment Amount: {adjustment_amount}")
+        adjustment_amount = FEE_INCREASE if increase else FEE_DECREASE
+        if debug:
+            logger.debug("Channel ID: %s, Alias: %s, Action: %s, Increase: %s, Reason: %s, Adjustment Amount: %s", chan_id, alias, action, increase, reason, adjustment_amount)
         actions.append((chan_id, alias, increase, reason, adjustment_amount))
     return actions
 
+# Function to compute the per-channel Q-table state of every channel
+def get_channel_states(channel_aliases, channel_stats, policies):
+    chan_ids = list(channel_aliases)
+    fee_ppm = [policies[chan_id]['fee_rate'] * 1000 if chan_id in policies else channel_aliases[chan_id][2] * 1000 for chan_id in chan_ids]
+    local_ratio = [channel_aliases[chan_id][3] for chan_id in chan_ids]
+    net_flow = [channel_stats.get(chan_id, {}).get('amt_out', 0) - channel_stats.get(chan_id, {}).get('amt_in', 0) for chan_id in chan_ids]
+    return encode_states(fee_ppm, local_ratio, net_flow)
+
+# Function to learn from the actions taken on the last run, now that their rewards and next states are known.
+# An action's reward counts the forwards since it was taken, not the whole aggregation window, most of
+# which came before it; actions saved without their time are rewarded over the window.
+def update_q_store(chan_ids, states, rewards, forwarding_events):
+    current = dict(zip(chan_ids, states.tolist()))
+    learned = [chan_id for chan_id in Q_STORE_TABLE.pending if chan_id in current]
+    if learned:
+        rewards = dict(rewards)
+        taken = {}
+        for chan_id in learned:
+            if len(Q_STORE_TABLE.pending[chan_id]) > 2:
+                taken.setdefault(Q_STORE_TABLE.pending[chan_id][2], []).append(chan_id)
+        for taken_at, taken_chan_ids in taken.items():
+            stats = aggregate_forwarding_events(forwarding_events.window(taken_at))
+            rewards.update({chan_id: reward_function_per_channel(chan_id, stats) for chan_id in taken_chan_ids})
+        previous_keys = Q_STORE_TABLE.make_keys(learned, [Q_STORE_TABLE.pending[chan_id][0] for chan_id in learned])
+        previous_actions = [Q_STORE_TABLE.pending[chan_id][1] for chan_id in learned]
+        next_values = Q_STORE_TABLE.lookup(Q_STORE_TABLE.make_keys(learned, [current[chan_id] for chan_id in learned]))
+        targets = np.array([rewards[chan_id] for chan_id in learned]) / 1000000 + gamma * next_values.max(axis=1)  # Normalizing reward for stability
+        Q_STORE_TABLE.update(previous_keys, previous_actions, targets, alpha)
+    logger.debug("Per-channel Q-table updated for %d channels, %d states stored.", len(learned), len(Q_STORE_TABLE))
+
+# Function to log the channels found, before any adjustments
+def log_channels(title, channel_aliases):
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(title)
+        for chan_id, (pubkey, alias, fee_rate, local_ratio) in channel_aliases.items():
+            logger.debug("Channel ID: %s, Alias: %s", chan_id, alias)
+
+# Function to log the adjustments made and their rewards
+def log_adjustments(title, actions, state, next_state, rewards):
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("State: %s", state)
+        logger.debug("Next State: %s", next_state)
+        logger.debug("Rewards: %s", rewards)
+        logger.debug(title)
+        date_str = datetime.fromtimestamp(current_time()).strftime("%Y-%m-%d %H:%M:%S")
+        for chan_id, alias, increase, reason, adjustment_amount in actions:
+            logger.debug("Date: %s, Channel: %s (%s), Increase: %s, Reason: %s, Adjustment Amount: %s, Reward: %s, New Fee Rate: %s",
+                         date_str, chan_id, alias, increase, reason, adjustment_amount, rewards[chan_id], next_state[chan_id])
+        logger.debug("Fee adjustments complete. Exiting...")
+
 # Main function to perform fee adjustments and collect data
 def run_rule_based_phase():
-    forwarding_events = get_forwarding_history(AGGREGATION_DAYS)
-    channel_aliases = get_all_channels()
+    with stage('fetch'):
+        forwarding_events = get_forwarding_history(AGGREGATION_DAYS)
+        channel_aliases = get_all_channels()
+    with stage('aggregate'):
+        channel_stats = aggregate_forwarding_events(forwarding_events)
 
-    if DEBUG:
-        print("All channels and their aliases:")
-        for chan_id, (pubkey, alias, fee_rate) in channel_aliases.items():
-            print(f"Channel ID: {chan_id}, Alias: {alias}")
+    log_channels("All channels and their aliases:", channel_aliases)
 
     state = {}
     next_state = {}
-    actions = rule_based_adjustments(forwarding_events, channel_aliases)
     rewards = {}
-
-    for action in actions:
-        chan_id, alias, increase, reason, adjustment_amount = action
-        current_fee_rate, new_fee_rate = adjust_fee(chan_id, alias, increase, reason, adjustment_amount)
+    with stage('decide'):
+        actions = apply_cooldowns(rule_based_adjustments(channel_stats, channel_aliases))
+
+    with stage('apply'):
+        fee_rates = apply_fee_adjustments(actions)
+        record_fee_updates(fee_rates)
+    actions = [action for action in actions if action[0] in fee_rates]
+    for chan_id, (current_fee_rate, new_fee_rate) in fee_rates.items():
         state[chan_id] = current_fee_rate
         next_state[chan_id] = new_fee_rate
-        rewards[chan_id] = reward_function_per_channel(chan_id, forwarding_events)
-
-    if DEBUG:
-        print(f"State: {state}")
-        print(f"Next State: {next_state}")
-        print(f"Rewards: {rewards}")
+        rewards[chan_id] = reward_function_per_channel(chan_id, channel_stats)
 
-    collect_data(state, actions, rewards, next_state)
+    if not DRY_RUN:
+        with stage('persist'):
+            collect_data(state, actions, rewards, next_state)
 
-    if DEBUG:
-        print("Summary of fee adjustments made:")
-        date_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        for action in actions:
-            chan_id, alias, increase, reason, adjustment_amount = action
-            reward = rewards[chan_id]
-            print(f"Date: {date_str}, Channel: {chan_id} ({alias}), Increase: {increase}, Reason: {reason}, Adjustment Amount: {adjustment_amount}, Reward: {reward}, New Fee Rate: {next_state[chan_id]}")
-
-    if DEBUG:
-        print("Fee adjustments complete. Exiting...")
+    log_adjustments("Summary of fee adjustments made:", actions, state, next_state, rewards)
+    return fee_rates
 
 def run_q_learning_phase():
-    forwarding_events = get_forwarding_history(AGGREGATION_DAYS)
-    channel_aliases = get_all_channels()
+    with stage('fetch'):
+        forwarding_events = get_forwarding_history(AGGREGATION_DAYS)
+        channel_aliases = get_all_channels()
+        policies = get_own_policies() if Q_STORE else None
+    with stage('aggregate'):
+        channel_stats = aggregate_forwarding_events(forwarding_events)
 
-    if DEBUG:
-        print("All channels and their aliases (Q-Learning phase):")
-        for chan_id, (pubkey, alias, fee_rate) in channel_aliases.items():
-            print(f"Channel ID: {chan_id}, Alias: {alias}")
+    log_channels("All channels and their aliases (Q-Learning phase):", channel_aliases)
 
     state = {}
     next_state = {}
-    actions = select_actions_based_on_q_table(channel_aliases)
     rewards = {}
-
-    for action in actions:
-        chan_id, alias, increase, reason, adjustment_amount = action
-        current_fee_rate, new_fee_rate = adjust_fee(chan_id, alias, increase, reason, adjustment_amount)
+    with stage('decide'):
+        if Q_STORE:
+            chan_ids = list(channel_aliases)
+            channel_states = get_channel_states(channel_aliases, channel_stats, policies)
+            rewards = {chan_id: reward_function_per_channel(chan_id, channel_stats) for chan_id in chan_ids}
+            update_q_store(chan_ids, channel_states, rewards, forwarding_events)
+            actions = select_actions_based_on_q_table(channel_aliases, Q_STORE_TABLE.lookup(Q_STORE_TABLE.make_keys(chan_ids, channel_states)))
+        else:
+            actions = select_actions_based_on_q_table(channel_aliases)
+        actions = apply_cooldowns(actions)
+
+    with stage('apply'):
+        fee_rates = apply_fee_adjustments(actions, policies)
+        record_fee_updates(fee_rates)
+    actions = [action for action in actions if action[0] in fee_rates]
+    for chan_id, (current_fee_rate, new_fee_rate) in fee_rates.items():
         state[chan_id] = current_fee_rate
         next_state[chan_id] = new_fee_rate
-        rewards[chan_id] = reward_function_per_channel(chan_id, forwarding_events)
-
-    if DEBUG:
-        print(f"State: {state}")
-        print(f"Next State: {next_state}")
-        print(f"Rewards: {rewards}")
+        if chan_id not in rewards:
+            rewards[chan_id] = reward_function_per_channel(chan_id, channel_stats)
 
-    collect_data(state, actions, rewards, next_state)
+    # Remember each channel's state, action and when it was taken, to learn from once the next run sees its reward
+    if Q_STORE:
+        channel_state = dict(zip(chan_ids, channel_states.tolist()))
+        now = current_time()
+        Q_STORE_TABLE.pending = {chan_id: [channel_state[chan_id], int(increase), now] for chan_id, alias, increase, reason, adjustment_amount in actions}
 
-    if DEBUG:
-        print("Summary of fee adjustments made (Q-Learning phase):")
-        date_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        for action in actions:
-            chan_id, alias, increase, reason, adjustment_amount = action
-            reward = rewards[chan_id]
-            print(f"Date: {date_str}, Channel: {chan_id} ({alias}), Increase: {increase}, Reason: {reason}, Adjustment Amount: {adjustment_amount}, Reward: {reward}, New Fee Rate: {next_state[chan_id]}")
+    if not DRY_RUN:
+        with stage('persist'):
+            collect_data(state, actions, rewards, next_state)
 
-    if DEBUG:
-        print("Fee adjustments complete. Exiting...")
+    log_adjustments("Summary of fee adjustments made (Q-Learning phase):", actions, state, next_state, rewards)
+    return fee_rates
 
-# Function to save the Q-table
+# Function to save the Q-table, with the checkpoint of the training rows it includes
 def save_q_table():
-    np.save('q_table.npy', Q)
+    np.save(Q_TABLE_FILE, Q)
+    if TRAINING_CHECKPOINT is not None:
+        save_training_checkpoint(TRAINING_CHECKPOINT)
 
 # Function to load the Q-table
 def load_q_table():
-    if os.path.isfile('q_table.npy'):
-        global Q
-        Q = np.load('q_table.npy')
+    global Q
+    if os.path.isfile(Q_TABLE_FILE):
+        Q = np.load(Q_TABLE_FILE)
     else:
         Q = np.zeros((num_states, num_actions))
 
-def run_phase():
-    if QTABLE:
+# Function to load the per-channel Q-table, memory-mapped
+def load_q_store():
+    global Q_STORE_TABLE
+    Q_STORE_TABLE = SparseQTable.load(Q_STORE_DIR, num_actions)
+
+# Function to save the per-channel Q-table
+def save_q_store():
+    Q_STORE_TABLE.save(Q_STORE_DIR)
+
+# Function to load the models and state that are kept in memory between runs
+def load_state():
+    load_fee_update_times()
+    if QTABLE and Q_STORE:
+        load_q_store()
+    elif QTABLE:
         load_q_table()
-        train_from_csv()
-        if DEBUG:
-            print("Q-table after training:", Q)
-        run_q_learning_phase()
-    else:
-        run_rule_based_phase()
 
-    save_q_table()
+# Function to run one round of fee adjustments; returns the old and new fee rate of each channel adjusted
+def run_adjustments():
+    with profiled(PROFILE_DIR, "fee_setting_agent"):
+        if QTABLE and not Q_STORE:
+            with stage('train'):
+                train_from_data()
+            logger.debug("Q-table after training: %s", Q)
+        if QTABLE:
+            return run_q_learning_phase()
+        return run_rule_based_phase()
+
+# Function to save the models and state, as a checkpoint
+def save_state():
+    with stage('persist'):
+        if QTABLE and Q_STORE:
+            save_q_store()
+        elif QTABLE:
+            save_q_table()
+        save_fee_update_times()
+
+# Function to write the node command and stage timings of the run just finished
+def flush_metrics():
+    commands, stages = get_metrics().flush(run=current_time())
+    logger.debug("Run timings: %s", get_metrics().summary(commands, stages))
 
-if __name__ == "__main__":
-    run_phase()
+def run_phase():
+    load_state()
+    fee_rates = run_adjustments()
+    if not DRY_RUN:
+        save_state()
+    flush_metrics()
+    return fee_rates
+
+# Function to run fee adjustments on a schedule, keeping the Q-table, event store and node
+# connection warm between runs, until SIGTERM or SIGINT
+def run_daemon(interval=None):
+    global PROMPT
+    interval = DAEMON_INTERVAL if interval is None else interval
+    if PROMPT:
+        print("Daemon mode runs unattended, ignoring PROMPT.")
+        PROMPT = False
+    stop = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda signum, frame: stop.set())
+
+    load_state()
+    last_checkpoint = time.monotonic()
+    while not stop.is_set():
+        started = time.monotonic()
+        try:
+            run_adjustments()
+        except Exception as error:
+            print(f"Error in fee adjustment run: {error}")
+        if not DRY_RUN and time.monotonic() - last_checkpoint >= CHECKPOINT_INTERVAL:
+            save_state()
+            last_checkpoint = time.monotonic()
+        flush_metrics()
+        stop.wait(max(0, interval - (time.monotonic() - started)))
+
+    print("Shutting down, saving state.")
+    if not DRY_RUN:
+        save_state()
+    close_event_store()
+    close_data_store()
+
+# Function to run the agent from the command line, once or as a daemon
+def main(argv=None, prog=None):
+    global DRY_RUN
+    parser = argparse.ArgumentParser(prog=prog, description="Set channel fees from forwarding history, with rules or Q-learning")
+    parser.add_argument('--dry-run', action='store_true', help="Print the planned fee changes without applying them or recording any data")
+    parser.add_argument('--daemon', action='store_true', help="Keep running, adjusting fees every --interval seconds until SIGTERM")
+    parser.add_argument('--interval', type=int, default=DAEMON_INTERVAL, help="Seconds between runs in daemon mode")
+    options = parser.parse_args(argv)
+    DRY_RUN = DRY_RUN or options.dry_run
+    configure_logging(DEBUG)
+    if options.daemon:
+        run_daemon(options.interval)
+    else:
+        run_phase()
 
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Fleet mode: runs fee_setting_agent.py and rebalance.py for several lnd nodes at once.
+# Both scripts keep their configuration and models in module globals, so each node is run
+# in a process of its own, working in the node's data directory, where its data store,
+# Q-table, event store and attempt log are kept. FLEET_CONCURRENCY caps how many nodes run
+# at a time. Each node's output goes to fleet.log in its data directory, and a summary of
+# every node is printed and written to FLEET_SUMMARY_FILE.
+#
+#   python fleet.py fleet.json
+#   python fleet.py fleet.json --nodes alpha beta --tasks fees --dry-run
+#   python fleet.py --fake 4    # four fake nodes, for testing
+#
+# The config file is JSON:
+#
+#   {
+#     "concurrency": 4,
+#     "fee_setting_agent": {"QTABLE": false},       settings for every node
+#     "rebalance": {"SUCCEEDED_MAX": 5},
+#     "nodes": [
+#       {"name": "alpha", "lncli_path": "lncli --rpcserver=localhost:10009", "macaroon_path": "~/alpha/admin.macaroon",
+#        "tls_cert_path": "~/alpha/tls.cert", "data_dir": "alpha"},
+#       {"name": "beta", "node_backend": "rest", "rest_host": "beta.local:8080", "macaroon_path": "~/beta/admin.macaroon",
+#        "tls_cert_path": "~/beta/tls.cert", "tasks": ["fees"], "fee_setting_agent": {"QTABLE": true}},
+#       {"name": "test", "fake": {"channels": 20, "events": 5000, "seed": 1}}
+#     ]
+#   }
+
+import argparse
+import json
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import redirect_stdout
+from multiprocessing import get_context
+
+from lntools import module_settings
+
+# Configuration parameters
+FLEET_CONCURRENCY = 4  # Maximum number of nodes run at once, unless the config file or --concurrency sets it
+FLEET_DATA_DIR = "fleet_data"  # Parent of the nodes' data directories, unless a node sets data_dir
+FLEET_LOG_FILE = "fleet.log"  # Output of each node's runs, in its data directory
+FLEET_SUMMARY_FILE = "fleet_summary.json"  # Summary of the last fleet run
+TASKS = ['fees', 'rebalance']  # What is run for a node, in this order, unless the node sets tasks
+NODE_KEYS = {'name', 'node_backend', 'lncli_path', 'rest_host', 'macaroon_path', 'tls_cert_path', 'data_dir', 'tasks', 'fake',
+             'fee_setting_agent', 'rebalance'}
+
+# Function to read the fleet config, resolving data directories against the config file's folder
+def load_fleet_config(path):
+    with open(path) as file:
+        config = json.load(file)
+    base_dir = os.path.dirname(os.path.abspath(path))
+    return normalize_fleet_config(config, base_dir)
+
+def normalize_fleet_config(config, base_dir):
+    nodes = []
+    for node in config.get('nodes', []):
+        if 'name' not in node:
+            raise Exception(f"Error in fleet config: every node needs a name: {node}")
+        unknown = set(node) - NODE_KEYS
+        if unknown:
+            raise Exception(f"Error in fleet config for {node['name']}: unknown keys {sorted(unknown)}")
+        tasks = node.get('tasks', TASKS)
+        if set(tasks) - set(TASKS):
+            raise Exception(f"Error in fleet config for {node['name']}: tasks must be among {TASKS}")
+        data_dir = os.path.join(base_dir, os.path.expanduser(node.get('data_dir', os.path.join(FLEET_DATA_DIR, node['name']))))
+        settings = {script: dict(config.get(script, {}), **node.get(script, {})) for script in ('fee_setting_agent', 'rebalance')}
+        nodes.append(dict(node, tasks=list(tasks), data_dir=data_dir, **settings))
+    names = [node['name'] for node in nodes]
+    if len(set(names)) < len(names):
+        raise Exception("Error in fleet config: node names must be unique")
+    return {'concurrency': config.get('concurrency', FLEET_CONCURRENCY), 'nodes': nodes}
+
+# Function to build a config of fake nodes, one data directory each under FLEET_DATA_DIR
+def fake_fleet_config(count, channels=20, events=5000):
+    return normalize_fleet_config({'nodes': [{'name': f"fake-{i}", 'fake': {'channels': channels, 'events': events, 'seed': i}}
+                                             for i in range(count)]}, os.getcwd())
+
+# Function to create the node client for one node of the fleet
+def create_fleet_client(node):
+    from node_client import LncliBackend, create_node_client
+    if 'fake' in node:
+        from fake_lnd import FakeNode
+        fake = node['fake']
+        return FakeNode(fake.get('channels', 10), fake.get('events', 1000), seed=fake.get('seed', 0))
+    backend = node.get('node_backend', 'lncli')
+    if backend == 'lncli':
+        # lncli finds the default node's macaroon and certificate itself; other nodes name theirs
+        extra_args = []
+        if node.get('macaroon_path'):
+            extra_args += ['--macaroonpath', os.path.expanduser(node['macaroon_path'])]
+        if node.get('tls_cert_path'):
+            extra_args += ['--tlscertpath', os.path.expanduser(node['tls_cert_path'])]
+        return LncliBackend(node.get('lncli_path', 'lncli'), extra_args)
+    return create_node_client(backend, rest_host=node.get('rest_host', 'localhost:8080'), macaroon_path=node.get('macaroon_path'),
+                              tls_cert_path=node.get('tls_cert_path'))
+
+# Function to set a script's module-level settings for one node, refusing names the script does not have
+def apply_settings(module, settings, node_name):
+    for name, value in settings.items():
+        if name not in module_settings(module):
+            raise Exception(f"Error in fleet config for {node_name}: {module.__name__} has no setting {name}")
+        setattr(module, name, value)
+
+# Function to run fee_setting_agent.py once for a node
+def run_fees(node, client, dry_run):
+    import fee_setting_agent as agent
+    from instrumentation import InstrumentedClient
+    apply_settings(agent, node['fee_setting_agent'], node['name'])
+    agent.PROMPT = False  # Nodes run unattended
+    agent.DRY_RUN = agent.DRY_RUN or dry_run
+    agent.NODE = InstrumentedClient(client, agent.get_metrics())
+    try:
+        fee_rates = agent.run_phase() or {}
+    finally:
+        agent.close_event_store()
+        agent.close_data_store()
+    return {'channels': len(fee_rates), 'fee_changes': sum(new != current for current, new in fee_rates.values()),
+            'node_commands': sum(counters[0] for counters in agent.get_metrics().total_commands.values())}
+
+# Function to run rebalance.py's loop once for a node
+def run_rebalance(node, client, dry_run):
+    if dry_run:
+        return {'skipped': "dry run"}
+    import rebalance
+    from instrumentation import InstrumentedClient
+    apply_settings(rebalance, node['rebalance'], node['name'])
+    rebalance.client = InstrumentedClient(client, rebalance.get_metrics())
+    rebalance.main()
+    return {'rebalances': rebalance.SUCCEEDED_COUNT, 'rebalanced_sat': rebalance.REBALANCED_AMOUNT, 'rounds': rebalance.ATTEMPTED_COUNT,
+            'node_commands': sum(counters[0] for counters in rebalance.get_metrics().total_commands.values())}
+
+# Function to run a node's tasks in its data directory; called in a process of its own.
+# Errors are reported in the result, so one failing node does not stop the others.
+def run_node(node, tasks, dry_run, debug):
+    from instrumentation import configure_logging
+    started = time.perf_counter()
+    result = {'name': node['name'], 'status': 'ok', 'tasks': {}}
+    os.makedirs(node['data_dir'], exist_ok=True)
+    os.chdir(node['data_dir'])  # The scripts' data files are relative to the working folder
+    with open(FLEET_LOG_FILE, mode='a') as log, redirect_stdout(log):
+        configure_logging(debug)
+        print(f"=== {time.strftime('%Y-%m-%d %H:%M:%S')} fleet run of {node['name']}: {', '.join(tasks)}")
+        try:
+            client = create_fleet_client(node)
+            for task in tasks:
+                task_started = time.perf_counter()
+                outcome = run_fees(node, client, dry_run) if task == 'fees' else run_rebalance(node, client, dry_run)
+                result['tasks'][task] = dict(outcome, seconds=round(time.perf_counter() - task_started, 3))
+            client.close()
+        except Exception as error:
+            traceback.print_exc(file=log)
+            result.update(status='error', error=f"{type(error).__name__}: {error}")
+    result['seconds'] = round(time.perf_counter() - started, 3)
+    return result
+
+# Function to call a function in a new process of its own, so no module state or memory carries over
+def run_in_process(function, *args):
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+        return executor.submit(function, *args).result()
+
+# Function to run every node, at most concurrency at a time, each in a fresh process
+def run_fleet(config, tasks=None, dry_run=False, debug=False, concurrency=None):
+    nodes = config['nodes']
+    results = []
+    with ThreadPoolExecutor(max_workers=max(1, min(concurrency or config['concurrency'], len(nodes) or 1))) as executor:
+        futures = {executor.submit(run_in_process, run_node, node, [task for task in node['tasks'] if not tasks or task in tasks], dry_run, debug): node
+                   for node in nodes}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as error:  # The worker process itself died
+                result = {'name': futures[future]['name'], 'status': 'error', 'error': f"{type(error).__name__}: {error}", 'tasks': {}, 'seconds': 0}
+            print(f"{result['name']}: {result['status']} in {result['seconds']:.1f}s" + (f" ({result['error']})" if 'error' in result else ''), flush=True)
+            results.append(result)
+    order = {node['name']: i for i, node in enumerate(nodes)}
+    return sorted(results, key=lambda result: order[result['name']])
+
+def print_summary(results):
+    print(f"\n{'node':<16} {'status':<7} {'seconds':>8} {'channels':>8} {'fee changes':>11} {'rebalances':>10} {'rebalanced (sat)':>16} {'commands':>9}")
+    totals = {'channels': 0, 'fee_changes': 0, 'rebalances': 0, 'rebalanced_sat': 0, 'node_commands': 0}
+    for result in results:
+        fees, rebalance = result['tasks'].get('fees', {}), result['tasks'].get('rebalance', {})
+        row = {'channels': fees.get('channels', 0), 'fee_changes': fees.get('fee_changes', 0), 'rebalances': rebalance.get('rebalances', 0),
+               'rebalanced_sat': rebalance.get('rebalanced_sat', 0), 'node_commands': fees.get('node_commands', 0) + rebalance.get('node_commands', 0)}
+        totals = {key: totals[key] + row[key] for key in totals}
+        print(f"{result['name']:<16} {result['status']:<7} {result['seconds']:>8.1f} {row['channels']:>8} {row['fee_changes']:>11} "
+              f"{row['rebalances']:>10} {row['rebalanced_sat']:>16} {row['node_commands']:>9}")
+    failed = sum(result['status'] != 'ok' for result in results)
+    print(f"{'total':<16} {f'{failed} failed':<7} {'':>8} {totals['channels']:>8} {totals['fee_changes']:>11} "
+          f"{totals['rebalances']:>10} {totals['rebalanced_sat']:>16} {totals['node_commands']:>9}")
+    return totals
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the fee agent and rebalancer for several lnd nodes at once")
+    parser.add_argument('config', nargs='?', help="Fleet config file (JSON)")
+    parser.add_argument('--fake', type=int, metavar='N', help="Run N fake nodes instead of a config file, for testing")
+    parser.add_argument('--nodes', nargs='+', help="Only run these nodes")
+    parser.add_argument('--tasks', nargs='+', choices=TASKS, help="Only run these tasks")
+    parser.add_argument('--concurrency', type=int, help="Maximum number of nodes run at once")
+    parser.add_argument('--dry-run', action='store_true', help="Plan fee changes without applying them, and skip rebalancing")
+    parser.add_argument('--debug', action='store_true', help="Write debug messages to the nodes' logs")
+    options = parser.parse_args(argv)
+    if not options.config and not options.fake:
+        parser.error("a config file or --fake is required")
+
+    config = fake_fleet_config(options.fake) if options.fake else load_fleet_config(options.config)
+    if options.nodes:
+        missing = set(options.nodes) - {node['name'] for node in config['nodes']}
+        if missing:
+            parser.error(f"unknown nodes: {', '.join(sorted(missing))}")
+        config['nodes'] = [node for node in config['nodes'] if node['name'] in options.nodes]
+
+    started = time.perf_counter()
+    results = run_fleet(config, options.tasks, options.dry_run, options.debug, options.concurrency)
+    totals = print_summary(results)
+    with open(FLEET_SUMMARY_FILE, mode='w') as file:
+        json.dump({'time': int(time.time()), 'seconds': round(time.perf_counter() - started, 3), 'totals': totals, 'nodes': results}, file, indent=2)
+    print(f"Finished {len(results)} nodes in {time.perf_counter() - started:.1f}s; summary written to {FLEET_SUMMARY_FILE}")
+    return 1 if any(result['status'] != 'ok' for result in results) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
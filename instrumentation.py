@@ -0,0 +1,166 @@
+# Timing and profiling for the scripts in this repository.
+# Metrics counts, times and sizes every node command made through an InstrumentedClient,
+# and times the named stages of a run (fetch, aggregate, decide, apply, persist). At the
+# end of each run flush() appends the run's figures to a JSON lines file, one line per
+# command or stage, and rewrites a Prometheus text format file with the totals since
+# start, e.g. for node_exporter's textfile collector. profiled() optionally dumps a
+# cProfile profile per run.
+
+import cProfile
+import itertools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from node_client import NodeClient, NodeError
+
+METRIC_PREFIX = "lntools"
+PROFILE_SEQUENCE = itertools.count(1)  # Numbers the profiles of one process, as daemon runs can end within the same second
+
+# Function to send log messages to stdout, with the script's own output; below DEBUG level
+# debug messages are dropped before their arguments are formatted
+def configure_logging(debug):
+    logging.basicConfig(level=logging.DEBUG if debug else logging.INFO, format="%(message)s", stream=sys.stdout)
+
+class Metrics:
+    def __init__(self, script, metrics_file=None, prometheus_file=None):
+        self.script = script
+        self.metrics_file = metrics_file
+        self.prometheus_file = prometheus_file
+        self.lock = threading.Lock()
+        self.commands = {}  # command -> [calls, errors, seconds, response bytes], for the current run
+        self.stages = {}  # stage -> [runs, seconds], for the current run
+        self.total_commands = {}
+        self.total_stages = {}
+
+    # Only count response sizes when the figures are written somewhere, as it serializes every response
+    @property
+    def enabled(self):
+        return bool(self.metrics_file or self.prometheus_file)
+
+    def record_command(self, command, seconds, size, error=False):
+        with self.lock:
+            counters = self.commands.setdefault(command, [0, 0, 0.0, 0])
+            counters[0] += 1
+            counters[1] += int(error)
+            counters[2] += seconds
+            counters[3] += size
+
+    def record_stage(self, name, seconds):
+        with self.lock:
+            counters = self.stages.setdefault(name, [0, 0.0])
+            counters[0] += 1
+            counters[1] += seconds
+
+    # Function to time a block of code as a named stage of the run
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_stage(name, time.perf_counter() - started)
+
+    # Function to write the current run's figures and start the next run
+    def flush(self, **labels):
+        with self.lock:
+            commands, self.commands = self.commands, {}
+            stages, self.stages = self.stages, {}
+            for totals, run in ((self.total_commands, commands), (self.total_stages, stages)):
+                for name, counters in run.items():
+                    total = totals.setdefault(name, [0] * len(counters))
+                    total[:] = [a + b for a, b in zip(total, counters)]
+        if self.metrics_file:
+            self.write_json_lines(commands, stages, labels)
+        if self.prometheus_file:
+            self.write_prometheus()
+        return commands, stages
+
+    def write_json_lines(self, commands, stages, labels):
+        record = dict(time=round(time.time(), 3), script=self.script, **labels)
+        with open(self.metrics_file, mode='a') as file:
+            for command, (calls, errors, seconds, size) in sorted(commands.items()):
+                file.write(json.dumps(dict(record, kind='command', name=command, calls=calls, errors=errors,
+                                           seconds=round(seconds, 6), response_bytes=size)) + '\n')
+            for stage, (runs, seconds) in sorted(stages.items()):
+                file.write(json.dumps(dict(record, kind='stage', name=stage, runs=runs, seconds=round(seconds, 6))) + '\n')
+
+    # Function to write the totals in Prometheus text format, atomically so a scrape never sees half a file
+    def write_prometheus(self):
+        lines = []
+
+        def metric(name, help_text, values):
+            lines.append(f"# HELP {METRIC_PREFIX}_{name} {help_text}")
+            lines.append(f"# TYPE {METRIC_PREFIX}_{name} counter")
+            for label, key, value in values:
+                lines.append(f'{METRIC_PREFIX}_{name}{{script="{self.script}",{label}="{key}"}} {value}')
+
+        with self.lock:
+            commands = sorted(self.total_commands.items())
+            stages = sorted(self.total_stages.items())
+        metric("node_command_calls_total", "Node commands made.", [('command', name, c[0]) for name, c in commands])
+        metric("node_command_errors_total", "Node commands that returned an error.", [('command', name, c[1]) for name, c in commands])
+        metric("node_command_seconds_total", "Time spent in node commands.", [('command', name, f"{c[2]:.6f}") for name, c in commands])
+        metric("node_command_response_bytes_total", "Size of node command responses, as JSON.", [('command', name, c[3]) for name, c in commands])
+        metric("stage_runs_total", "Times each stage of a run was entered.", [('stage', name, s[0]) for name, s in stages])
+        metric("stage_seconds_total", "Time spent in each stage of a run.", [('stage', name, f"{s[1]:.6f}") for name, s in stages])
+        temp_path = self.prometheus_file + '.tmp'
+        with open(temp_path, mode='w') as file:
+            file.write('\n'.join(lines) + '\n')
+        os.replace(temp_path, self.prometheus_file)
+
+    # Function to print the run's slowest commands and stages, for a quick look without a metrics file
+    def summary(self, commands, stages):
+        parts = [f"{name} {seconds:.2f}s" for name, (runs, seconds) in stages.items()]
+        parts += [f"{name} x{calls} {seconds:.2f}s" for name, (calls, errors, seconds, size) in
+                  sorted(commands.items(), key=lambda item: item[1][2], reverse=True)[:5]]
+        return ', '.join(parts)
+
+# Node client wrapper that records every call in a Metrics instance
+class InstrumentedClient(NodeClient):
+    def __init__(self, client, metrics):
+        self.client = client
+        self.metrics = metrics
+
+    def call(self, command, *args, **flags):
+        started = time.perf_counter()
+        try:
+            result = self.client.call(command, *args, **flags)
+        except NodeError:
+            self.metrics.record_command(command, time.perf_counter() - started, 0, error=True)
+            raise
+        seconds = time.perf_counter() - started
+        size = len(json.dumps(result)) if self.metrics.enabled else 0
+        self.metrics.record_command(command, seconds, size)
+        return result
+
+    def format_command(self, command, *args, **flags):
+        return self.client.format_command(command, *args, **flags)
+
+    def subscribe(self, command):
+        return self.client.subscribe(command)
+
+    def close(self):
+        self.client.close()
+
+# Function to profile a block of code with cProfile when profile_dir is set, dumping one
+# profile per run that can be read with pstats or snakeviz
+@contextmanager
+def profiled(profile_dir, name):
+    if not profile_dir:
+        yield
+        return
+    os.makedirs(profile_dir, exist_ok=True)
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        path = os.path.join(profile_dir, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{next(PROFILE_SEQUENCE)}.prof")
+        profiler.dump_stats(path)
+        logging.getLogger(__name__).info("Wrote profile %s", path)
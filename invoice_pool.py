@@ -0,0 +1,120 @@
+# Payment secrets for rebalance payments, so that an attempt needs no invoice commands of its own.
+# InvoicePool keeps a bounded set of amountless invoices to our own node, paid with whatever
+# amount each attempt needs. An invoice whose payment failed goes back into the pool and is
+# paid again later; a settled one is dropped. Invoices that grow old, or whose payment ended
+# in an unknown state, are marked stale and cancelled in one batch by a background thread,
+# which also tops the pool up, between rounds. The pool is kept across runs in a JSON file.
+# new_keysend() makes the secret of a keysend payment to ourselves instead, with no invoice.
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from node_client import NodeError
+
+INVOICE_POOL_FILE = "rebalance_invoices.json"  # Pooled and stale invoices, kept across runs
+INVOICE_POOL_SIZE = 4              # Invoices kept ready; an attempt that finds the pool empty creates one
+INVOICE_EXPIRY = 7 * 86400         # Expiry of pooled invoices, in seconds
+INVOICE_MAX_AGE = 6 * 86400        # Seconds after which a pooled invoice is no longer paid, but cancelled
+INVOICE_MEMO = "rebalance"         # Memo of pooled invoices
+
+logger = logging.getLogger("invoice_pool")
+
+# Function to make the preimage and payment hash of a keysend payment, as hex
+def new_keysend():
+    preimage = os.urandom(32)
+    return {'r_hash': hashlib.sha256(preimage).hexdigest(), 'preimage': preimage.hex()}
+
+class InvoicePool:
+    def __init__(self, client, path=INVOICE_POOL_FILE, size=INVOICE_POOL_SIZE, expiry=INVOICE_EXPIRY, max_age=INVOICE_MAX_AGE,
+                 memo=INVOICE_MEMO, clock=time.time):
+        self.client = client
+        self.path = path
+        self.size = size
+        self.expiry = expiry
+        self.max_age = max_age
+        self.memo = memo
+        self.clock = clock
+        self.ready = []  # Invoices that can be paid: dicts of r_hash, payment_request, payment_addr and created
+        self.stale = set()  # Payment hashes of invoices waiting to be cancelled
+        self.worker = None
+        self.lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path) as file:
+                saved = json.load(file)
+            self.ready = saved.get('ready', [])
+            self.stale = set(saved.get('stale', []))
+
+    def _create(self):
+        invoice = self.client.call("addinvoice", 0, memo=self.memo, expiry=self.expiry)
+        return {'r_hash': invoice['r_hash'], 'payment_request': invoice['payment_request'],
+                'payment_addr': invoice.get('payment_addr'), 'created': self.clock()}
+
+    # Function to take an invoice for one attempt, creating one only when none is ready
+    def take(self):
+        now = self.clock()
+        with self.lock:
+            while self.ready:
+                invoice = self.ready.pop()
+                if now - invoice['created'] < self.max_age:
+                    return invoice
+                self.stale.add(invoice['r_hash'])
+        return self._create()
+
+    # Function to hand back an invoice after an attempt: a failed payment leaves it open to be
+    # paid again, a settled one is done with, and one in an unknown state is cancelled later
+    def put_back(self, invoice, outcome):
+        with self.lock:
+            if outcome == 'FAILED' and len(self.ready) < self.size:
+                self.ready.append(invoice)
+            elif outcome != 'SUCCEEDED':
+                self.stale.add(invoice['r_hash'])
+
+    # Function to cancel the stale invoices and top the pool up, as one batch of node calls
+    def maintain(self):
+        with self.lock:
+            now = self.clock()
+            self.stale.update(invoice['r_hash'] for invoice in self.ready if now - invoice['created'] >= self.max_age)
+            self.ready = [invoice for invoice in self.ready if invoice['r_hash'] not in self.stale]
+            stale = list(self.stale)
+            missing = self.size - len(self.ready)
+        for r_hash in stale:
+            try:
+                self.client.call("cancelinvoice", r_hash)
+            except NodeError as error:
+                # Settled invoices cannot be cancelled, and the rest expire on their own
+                logger.debug("Could not cancel invoice %s: %s", r_hash, error)
+        created = []
+        for _ in range(max(0, missing)):
+            try:
+                created.append(self._create())
+            except NodeError as error:
+                logger.info("Could not create a pooled invoice: %s", error)
+                break
+        with self.lock:
+            self.stale.difference_update(stale)
+            self.ready.extend(created)
+        logger.debug("Cancelled %d stale invoices, created %d", len(stale), len(created))
+
+    # Function to run maintain() in a background thread, unless the last batch is still running
+    def maintain_in_background(self):
+        if self.worker is not None and self.worker.is_alive():
+            return
+        self.worker = threading.Thread(target=self.maintain, daemon=True)
+        self.worker.start()
+
+    # Function to wait for the background batch and write the pool, atomically
+    def close(self):
+        if self.worker is not None:
+            self.worker.join()
+        if not self.path:
+            return
+        with self.lock:
+            saved = {'ready': list(self.ready), 'stale': sorted(self.stale)}
+        temp_path = self.path + '.tmp'
+        with open(temp_path, mode='w') as file:
+            json.dump(saved, file)
+        os.replace(temp_path, self.path)
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# One command line for the node tools, installed as lntools:
+#
+#   lntools fees [--dry-run] [--daemon] [--interval 3600]     fee_setting_agent.py
+#   lntools rebalance                                         rebalance.py
+#   lntools analyze [--top 10] [--no-plots]                   analyze_fee_adjustments.py
+#   lntools config                                            print the settings given in the config file, environment and flags
+#
+# Each tool keeps its settings in module globals, as when it is run as a script. lntools
+# sets them, before running the tool, from three places, each overriding the one before:
+#
+#   a JSON config file, from --config, LNTOOLS_CONFIG or lntools.json in the working folder:
+#     {
+#       "NODE_BACKEND": "rest",                      settings for every tool that has them
+#       "fee_setting_agent": {"QTABLE": false},      settings for one tool, as in fleet.py
+#       "rebalance": {"SUCCEEDED_MAX": 5}
+#     }
+#   environment variables LNTOOLS_<SETTING>, e.g. LNTOOLS_NODE_BACKEND=rest, for every tool that has the setting
+#   --set SETTING=VALUE, or --set rebalance.SETTING=VALUE for one tool, and the node connection flags
+#
+# Values from the environment and --set are read as JSON where they parse (5, 0.5, true, null),
+# and as strings otherwise. Every name must be a setting of some tool, or of its section's tool.
+# Only this module is imported at startup; the tools, and with them NumPy, are imported when a
+# command runs, so --help and config start quickly. Services can use the same settings with
+# load_config() and configure().
+
+import argparse
+import json
+import os
+import sys
+
+CONFIG_FILE = "lntools.json"  # Config file read from the working folder when neither --config nor LNTOOLS_CONFIG names one
+ENV_PREFIX = "LNTOOLS_"  # Prefix of settings given as environment variables
+# The modules each command runs, with their settings sections in the config file
+COMMANDS = {
+    'fees': ['fee_setting_agent'],
+    'rebalance': ['rebalance'],
+    'analyze': ['fee_setting_agent', 'analyze_fee_adjustments'],  # The analysis reads the fee agent's data store settings
+}
+# Node connection flags, and the setting each sets
+NODE_FLAGS = {'backend': 'NODE_BACKEND', 'lncli_path': 'LNCLI_PATH', 'rest_host': 'REST_HOST', 'macaroon': 'MACAROON_PATH',
+              'tls_cert': 'TLS_CERT_PATH'}
+SECTIONS = sorted({module for modules in COMMANDS.values() for module in modules})
+# Settings named in lower case; every other setting is an upper case module global
+LOWER_CASE_SETTINGS = {
+    'fee_setting_agent': ['alpha', 'gamma', 'epsilon'],
+    'rebalance': ['max_fee', 'invoice_size', 'min_invoice_size', 'force', 'timeout', 'fee_increment', 'fee_decrement'],
+}
+
+# Function to read a setting's value from text: JSON where it parses, a string otherwise
+def parse_value(text):
+    if text.lower() in ('true', 'false'):
+        return text.lower() == 'true'  # Also Python's True and False
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+# Function to read --set SETTING=VALUE or --set section.SETTING=VALUE into (section, name, value),
+# section being None for every tool
+def parse_assignment(assignment):
+    name, separator, text = assignment.partition('=')
+    if not separator or not name:
+        raise ValueError(f"settings are given as SETTING=VALUE, not {assignment!r}")
+    section, dot, setting = name.rpartition('.')
+    if dot and section not in SECTIONS:
+        raise ValueError(f"unknown section {section!r} in {assignment!r}, expected one of {', '.join(SECTIONS)}")
+    return (section or None), setting, parse_value(text)
+
+# Function to set a setting for every tool, overriding what any tool's section set before
+def set_shared(config, name, value):
+    for section in SECTIONS:
+        config[section].pop(name, None)
+        config[section].pop(name.lower(), None)
+    config['shared'][name] = value
+
+# Function to gather the settings from the config file, the environment and flags, without
+# importing any tool. Returns {'shared': {...}, section: {...}, 'sources': [...]}, each later
+# source overriding earlier ones; shared settings apply to every tool that has them.
+def load_config(path=None, environ=None, assignments=(), node_flags=None):
+    environ = os.environ if environ is None else environ
+    config = {'shared': {}, 'sources': []}
+    config.update({section: {} for section in SECTIONS})
+
+    path = path or environ.get(ENV_PREFIX + 'CONFIG') or (CONFIG_FILE if os.path.isfile(CONFIG_FILE) else None)
+    if path:
+        try:
+            with open(os.path.expanduser(path)) as file:
+                saved = json.load(file)
+        except (OSError, ValueError) as error:
+            raise Exception(f"Error reading config file {path}: {error}")
+        for key, value in saved.items():
+            if key in SECTIONS:
+                config[key].update(value)
+            elif isinstance(value, dict):
+                raise Exception(f"Error in config file {path}: unknown section {key!r}, expected one of {', '.join(SECTIONS)}")
+            else:
+                config['shared'][key] = value
+        config['sources'].append(os.path.abspath(path))
+
+    for key, text in sorted(environ.items()):
+        if key.startswith(ENV_PREFIX) and key != ENV_PREFIX + 'CONFIG':
+            set_shared(config, key[len(ENV_PREFIX):], parse_value(text))
+            config['sources'].append(f"${key}")
+
+    for flag, value in (node_flags or {}).items():
+        if value is not None:
+            set_shared(config, NODE_FLAGS[flag], value)
+            config['sources'].append(f"--{flag.replace('_', '-')}")
+    for assignment in assignments:
+        section, name, value = parse_assignment(assignment)
+        if section is None:
+            set_shared(config, name, value)
+        else:
+            config[section][name] = value
+        config['sources'].append(f"--set {assignment}")
+    return config
+
+# Function to read a tool's setting names from its source file, without importing it: upper case
+# names assigned at module level to anything but a lambda, and its lower case settings. Names a
+# tool imports, such as rebalance's FIRST_COMPLETED, are not its settings.
+def source_settings(section, path=None):
+    import ast
+    if path is None:
+        import importlib.util
+        path = importlib.util.find_spec(section).origin
+    with open(path) as file:
+        tree = ast.parse(file.read())
+    names = {target.id for node in tree.body if isinstance(node, ast.Assign) and not isinstance(node.value, ast.Lambda)
+             for target in node.targets if isinstance(target, ast.Name)}
+    return {name for name in names if name.isupper()} | set(LOWER_CASE_SETTINGS.get(section, ()))
+
+# Function to list an imported tool module's settings
+def module_settings(module):
+    return source_settings(module.__name__.rpartition('.')[2], module.__file__)
+
+# Function to set a tool's module settings from a config: shared settings the module has, then
+# its own section, whose names must all exist. Names given in upper case, as environment
+# variables are, also match a lower case setting such as rebalance's max_fee.
+def configure(module, config):
+    section = module.__name__.rpartition('.')[2]
+    settings = module_settings(module)
+    for name, value in config['shared'].items():
+        for candidate in (name, name.lower()):
+            if candidate in settings:
+                setattr(module, candidate, value)
+                break
+    for name, value in config.get(section, {}).items():
+        if name not in settings:
+            raise Exception(f"Error in settings for {section}: it has no setting {name}")
+        setattr(module, name, value)
+    return module
+
+# Function to check the config's names against every tool, from their sources so tools the command
+# does not run are not imported: each shared setting must be a setting of some tool, and each
+# section's settings of its tool, so a misspelt name is reported rather than ignored
+def check_settings(config):
+    settings = {section: source_settings(section) for section in SECTIONS}
+    for section in SECTIONS:
+        unknown = [name for name in config.get(section, {}) if name not in settings[section]]
+        if unknown:
+            raise Exception(f"Error in settings for {section}: it has no setting {', '.join(unknown)}")
+    known = set().union(*settings.values())
+    unknown = [name for name in config['shared'] if name not in known and name.lower() not in known]
+    if unknown:
+        raise Exception(f"Error in settings: no tool has a setting {', '.join(unknown)}")
+
+# Function to import the modules a command runs and set their settings
+def load_tools(command, config):
+    import importlib
+    check_settings(config)
+    return [configure(importlib.import_module(name), config) for name in COMMANDS[command]]
+
+def run_fees(config, args, prog):
+    agent, = load_tools('fees', config)
+    agent.main(args, prog)
+
+def run_rebalance(config, args, prog):
+    if args:
+        raise SystemExit(f"{prog}: takes no arguments; rebalance.py is configured with settings, e.g. --set SUCCEEDED_MAX=5")
+    rebalance, = load_tools('rebalance', config)
+    from instrumentation import configure_logging, profiled
+    configure_logging(rebalance.DEBUG)
+    with profiled(rebalance.PROFILE_DIR, "rebalance"):
+        rebalance.main()
+
+def run_analyze(config, args, prog):
+    agent, analyze = load_tools('analyze', config)
+    analyze.main(args, prog)
+
+def print_config(config, args, prog):
+    if args:
+        raise SystemExit(f"{prog}: takes no arguments")
+    print(json.dumps({key: value for key, value in config.items() if key == 'sources' or value}, indent=2))
+
+RUNNERS = {'fees': run_fees, 'rebalance': run_rebalance, 'analyze': run_analyze, 'config': print_config}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='lntools', description="Fee setting, rebalancing and analysis for LND nodes",
+                                     epilog="Options after the command are the tool's own; see lntools COMMAND --help")
+    parser.add_argument('--config', help=f"JSON config file; defaults to $LNTOOLS_CONFIG, or {CONFIG_FILE} if it exists")
+    parser.add_argument('--set', dest='assignments', action='append', default=[], metavar='[TOOL.]SETTING=VALUE',
+                        help=f"Set a setting for every tool that has it, or for one tool ({', '.join(SECTIONS)}); may be repeated")
+    parser.add_argument('--backend', choices=['lncli', 'rest'], help="Node backend (NODE_BACKEND)")
+    parser.add_argument('--lncli-path', help="Path to lncli (LNCLI_PATH)")
+    parser.add_argument('--rest-host', help="lnd REST API address (REST_HOST)")
+    parser.add_argument('--macaroon', help="Macaroon file for the REST API (MACAROON_PATH)")
+    parser.add_argument('--tls-cert', help="TLS certificate for the REST API (TLS_CERT_PATH)")
+    parser.add_argument('command', choices=RUNNERS, help="fees: set channel fees; rebalance: rebalance channels; "
+                                                         "analyze: analyze the fee adjustments; config: print the settings given")
+    parser.add_argument('args', nargs=argparse.REMAINDER, help=argparse.SUPPRESS)
+    options = parser.parse_args(argv)
+
+    try:
+        config = load_config(options.config, assignments=options.assignments,
+                             node_flags={flag: getattr(options, flag) for flag in NODE_FLAGS})
+    except ValueError as error:
+        parser.error(str(error))
+    RUNNERS[options.command](config, options.args, f"lntools {options.command}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
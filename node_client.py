@@ -0,0 +1,306 @@
+# Pluggable client layer for talking to an LND node.
+# Every backend exposes call(command, *args, **flags), named after the lncli
+# subcommand, and returns the parsed JSON response as a dict. Errors from the
+# node are raised as NodeError. Backends that support lnd's streaming subscriptions
+# also expose subscribe(command), which yields one event at a time.
+#
+#   LncliBackend - runs the lncli binary for each call (the original behaviour)
+#   RestBackend  - talks to lnd's REST API over one persistent connection
+
+import base64
+import hashlib
+import http.client
+import json
+import os
+import shlex
+import ssl
+import subprocess
+import threading
+from urllib.parse import urlencode
+
+class NodeError(Exception):
+    pass
+
+# Function to tell whether a payinvoice result reports a settled payment
+def payment_succeeded(result):
+    return result.get('status') == 'SUCCEEDED' or 'SUCCEEDED' in result.get('output', '')
+
+# Function to get the routing fee paid, in satoshis, from a payinvoice result; None if not reported
+def payment_fee_sat(result):
+    if 'fee_sat' in result:
+        return int(result['fee_sat'])
+    if 'total_fees' in result.get('payment_route', {}):
+        return int(result['payment_route']['total_fees'])
+    return None
+
+# Function to get the number of hops in a payinvoice result's route; None if not reported
+def payment_route_length(result):
+    if result.get('htlcs'):
+        return len(result['htlcs'][-1].get('route', {}).get('hops', []))
+    if 'hops' in result.get('payment_route', {}):
+        return len(result['payment_route']['hops'])
+    return None
+
+class NodeClient:
+    def call(self, command, *args, **flags):
+        raise NotImplementedError
+
+    # Human readable form of a call, in lncli syntax, for logging and prompts
+    def format_command(self, command, *args, **flags):
+        return ' '.join(['lncli', command] + [str(arg) for arg in args] + _format_flags(flags))
+
+    # Function to yield the events of a streaming subscription, e.g. subscribehtlcevents
+    def subscribe(self, command):
+        raise NodeError(f"Subscription {command} is not supported by this backend")
+
+    def close(self):
+        pass
+
+def _format_flags(flags):
+    formatted = []
+    for name, value in flags.items():
+        if value is None or value is False:
+            continue
+        formatted.append(f"--{name}")
+        if value is not True:
+            formatted.append(str(value))
+    return formatted
+
+class LncliBackend(NodeClient):
+    def __init__(self, lncli_path="lncli", extra_args=()):
+        self.lncli = shlex.split(lncli_path) + list(extra_args)
+
+    def format_command(self, command, *args, **flags):
+        return ' '.join(self.lncli + [command] + [str(arg) for arg in args] + _format_flags(flags))
+
+    def call(self, command, *args, **flags):
+        argv = self.lncli + [command] + [str(arg) for arg in args] + _format_flags(flags)
+        result = subprocess.run(argv, capture_output=True, text=True)
+        output = result.stdout.strip()
+        if result.returncode != 0:
+            raise NodeError(result.stderr.strip() or output)
+        try:
+            return json.loads(output)
+        except ValueError:
+            # Some subcommands (e.g. payinvoice on older lncli) print plain text
+            return {'output': output}
+
+def _hex_to_base64(value):
+    return base64.b64encode(bytes.fromhex(value)).decode()
+
+def _base64_to_hex(value):
+    return base64.b64decode(value).hex()
+
+KEYSEND_RECORD = '5482373484'  # Custom record that carries a keysend preimage
+
+def _chan_point(chan_point):
+    txid, output_index = chan_point.split(':')
+    return {'funding_txid_str': txid, 'output_index': int(output_index)}
+
+def _chanpolicy_body(flags):
+    body = {
+        'base_fee_msat': str(flags.get('base_fee_msat', 0)),
+        'fee_rate': float(flags['fee_rate']),
+        'time_lock_delta': int(flags['time_lock_delta']),
+    }
+    if flags.get('min_htlc_msat') is not None:
+        body['min_htlc_msat'] = str(flags['min_htlc_msat'])
+        body['min_htlc_msat_specified'] = True
+    if flags.get('chan_point'):
+        body['chan_point'] = _chan_point(flags['chan_point'])
+    else:
+        body['global'] = True
+    return body
+
+# Flags shared by payinvoice and sendpayment
+def _payment_body(body, flags):
+    body['allow_self_payment'] = bool(flags.get('allow_self_payment'))
+    if flags.get('fee_limit') is not None:
+        body['fee_limit'] = {'fixed': str(flags['fee_limit'])}
+    if flags.get('outgoing_chan_id'):
+        body['outgoing_chan_id'] = str(flags['outgoing_chan_id'])
+    if flags.get('last_hop'):
+        body['last_hop_pubkey'] = _hex_to_base64(flags['last_hop'])
+    return body
+
+def _payinvoice_body(args, flags):
+    body = {'payment_request': args[0]}
+    if flags.get('amt'):
+        body['amt'] = str(flags['amt'])
+    return _payment_body(body, flags)
+
+# lncli makes the keysend preimage itself; over REST it is made here
+def _sendpayment_body(flags):
+    if not flags.get('keysend'):
+        raise NodeError("The REST backend only sends keysend payments with sendpayment")
+    preimage = os.urandom(32)
+    body = {'dest': _hex_to_base64(flags['dest']), 'amt': str(flags['amt']),
+            'payment_hash': base64.b64encode(hashlib.sha256(preimage).digest()).decode(),
+            'dest_custom_records': {KEYSEND_RECORD: base64.b64encode(preimage).decode()}}
+    return _payment_body(body, flags)
+
+def _payinvoice_result(response):
+    if response.get('payment_error'):
+        return {'status': 'FAILED', 'failure_reason': response['payment_error']}
+    return {'status': 'SUCCEEDED', 'payment_route': response.get('payment_route', {}),
+            'payment_preimage': response.get('payment_preimage', '')}
+
+def _buildroute_body(flags):
+    body = {
+        'amt_msat': str(int(flags['amt']) * 1000),
+        'final_cltv_delta': int(flags.get('final_cltv_delta', 40)),
+        'hop_pubkeys': [_hex_to_base64(pubkey) for pubkey in flags['hops'].split(',')],
+    }
+    if flags.get('outgoing_chan_id'):
+        body['outgoing_chan_id'] = str(flags['outgoing_chan_id'])
+    if flags.get('payment_addr'):
+        body['payment_addr'] = _hex_to_base64(flags['payment_addr'])
+    return body
+
+def _buildroute_result(response):
+    for hop in response.get('route', {}).get('hops', []):
+        if hop.get('mpp_record', {}).get('payment_addr'):
+            hop['mpp_record']['payment_addr'] = _base64_to_hex(hop['mpp_record']['payment_addr'])
+    return response
+
+# lncli takes the route as the JSON printed by buildroute, with bytes in hex; REST takes them in base64
+def _sendtoroute_body(flags):
+    route = json.loads(flags['routes']) if isinstance(flags['routes'], str) else flags['routes']
+    route = json.loads(json.dumps(route.get('route', route)))
+    final_hop = route['hops'][-1]
+    if final_hop.get('mpp_record', {}).get('payment_addr'):
+        final_hop['mpp_record']['payment_addr'] = _hex_to_base64(final_hop['mpp_record']['payment_addr'])
+    if final_hop.get('custom_records'):
+        final_hop['custom_records'] = {key: _hex_to_base64(value) for key, value in final_hop['custom_records'].items()}
+    return {'payment_hash': _hex_to_base64(flags['payment_hash']), 'route': route}
+
+def _addinvoice_body(args, flags):
+    body = {'value': str(args[0]), 'memo': flags.get('memo', '')}
+    if flags.get('expiry'):
+        body['expiry'] = str(flags['expiry'])
+    return body
+
+# REST returns payment hashes and addresses in base64, where lncli prints hex
+def _invoice_result(invoice):
+    return dict(invoice, **{key: _base64_to_hex(invoice[key]) for key in ('r_hash', 'payment_addr') if invoice.get(key)})
+
+# lncli subcommand -> function(args, flags) returning (HTTP method, path, JSON body)
+REST_ROUTES = {
+    'getinfo': lambda args, flags: ('GET', '/v1/getinfo', None),
+    'listchannels': lambda args, flags: ('GET', '/v1/channels', None),
+    'feereport': lambda args, flags: ('GET', '/v1/fees', None),
+    'describegraph': lambda args, flags: ('GET', '/v1/graph', None),
+    'getchaninfo': lambda args, flags: ('GET', f"/v1/graph/edge/{args[0]}", None),
+    'getnodeinfo': lambda args, flags: ('GET', f"/v1/graph/node/{args[0]}", None),
+    'fwdinghistory': lambda args, flags: ('POST', '/v1/switch', {
+        'start_time': str(flags.get('start_time', 0)),
+        'end_time': str(flags.get('end_time', 0)),
+        'index_offset': int(flags.get('index_offset', 0)),
+        'num_max_events': int(flags.get('max_events', 100)),
+    }),
+    'updatechanpolicy': lambda args, flags: ('POST', '/v1/chanpolicy', _chanpolicy_body(flags)),
+    'listinvoices': lambda args, flags: ('GET', '/v1/invoices?' + urlencode({'pending_only': 'true' if flags.get('pending_only') else 'false'}), None),
+    'addinvoice': lambda args, flags: ('POST', '/v1/invoices', _addinvoice_body(args, flags)),
+    'cancelinvoice': lambda args, flags: ('POST', '/v2/invoices/cancel', {'payment_hash': _hex_to_base64(args[0])}),
+    'payinvoice': lambda args, flags: ('POST', '/v1/channels/transactions', _payinvoice_body(args, flags)),
+    'sendpayment': lambda args, flags: ('POST', '/v1/channels/transactions', _sendpayment_body(flags)),
+    'buildroute': lambda args, flags: ('POST', '/v2/router/route', _buildroute_body(flags)),
+    'sendtoroute': lambda args, flags: ('POST', '/v2/router/route/send', _sendtoroute_body(flags)),
+}
+
+# Streaming subscriptions, answered with one JSON message per line
+REST_STREAMS = {
+    'subscribehtlcevents': '/v2/router/htlcevents',
+    'subscribechannelevents': '/v1/channels/subscribe',
+    'subscribechannelgraph': '/v1/graph/subscribe',
+}
+
+# Responses that need reshaping to match what lncli prints
+REST_RESULTS = {
+    'payinvoice': _payinvoice_result,
+    'sendpayment': _payinvoice_result,
+    'addinvoice': _invoice_result,
+    'buildroute': _buildroute_result,
+    'listinvoices': lambda response: dict(response, invoices=[_invoice_result(invoice) for invoice in response.get('invoices', [])]),
+}
+
+class RestBackend(NodeClient):
+    def __init__(self, host="localhost:8080", macaroon_path=None, tls_cert_path=None, timeout=60):
+        self.host = host
+        self.timeout = timeout
+        self.headers = {'Content-Type': 'application/json'}
+        if macaroon_path:
+            with open(os.path.expanduser(macaroon_path), 'rb') as file:
+                self.headers['Grpc-Metadata-macaroon'] = file.read().hex()
+        # Without a TLS certificate the connection is plain HTTP, as used by local stand-ins
+        self.ssl_context = ssl.create_default_context(cafile=os.path.expanduser(tls_cert_path)) if tls_cert_path else None
+        if self.ssl_context:
+            self.ssl_context.check_hostname = False
+        # One persistent connection per thread, so the client can be shared by worker threads
+        self.local = threading.local()
+
+    def _connect(self):
+        if self.ssl_context:
+            return http.client.HTTPSConnection(self.host, timeout=self.timeout, context=self.ssl_context)
+        return http.client.HTTPConnection(self.host, timeout=self.timeout)
+
+    def call(self, command, *args, **flags):
+        if command not in REST_ROUTES:
+            raise NodeError(f"Command {command} is not supported by the REST backend")
+        method, path, body = REST_ROUTES[command](args, flags)
+        payload = json.dumps(body) if body is not None else None
+
+        # Reuse the open connection; reconnect once if the server dropped it
+        for attempt in range(2):
+            if getattr(self.local, 'conn', None) is None:
+                self.local.conn = self._connect()
+            try:
+                self.local.conn.request(method, path, body=payload, headers=self.headers)
+                response = self.local.conn.getresponse()
+                data = response.read()
+                break
+            except (http.client.HTTPException, ConnectionError):
+                self.close()
+                if attempt:
+                    raise
+
+        result = json.loads(data) if data else {}
+        if response.status != 200:
+            raise NodeError(result.get('message') or result.get('error') or f"HTTP {response.status}")
+        if command in REST_RESULTS:
+            result = REST_RESULTS[command](result)
+        return result
+
+    # Each subscription has its own connection, without a timeout, as events may be hours apart
+    def subscribe(self, command):
+        if command not in REST_STREAMS:
+            raise NodeError(f"Subscription {command} is not supported by the REST backend")
+        conn = self._connect()
+        conn.timeout = None
+        try:
+            conn.request('GET', REST_STREAMS[command], headers=self.headers)
+            response = conn.getresponse()
+            if response.status != 200:
+                raise NodeError(f"HTTP {response.status} subscribing to {command}")
+            for line in response:
+                if not line.strip():
+                    continue
+                message = json.loads(line)
+                if 'error' in message:
+                    raise NodeError(message['error'].get('message') or str(message['error']))
+                yield message.get('result', message)
+        finally:
+            conn.close()
+
+    def close(self):
+        if getattr(self.local, 'conn', None) is not None:
+            self.local.conn.close()
+            self.local.conn = None
+
+# Function to create a node client from configuration values
+def create_node_client(backend="lncli", lncli_path="lncli", rest_host="localhost:8080", macaroon_path=None, tls_cert_path=None):
+    if backend == "lncli":
+        return LncliBackend(lncli_path)
+    if backend == "rest":
+        return RestBackend(rest_host, macaroon_path, tls_cert_path)
+    raise ValueError(f"Unknown node backend: {backend}")
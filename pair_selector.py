@@ -0,0 +1,97 @@
+# Scoring of (source, target) channel pairs for rebalancing.
+# Pairs are ranked by how much imbalance they can fix, their success rate and fees
+# so far, and a penalty for recent failures, and are served best first from a
+# priority queue. Invoice sizes are fitted to the actual surplus and deficit. The
+# history starts from the attempts of earlier runs, read from the attempt log.
+
+import heapq
+import itertools
+
+class PairSelector:
+    def __init__(self, min_amount, max_amount, prior_fee_ppm=500, failure_penalty=0.5, failure_decay=0.5):
+        self.min_amount = min_amount
+        self.max_amount = max_amount
+        self.prior_fee_ppm = prior_fee_ppm      # Assumed fee rate for pairs that have never succeeded
+        self.failure_penalty = failure_penalty  # Score multiplier per recent failure
+        self.failure_decay = failure_decay      # Recent failures are multiplied by this after each round
+        self.history = {}
+
+    def _stats(self, source, target):
+        return self.history.setdefault((source, target), {'attempts': 0, 'successes': 0, 'amount': 0, 'fees': 0, 'recent_failures': 0.0})
+
+    # Function to seed the history from an AttemptLog, so each run starts from the attempts of earlier runs
+    def fit(self, attempt_log):
+        self.history = {}
+        for source, target, attempts, successes, amount, fees in attempt_log.pair_totals():
+            self._stats(source, target).update(attempts=attempts, successes=successes, amount=amount, fees=fees)
+        return self
+
+    # Function to size an invoice to the smaller of the source's surplus and the target's deficit
+    def invoice_amount(self, surplus, deficit):
+        amount = min(surplus, deficit, self.max_amount) // 1000 * 1000
+        return amount if amount >= self.min_amount else 0
+
+    def success_rate(self, source, target):
+        stats = self.history.get((source, target))
+        if stats is None:
+            return 0.5
+        return (stats['successes'] + 1) / (stats['attempts'] + 2)
+
+    def fee_ppm(self, source, target):
+        stats = self.history.get((source, target))
+        if not stats or not stats['amount']:
+            return self.prior_fee_ppm
+        return stats['fees'] * 1000000 / stats['amount']
+
+    # Expected sats rebalanced per attempt, discounted by the fee rate and recent failures
+    def score(self, source, target, amount):
+        stats = self.history.get((source, target))
+        recent_failures = stats['recent_failures'] if stats else 0
+        return amount * self.success_rate(source, target) * self.failure_penalty ** recent_failures / (1 + self.fee_ppm(source, target) / 1000)
+
+    def record(self, source, target, amount, succeeded, fee_sat=None):
+        stats = self._stats(source, target)
+        stats['attempts'] += 1
+        if succeeded:
+            stats['successes'] += 1
+            if fee_sat is not None:
+                stats['amount'] += amount
+                stats['fees'] += fee_sat
+            stats['recent_failures'] = 0.0
+        else:
+            stats['recent_failures'] += 1
+
+    def end_round(self):
+        for stats in self.history.values():
+            stats['recent_failures'] *= self.failure_decay
+
+# Priority queue of candidates, lowest priority value first. Candidates that are not
+# ready yet are set aside and kept for later pops.
+class CandidateQueue:
+    def __init__(self, candidates=()):
+        self.counter = itertools.count()
+        self.heap = [(priority, next(self.counter), item) for priority, item in candidates]
+        heapq.heapify(self.heap)
+
+    def __len__(self):
+        return len(self.heap)
+
+    def push(self, priority, item):
+        heapq.heappush(self.heap, (priority, next(self.counter), item))
+
+    # Pop the best candidate for which is_ready(item) is true, or None
+    def pop_first(self, is_ready):
+        skipped = []
+        found = None
+        while self.heap:
+            entry = heapq.heappop(self.heap)
+            if is_ready(entry[2]):
+                found = entry[2]
+                break
+            skipped.append(entry)
+        for entry in skipped:
+            heapq.heappush(self.heap, entry)
+        return found
+
+    def clear(self):
+        self.heap = []
@@ -0,0 +1,113 @@
+# Per-channel Q-table held sparsely: only (channel, state) pairs that have been
+# visited are stored, as a sorted array of uint64 keys and a matching array of
+# action values, so thousands of channels times thousands of states cost memory
+# only for what is used. Lookups and updates are vectorized with searchsorted.
+#
+# A state combines the channel's fee rate, its local liquidity ratio and the
+# recent direction of its forwarding flow. Tables are saved as .npy files and
+# loaded memory-mapped.
+
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+FEE_BUCKET_PPM = 10  # Width of a fee rate bucket, in ppm
+FEE_BUCKETS = 1001  # Fee rates up to 10,000 ppm (1%) are distinguished
+LIQUIDITY_BUCKETS = 10  # Local balance as a fraction of capacity, in tenths
+FLOW_BUCKETS = 3  # Net inbound, balanced or inactive, net outbound
+NUM_STATES = FEE_BUCKETS * LIQUIDITY_BUCKETS * FLOW_BUCKETS
+
+# Function to encode fee rates (ppm), local liquidity ratios (0 to 1) and net flows into state indices
+def encode_states(fee_ppm, local_ratio, net_flow):
+    fee_bucket = np.minimum(np.asarray(fee_ppm, dtype=np.float64) // FEE_BUCKET_PPM, FEE_BUCKETS - 1).astype(np.int64)
+    liquidity_bucket = np.clip((np.asarray(local_ratio, dtype=np.float64) * LIQUIDITY_BUCKETS).astype(np.int64), 0, LIQUIDITY_BUCKETS - 1)
+    flow_bucket = np.sign(np.asarray(net_flow)).astype(np.int64) + 1
+    return (fee_bucket * LIQUIDITY_BUCKETS + liquidity_bucket) * FLOW_BUCKETS + flow_bucket
+
+class SparseQTable:
+    def __init__(self, num_actions, keys=None, values=None, channels=None, pending=None):
+        self.num_actions = num_actions
+        self.keys = keys if keys is not None else np.zeros(0, dtype=np.uint64)
+        self.values = values if values is not None else np.zeros((0, num_actions))
+        self.channels = channels or {}  # chan_id -> channel index used in keys
+        self.pending = pending or {}  # chan_id -> [state, action, time taken] chosen on the last run, awaiting its reward
+
+    def __len__(self):
+        return len(self.keys)
+
+    def channel_indices(self, chan_ids):
+        for chan_id in chan_ids:
+            if chan_id not in self.channels:
+                self.channels[chan_id] = len(self.channels)
+        return np.array([self.channels[chan_id] for chan_id in chan_ids], dtype=np.uint64)
+
+    def make_keys(self, chan_ids, states):
+        return (self.channel_indices(chan_ids) << np.uint64(32)) | np.asarray(states, dtype=np.uint64)
+
+    def _positions(self, keys):
+        positions = np.searchsorted(self.keys, keys)
+        found = positions < len(self.keys)
+        found[found] = self.keys[positions[found]] == keys[found]
+        return positions, found
+
+    # Action values for each key; states never visited are all zeros
+    def lookup(self, keys):
+        positions, found = self._positions(keys)
+        values = np.zeros((len(keys), self.num_actions))
+        values[found] = self.values[positions[found]]
+        return values
+
+    def _insert(self, keys):
+        keys = np.setdiff1d(np.unique(keys), self.keys, assume_unique=True)
+        if len(keys):
+            merged = np.concatenate((self.keys, keys))
+            order = np.argsort(merged, kind='stable')
+            self.keys = merged[order]
+            self.values = np.concatenate((self.values, np.zeros((len(keys), self.num_actions))))[order]
+
+    # Q-learning update of Q(key, action) towards target, for all keys at once
+    def update(self, keys, actions, targets, alpha):
+        self._insert(keys)
+        positions, found = self._positions(keys)
+        actions = np.asarray(actions, dtype=np.int64)
+        self.values[positions, actions] = (1 - alpha) * self.values[positions, actions] + alpha * np.asarray(targets)
+
+    # Save atomically: the arrays go to a new folder, named in meta.json, and replacing meta.json
+    # is the single step that switches to them, so a crash leaves the old table or the new one
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        arrays = f"arrays-{time.time_ns()}"
+        os.makedirs(os.path.join(directory, arrays))
+        for name, array in (('keys', self.keys), ('values', self.values)):
+            np.save(os.path.join(directory, arrays, f"{name}.npy"), np.ascontiguousarray(array))
+        with open(os.path.join(directory, 'meta.tmp.json'), mode='w') as file:
+            json.dump({'num_actions': self.num_actions, 'arrays': arrays, 'channels': self.channels, 'pending': self.pending}, file)
+        os.replace(os.path.join(directory, 'meta.tmp.json'), os.path.join(directory, 'meta.json'))
+
+        # Earlier arrays, including those of tables saved before meta.json named a folder
+        for name in os.listdir(directory):
+            if name.startswith('arrays-') and name != arrays:
+                shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+            elif name in ('keys.npy', 'values.npy'):
+                os.remove(os.path.join(directory, name))
+
+    # Load memory-mapped, copy-on-write: only pages that are read are loaded, and the files are not modified
+    @classmethod
+    def load(cls, directory, num_actions):
+        if not os.path.isfile(os.path.join(directory, 'meta.json')):
+            return cls(num_actions)
+        with open(os.path.join(directory, 'meta.json')) as file:
+            meta = json.load(file)
+        arrays = os.path.join(directory, meta.get('arrays', ''))
+        keys, values = (_load_array(os.path.join(arrays, name)) for name in ('keys.npy', 'values.npy'))
+        return cls(meta['num_actions'], keys, values, meta['channels'], meta['pending'])
+
+def _load_array(path):
+    try:
+        return np.load(path, mmap_mode='c')
+    except ValueError:
+        # Empty arrays cannot be memory-mapped
+        return np.load(path)
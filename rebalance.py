@@ -1,17 +1,37 @@
-import subprocess
-import re
 import json
+import logging
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+
+from alias_cache import AliasCache
+from pair_selector import CandidateQueue, PairSelector
+from attempt_log import AttemptLog, FeeLimitModel
+from instrumentation import InstrumentedClient, Metrics, configure_logging, profiled
+from invoice_pool import InvoicePool, new_keysend
+from node_client import KEYSEND_RECORD, NodeError, create_node_client, payment_fee_sat, payment_route_length, payment_succeeded
 
 # Script to rebalance Lightning Network channels using lncli commands.
 # This script fetches the current channel balances, identifies channels that need rebalancing,
-# and attempts to rebalance them by creating and paying invoices.
+# and attempts to rebalance them by paying our own node, to an invoice from a reusable pool or
+# by keysend, with one payment call per attempt: over circular routes planned locally from the
+# channel graph and sent with sendtoroute, or by leaving lnd to find a route.
 # If rebalancing fails due to insufficient balance, the fee limit is incrementally increased
 # and the process is retried.
 
 # Configuration parameters
+DEBUG = True              # Log debug messages and command output; when False they are dropped before being formatted
+NODE_BACKEND = "lncli"    # "lncli" to run the lncli binary, "rest" to use lnd's REST API over a persistent connection
+LNCLI_PATH = "lncli"      # Path to lncli, used when NODE_BACKEND is "lncli"
+REST_HOST = "localhost:8080"  # lnd REST API address, used when NODE_BACKEND is "rest"
+MACAROON_PATH = "~/.lnd/data/chain/bitcoin/mainnet/admin.macaroon"  # Used when NODE_BACKEND is "rest"
+TLS_CERT_PATH = "~/.lnd/tls.cert"  # Used when NODE_BACKEND is "rest"
+
 max_fee = 150             # Initial maximum fee limit in satoshis
-invoice_size = 500000     # Size of the invoice to create for rebalancing
-force = "--force"         # Force the payment to be sent, even if it is risky
+invoice_size = 500000     # Size of the invoice to create for rebalancing (the largest size when PAIR_SELECTION is "scored")
+min_invoice_size = 50000  # Smallest invoice to create when sizing invoices to the actual surplus and deficit
+force = True              # Force the payment to be sent, even if it is risky
 timeout = "15s"           # Timeout for the payment attempt
 fee_increment = 10        # Increment value for fee limit if rebalancing fails
 fee_decrement = 5         # Decrement value for fee limit if rebalancing succeeds
@@ -21,72 +41,209 @@ TOLERABLE_LOW_RATIO = 0.33    # Ratio below which a channel is considered underb
 
 SUCCEEDED_MAX = 20            # Maximum number of successful rebalances
 ATTEMPTED_MAX = 250           # Maximum number of rebalance attempts
+PAIR_SELECTION = "ordered"    # "ordered" for channel order and fixed invoices, "scored" to try the most promising pairs first with fitted invoice sizes (see benchmarks/bench_pair_selection.py)
+CONCURRENCY = 4               # Maximum number of rebalance payments in flight at once, over disjoint channel pairs
+RESYNC_INTERVAL = 300         # Seconds between full channel resyncs from the node; balances are tracked locally in between
+ATTEMPT_LOG_FILE = "rebalance_attempts.db"  # Append-only log of every rebalance attempt, kept across runs
+FEE_MODEL = True              # Set fee limits per pair from the attempt log, falling back to the global fee limit
+TARGET_SUCCESS_PROBABILITY = 0.5  # Lowest estimated success probability accepted when picking a pair's fee limit
+ALIAS_CACHE_FILE = "node_aliases.db"  # Persistent cache of peer aliases, shared with fee_setting_agent.py
+ALIAS_CACHE_TTL = 7 * 86400   # Seconds before a cached alias is fetched again
+ALIAS_CACHE_MAX_ENTRIES = 10000  # Least recently used aliases are evicted beyond this
+METRICS_FILE = None           # Set to a file name to append per-round node command and stage timings, as JSON lines
+PROMETHEUS_FILE = None        # Set to a file name to write the timings in Prometheus text format, e.g. for node_exporter's textfile collector
+PROFILE_DIR = None            # Set to a folder to save a cProfile profile of the run
+REBALANCE_PAYMENT = "pool"    # "pool" to pay amountless invoices from a reusable pool, "keysend" to keysend to our own node (needs lnd's accept-keysend)
+INVOICE_POOL_FILE = "rebalance_invoices.json"  # Pooled invoices kept across runs, and stale ones still to cancel
+INVOICE_POOL_SIZE = 4         # Invoices kept ready, at least CONCURRENCY so attempts never create one themselves
+INVOICE_MAX_AGE = 6 * 86400   # Seconds before a pooled invoice is cancelled in the background rather than paid again
+ROUTE_PLANNER = True          # Plan circular routes locally and pay them with sendtoroute; False lets payinvoice or sendpayment find a route
+ROUTE_CANDIDATES = 3          # Cheapest routes within the fee limit to try per attempt
+GRAPH_CACHE_FILE = "channel_graph.npz"  # Cached channel graph for the route planner, so describegraph runs at most every GRAPH_MAX_AGE
+GRAPH_MAX_AGE = 6 * 3600      # Seconds before the whole channel graph is fetched again; updates are followed in between where the backend streams them
+ROUTE_FAILURES_FILE = "route_failures.json"  # Channels recent payments failed at, which routes avoid for a while
 
 SUCCEEDED_COUNT = 0           # Counter for successful rebalances
 ATTEMPTED_COUNT = 0           # Counter for rebalance attempts
-
-# Function to run shell commands and return the output
-def run_command(command):
-    print(f"Running command: {command}")
-    result = subprocess.run(command, shell=True, capture_output=True, text=True)
-    print(f"Command output: {result.stdout.strip()}")
-    return result.stdout.strip()
-
-# Function to print debug messages
-def debug_message(message):
-    print(f"DEBUG: {message}")
-
-# Function to get node aliases using lncli describegraph
-def get_node_aliases():
-    nodes_json = run_command("lncli describegraph")
-    nodes_data = json.loads(nodes_json)
-    aliases = {}
-
-    for node in nodes_data['nodes']:
-        pubkey = node['pub_key']
-        alias = node['alias']
-        aliases[pubkey] = alias
-
-    return aliases
-
-# Fetch channel data and map public keys to aliases
-channels_json = run_command("lncli listchannels")
-channels_data = json.loads(channels_json)
-node_aliases = get_node_aliases()
-mapping = {}
-
-for channel in channels_data['channels']:
-    chan_id = channel['chan_id']
-    pubkey = channel['remote_pubkey']
-    alias = node_aliases.get(pubkey, pubkey)  # Use alias if available, else pubkey
-    mapping[chan_id] = {'pubkey': pubkey, 'alias': alias}
-    debug_message(f"Mapped channel ID {chan_id} to pubkey {pubkey} and alias {alias}")
-
-debug_message(f"Final channel to pubkey mapping: {mapping}")
-
-# Function to get current channel balances
-def get_channel_balances():
-    channels_json = run_command("lncli listchannels")
-    channels_data = json.loads(channels_json)
-    channel_balances = []
-
-    for channel in channels_data['channels']:
-        chan_id = channel['chan_id']
-        local_balance = int(channel['local_balance'])
-        remote_balance = int(channel['remote_balance'])
-        pubkey = channel['remote_pubkey']
-        name = node_aliases.get(pubkey, pubkey)
-        channel_balances.append({
-            'chan_id': chan_id,
-            'local_balance': local_balance,
-            'remote_balance': remote_balance,
-            'name': name
-        })
-
-    return channel_balances
-
-# Function to rebalance a channel by creating and paying an invoice
-def rebalance_channel(fee_limit, chan_id, pubkey, invsize, force, timeout, memo):
+REBALANCED_AMOUNT = 0         # Total satoshis rebalanced successfully
+
+logger = logging.getLogger("rebalance")
+metrics = None  # Node command and stage timings, created on first use
+client = None  # Node client, created on first use unless set beforehand, as fleet.py and the benchmarks do
+
+# Function to get the timings of node commands and run stages
+def get_metrics():
+    global metrics
+    if metrics is None:
+        metrics = Metrics("rebalance", METRICS_FILE, PROMETHEUS_FILE)
+    return metrics
+
+# Function to get the node client for the configured backend, timing every command
+def get_client():
+    global client
+    if client is None:
+        client = InstrumentedClient(create_node_client(NODE_BACKEND, LNCLI_PATH, REST_HOST, MACAROON_PATH, TLS_CERT_PATH), get_metrics())
+    return client
+
+# Function to run node commands and return the parsed output
+def run_command(command, *args, **flags):
+    logger.info("Running command: %s", get_client().format_command(command, *args, **flags))
+    result = get_client().call(command, *args, **flags)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Command output: %s", json.dumps(result))
+    return result
+
+# Function to log debug messages, formatted only when DEBUG is on
+def debug_message(message, *args):
+    logger.debug("DEBUG: " + message, *args)
+
+# In-memory view of our channels, loaded once and updated from payment results.
+# It resyncs from the node every RESYNC_INTERVAL seconds, or sooner when a payment
+# result does not match what the local view predicted.
+class ChannelState:
+    def __init__(self, resync_interval=None):
+        self.resync_interval = RESYNC_INTERVAL if resync_interval is None else resync_interval
+        self.channels = {}
+        self.aliases = AliasCache(ALIAS_CACHE_FILE, ALIAS_CACHE_TTL, ALIAS_CACHE_MAX_ENTRIES)
+        self.last_sync = None
+        self.stale = True
+        self.lock = threading.Lock()
+
+    # Function to fetch a peer's alias with getnodeinfo, on an alias cache miss; None if it fails
+    @staticmethod
+    def fetch_alias(pubkey):
+        try:
+            return run_command("getnodeinfo", pubkey)['node'].get('alias', '')
+        except NodeError as error:
+            debug_message("No node info for %s: %s", pubkey, error)
+            return None
+
+    def sync(self):
+        channels_data = run_command("listchannels")
+        aliases = self.aliases.get_many([channel['remote_pubkey'] for channel in channels_data['channels']], self.fetch_alias)
+        channels = {}
+        for channel in channels_data['channels']:
+            chan_id = channel['chan_id']
+            pubkey = channel['remote_pubkey']
+            channels[chan_id] = {
+                'pubkey': pubkey,
+                'alias': aliases.get(pubkey) or pubkey,  # Use alias if available, else pubkey
+                'local_balance': int(channel['local_balance']),
+                'remote_balance': int(channel['remote_balance']),
+            }
+        with self.lock:
+            self.channels = channels
+            self.last_sync = time.monotonic()
+            self.stale = False
+        debug_message("Synced %d channels from the node", len(channels))
+
+    # Function to resync from the node if the local view is stale or too old; returns whether it did
+    def refresh(self):
+        if self.stale or time.monotonic() - self.last_sync >= self.resync_interval:
+            self.sync()
+            return True
+        return False
+
+    def mark_stale(self, reason):
+        debug_message("Channel state needs a resync: %s", reason)
+        with self.lock:
+            self.stale = True
+
+    @property
+    def mapping(self):
+        with self.lock:
+            return {chan_id: {'pubkey': channel['pubkey'], 'alias': channel['alias']} for chan_id, channel in self.channels.items()}
+
+    # Function to get current channel balances
+    def get_channel_balances(self):
+        with self.lock:
+            return [{'chan_id': chan_id, 'local_balance': channel['local_balance'], 'remote_balance': channel['remote_balance'], 'name': channel['alias']}
+                    for chan_id, channel in self.channels.items()]
+
+    # Function to update the two channels touched by a rebalance payment
+    def apply_payment(self, source, target, amount, result):
+        if payment_succeeded(result):
+            fee = payment_fee_sat(result)
+            if fee is None:
+                self.mark_stale("payment result did not report the fee paid")
+                return
+            with self.lock:
+                self.channels[source]['local_balance'] -= amount + fee
+                self.channels[source]['remote_balance'] += amount + fee
+                self.channels[target]['local_balance'] += amount
+                self.channels[target]['remote_balance'] -= amount
+        elif 'INSUFFICIENT_BALANCE' in str(result.get('failure_reason', '')):
+            # Attempts are only made when the local view shows enough liquidity
+            self.mark_stale(f"payment from {source} failed for insufficient balance")
+
+# Function to set up the route planner: the channel graph from its cache or describegraph,
+# kept current in a background thread where the node streams graph updates. The planner
+# needs NumPy, so it is only imported when routes are planned locally.
+def load_route_planner(node_info):
+    from route_planner import RouteFailures, RoutePlanner, load_channel_graph
+    graph = load_channel_graph(get_client(), GRAPH_CACHE_FILE, GRAPH_MAX_AGE)
+    threading.Thread(target=graph.follow, args=(get_client(),), daemon=True).start()
+    debug_message("Channel graph has %d nodes and %d channel directions", graph.num_nodes, graph.num_edges)
+    planner = RoutePlanner(graph, node_info['identity_pubkey'], RouteFailures(ROUTE_FAILURES_FILE))
+    planner.block_height = node_info.get('block_height')
+    return planner
+
+# How rebalances pay our own node: to an amountless invoice from the pool, or by keysend
+# when there is no pool, over planned routes when there is a route planner
+class SelfPayer:
+    def __init__(self, our_pubkey, pool=None, planner=None):
+        self.our_pubkey = our_pubkey
+        self.pool = pool
+        self.planner = planner
+
+    # Function to get the secret of one payment: a pooled invoice, or a keysend preimage and hash
+    def take(self):
+        return self.pool.take() if self.pool else new_keysend()
+
+    def put_back(self, secret, outcome):
+        if self.pool:
+            self.pool.put_back(secret, outcome)
+
+# Function to turn a planned route into one for sendtoroute, locally, or with buildroute when
+# the route's channel back to us is private and so not in the graph
+def build_route(planner, route, secret, chan_id, invsize):
+    built = planner.build_route(route, chan_id, invsize, planner.block_height, secret.get('payment_addr'), secret.get('preimage'))
+    if built is not None:
+        return built
+    built = run_command("buildroute", amt=invsize, hops=','.join(route['hops']), outgoing_chan_id=chan_id,
+                        payment_addr=secret.get('payment_addr'))['route']
+    if secret.get('preimage'):
+        built['hops'][-1]['custom_records'] = {KEYSEND_RECORD: secret['preimage']}
+    return built
+
+# Function to pay over planned circular routes, one at a time with sendtoroute, until one
+# succeeds. Failures are fed back to the planner.
+def pay_planned_routes(planner, routes, secret, fee_limit, chan_id, invsize):
+    failure_reason = 'FAILURE_REASON_NO_ROUTE'
+    attempts = []
+    for route in routes:
+        try:
+            built = build_route(planner, route, secret, chan_id, invsize)
+            # lnd picks among parallel channels itself, which may cost more than planned
+            if int(built['total_fees_msat']) > fee_limit * 1000:
+                failure_reason = 'FAILURE_REASON_NO_ROUTE: built route is over the fee limit'
+                continue
+            attempt = run_command("sendtoroute", payment_hash=secret['r_hash'], routes=json.dumps({'route': built}))
+        except NodeError as error:
+            failure_reason = str(error)
+            continue
+        attempts.append(attempt)
+        failure_reason = planner.record_attempt(attempt, invsize)
+        if attempt.get('status') == 'SUCCEEDED':
+            return {'status': 'SUCCEEDED', 'fee_sat': str(int(attempt['route']['total_fees_msat']) // 1000), 'htlcs': attempts}
+        if 'INSUFFICIENT_BALANCE' in failure_reason or 'destination' in failure_reason:
+            break  # Other routes out of the same channel to the same invoice would fail the same way
+    return {'status': 'FAILED', 'failure_reason': failure_reason, 'htlcs': attempts}
+
+# Function to rebalance a channel by paying our own node from it, over planned routes when
+# the payer has a route planner. The payment comes back in from the peer pubkey, over the
+# channel last_chan_id when it is given.
+def rebalance_channel(fee_limit, chan_id, pubkey, invsize, force, timeout, memo, payer, first_hop=None, last_chan_id=None):
     print(f"Fee limit is {fee_limit}")
     print(f"Channel ID is {chan_id}")
     print(f"Pub key is {pubkey}")
@@ -95,53 +252,81 @@ def rebalance_channel(fee_limit, chan_id, pubkey, invsize, force, timeout, memo)
     print(f"TIMEOUT is {timeout}")
     print(f"MEMO is {memo}")
 
-    # Clean existing pending invoices
-    pending_invoices = run_command("lncli listinvoices --pending_only | grep r_hash")
-    for line in pending_invoices.splitlines():
-        r_hash = re.search(r'"r_hash": "([^"]+)"', line)
-        if r_hash:
-            cancel_command = f"lncli cancelinvoice {r_hash.group(1)}"
-            run_command(cancel_command)
-
-    # Create a new invoice and self-pay it
-    addinvoice_command = f"lncli addinvoice {invsize} --memo {memo}"
-    invoice_output = run_command(addinvoice_command)
-    payment_request = re.search(r'"payment_request": "([^"]+)"', invoice_output)
-
-    if payment_request:
-        payinvoice_command = (
-            f"lncli payinvoice --allow_self_payment --fee_limit {fee_limit} --outgoing_chan_id {chan_id} "
-            f"--last_hop {pubkey} --timeout {timeout} {payment_request.group(1)} {force}"
-        )
-        return run_command(payinvoice_command)
+    # Without a route within the fee limit there is nothing to pay
+    planner = payer.planner
+    if planner is not None:
+        with get_metrics().stage('plan'):
+            routes = planner.circular_routes(first_hop, pubkey, invsize, fee_limit, ROUTE_CANDIDATES, last_chan_id)
+        debug_message("Planned %d routes within %s sats: %s", len(routes), fee_limit, routes)
+        if not routes:
+            return {'status': 'FAILED', 'failure_reason': 'FAILURE_REASON_NO_ROUTE'}
+
+    try:
+        secret = payer.take()
+    except NodeError as error:
+        return {'status': 'FAILED', 'failure_reason': f"Failed to create invoice: {error}"}
+
+    # A payment call that errors may still be in flight, and an invoice the node does not know
+    # is gone, so neither is paid again
+    try:
+        if planner is not None:
+            out = pay_planned_routes(planner, routes, secret, fee_limit, chan_id, invsize)
+        elif payer.pool is None:
+            out = run_command("sendpayment", dest=payer.our_pubkey, amt=invsize, keysend=True, allow_self_payment=True, fee_limit=fee_limit,
+                              outgoing_chan_id=chan_id, last_hop=pubkey, timeout=timeout, force=force)
+        else:
+            out = run_command("payinvoice", secret['payment_request'], amt=invsize, allow_self_payment=True, fee_limit=fee_limit,
+                              outgoing_chan_id=chan_id, last_hop=pubkey, timeout=timeout, force=force)
+    except NodeError as error:
+        payer.put_back(secret, 'UNKNOWN')
+        return {'status': 'FAILED', 'failure_reason': str(error)}
+    if payment_succeeded(out):
+        payer.put_back(secret, 'SUCCEEDED')
     else:
-        return "Failed to create invoice"
-
-# Main loop to attempt rebalancing until success criteria are met
-current_fee_limit = max_fee
-
-while SUCCEEDED_COUNT < SUCCEEDED_MAX and ATTEMPTED_COUNT < ATTEMPTED_MAX:
-    debug_message(f"Starting loop iteration with SUCCEEDED_COUNT={SUCCEEDED_COUNT} and ATTEMPTED_COUNT={ATTEMPTED_COUNT}")
-
-    print("At start of loop - getting current channel balances")
-    print(f"Successful rebalances {SUCCEEDED_COUNT}, Total {SUCCEEDED_COUNT * invoice_size}")
-    print(f"Attempts {ATTEMPTED_COUNT}")
-
+        payer.put_back(secret, 'UNKNOWN' if 'INCORRECT' in str(out.get('failure_reason', '')) else 'FAILED')
+    return out
+
+# Tracks which channels have a payment in flight and how much of their local balance it may spend,
+# so concurrent attempts never share a channel or drain the same source channel
+class LiquidityReservations:
+    def __init__(self, channel_balances):
+        self.local = {channel['chan_id']: channel['local_balance'] for channel in channel_balances}
+        self.remote = {channel['chan_id']: channel['remote_balance'] for channel in channel_balances}
+        self.reserved = {}
+        self.busy = set()
+        self.lock = threading.Lock()
+
+    def is_busy(self, source, target):
+        with self.lock:
+            return source in self.busy or target in self.busy
+
+    def has_liquidity(self, source, target, amount, fee_limit):
+        with self.lock:
+            available = self.local.get(source, 0) - self.reserved.get(source, 0)
+            return available >= amount + fee_limit and self.remote.get(target, 0) >= amount
+
+    def reserve(self, source, target, amount, fee_limit):
+        with self.lock:
+            self.busy.update((source, target))
+            self.reserved[source] = self.reserved.get(source, 0) + amount + fee_limit
+
+    def release(self, source, target, amount, fee_limit):
+        with self.lock:
+            self.busy.difference_update((source, target))
+            self.reserved[source] -= amount + fee_limit
+
+# Function to list (low, high) channel pairs to try, in the order the original loop tried them
+def get_candidate_pairs(channel_balances):
     rebalance = {}
     localhigh = {}
 
-    SUCCEEDED = False
-    ATTEMPTED_COUNT += 1
-
-    # Get current channel balances
-    channel_balances = get_channel_balances()
     for channel in channel_balances:
         chan_id = channel['chan_id']
         local = channel['local_balance']
         remote = channel['remote_balance']
         name = channel['name']
         ratio = (local + 1) / (remote + 1)
-        debug_message(f"Channel {name} ID is {chan_id} with local balance {local} and remote balance {remote}, ratio {ratio}")
+        debug_message("Channel %s ID is %s with local balance %s and remote balance %s, ratio %s", name, chan_id, local, remote, ratio)
 
         if ratio < TOLERABLE_LOW_RATIO:
             print(f"Needs rebalancing: Ratio is {ratio}\n")
@@ -149,46 +334,186 @@ while SUCCEEDED_COUNT < SUCCEEDED_MAX and ATTEMPTED_COUNT < ATTEMPTED_MAX:
         if ratio > TOLERABLE_HIGH_RATIO:
             localhigh[name] = {'ID': chan_id}
 
-    debug_message(f"Rebalance candidates: {rebalance}")
-    debug_message(f"Local high balance channels: {localhigh}")
-
-    for chan_id in mapping:
-        print(f"The pubkey for channel {chan_id} is {mapping[chan_id]['pubkey']}")
-
-    for name in rebalance:
-        print(f"Rebalancing {name}")
-        rebalance_chanid = rebalance[name]['ID']
-        print("Local balance low, trying to find partner with high local balance")
-        for highname in localhigh:
-            if highname != name:
-                datestr = run_command("date")
-                print(f"\t{datestr}")
-                print(f"\n\n\t*** Trying {highname} with {name} ***\n\n")
-                memo = f"{highname} to {name}".replace(' ', '_')
-                print(f"\n\n\t*** Memo: {memo} ***\n\n")
-                highchanid = localhigh[highname]['ID']
-                debug_message(f"High local balance channel ID: {highchanid}")
-                debug_message(f"Mapping contains high local balance channel ID: {highchanid in mapping}")
-                if highchanid in mapping:
-                    rebalance_pubkey = mapping[rebalance_chanid]['pubkey']  # Using rebalance_chanid to get the public key for receiving
-                    print(f"Using high local balance channel ID {highchanid} and local pub key {rebalance_pubkey}")
-
-                    # Rebalance the channel
-                    out = rebalance_channel(current_fee_limit, highchanid, rebalance_pubkey, invoice_size, force, timeout, memo)
-                    print(out)
-                    if "SUCCEEDED" in out:
-                        print("Rebalanced a channel ... run again!\n\n\n")
-                        SUCCEEDED = True
-                        SUCCEEDED_COUNT += 1
-                        break
-                    else:
-                        print(f"\n\t*** Succeeded count now {SUCCEEDED_COUNT} in {ATTEMPTED_COUNT} attempts ***\n\n")
-                else:
-                    print(f"Error: high local balance channel ID {highchanid} not found in mapping")
-
-        if SUCCEEDED:
-            current_fee_limit -= fee_decrement
-            break
-
-    if not SUCCEEDED:
-        current_fee_limit += fee_increment
+    debug_message("Rebalance candidates: %s", rebalance)
+    debug_message("Local high balance channels: %s", localhigh)
+
+    return [(name, rebalance[name]['ID'], highname, localhigh[highname]['ID'])
+            for name in rebalance for highname in localhigh if highname != name]
+
+# Function to build the queue of (pair, invoice size) candidates for a round
+def get_candidate_queue(channel_balances, selector):
+    pairs = get_candidate_pairs(channel_balances)
+    if PAIR_SELECTION != "scored":
+        return CandidateQueue((index, (pair, invoice_size)) for index, pair in enumerate(pairs))
+
+    balances = {channel['chan_id']: channel for channel in channel_balances}
+    candidates = []
+    for pair in pairs:
+        name, rebalance_chanid, highname, highchanid = pair
+        surplus = (balances[highchanid]['local_balance'] - balances[highchanid]['remote_balance']) // 2
+        deficit = (balances[rebalance_chanid]['remote_balance'] - balances[rebalance_chanid]['local_balance']) // 2
+        amount = selector.invoice_amount(surplus, deficit)
+        if amount:
+            candidates.append((-selector.score(highchanid, rebalance_chanid, amount), (pair, amount)))
+    return CandidateQueue(candidates)
+
+# Function to make one rebalance attempt from a high local balance channel to a low one
+def attempt_rebalance(mapping, fee_limit, amount, name, rebalance_chanid, highname, highchanid, payer):
+    datestr = datetime.now().strftime("%a %b %d %H:%M:%S %Y")
+    print(f"\t{datestr}")
+    print(f"\n\n\t*** Trying {highname} with {name} ***\n\n")
+    memo = f"{highname} to {name}".replace(' ', '_')
+    print(f"\n\n\t*** Memo: {memo} ***\n\n")
+    debug_message("High local balance channel ID: %s", highchanid)
+    debug_message("Mapping contains high local balance channel ID: %s", highchanid in mapping)
+    if highchanid not in mapping:
+        print(f"Error: high local balance channel ID {highchanid} not found in mapping")
+        return {'status': 'FAILED', 'failure_reason': 'channel not found in mapping'}
+
+    rebalance_pubkey = mapping[rebalance_chanid]['pubkey']  # Using rebalance_chanid to get the public key for receiving
+    print(f"Using high local balance channel ID {highchanid} and local pub key {rebalance_pubkey}")
+
+    # Rebalance the channel
+    out = rebalance_channel(fee_limit, highchanid, rebalance_pubkey, amount, force, timeout, memo, payer, mapping[highchanid]['pubkey'], rebalance_chanid)
+    print(out)
+    return out
+
+# Function to run one round of attempts, up to CONCURRENCY at a time, stopping at the first success.
+# Returns the number of successful rebalances and the satoshis they moved.
+def run_rebalance_round(state, selector, fee_limit, max_successes, payer, attempt_log=None, model=None):
+    mapping = state.mapping
+    channel_balances = state.get_channel_balances()
+    reservations = LiquidityReservations(channel_balances)
+    with get_metrics().stage('decide'):
+        candidates = get_candidate_queue(channel_balances, selector)
+    succeeded = 0
+    rebalanced = 0
+    in_flight = {}
+
+    def is_free(candidate):
+        name, rebalance_chanid, highname, highchanid = candidate[0]
+        return not reservations.is_busy(highchanid, rebalance_chanid)
+
+    with get_metrics().stage('apply'), ThreadPoolExecutor(max_workers=CONCURRENCY) as executor:
+        while candidates or in_flight:
+            # Start attempts on the best pairs whose channels are free, without exceeding the success budget
+            while not succeeded and len(in_flight) < min(CONCURRENCY, max_successes):
+                candidate = candidates.pop_first(is_free)
+                if candidate is None:
+                    break
+                (name, rebalance_chanid, highname, highchanid), amount = candidate
+                # Use the pair's fitted fee limit if it has enough history, else scale the
+                # global fee limit, which is set for a full size invoice, to this invoice
+                pair_fee_limit = model.fee_limit(highchanid, rebalance_chanid, amount) if model else None
+                if pair_fee_limit is None:
+                    pair_fee_limit = max(1, fee_limit * amount // invoice_size)
+                if not reservations.has_liquidity(highchanid, rebalance_chanid, amount, pair_fee_limit):
+                    debug_message("Skipping %s with %s: not enough liquidity for %s", highname, name, amount)
+                    continue
+                print(f"Rebalancing {name}")
+                print("Local balance low, trying to find partner with high local balance")
+                reservations.reserve(highchanid, rebalance_chanid, amount, pair_fee_limit)
+                future = executor.submit(attempt_rebalance, mapping, pair_fee_limit, amount, name, rebalance_chanid, highname, highchanid, payer)
+                in_flight[future] = (candidate, pair_fee_limit, time.monotonic())
+
+            if not in_flight:
+                break
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                ((name, rebalance_chanid, highname, highchanid), amount), pair_fee_limit, started = in_flight.pop(future)
+                reservations.release(highchanid, rebalance_chanid, amount, pair_fee_limit)
+                try:
+                    out = future.result()
+                except Exception as error:
+                    # The payment may or may not have been made, so the balances are re-read
+                    logger.exception("Error rebalancing %s with %s", highname, name)
+                    out = {'status': 'FAILED', 'failure_reason': f"Error in rebalance attempt: {error}"}
+                    state.mark_stale(f"attempt from {highchanid} raised {error!r}")
+                state.apply_payment(highchanid, rebalance_chanid, amount, out)
+                selector.record(highchanid, rebalance_chanid, amount, payment_succeeded(out), payment_fee_sat(out))
+                if model:
+                    model.update(highchanid, rebalance_chanid, amount, pair_fee_limit, payment_succeeded(out))
+                if attempt_log:
+                    attempt_log.append(highchanid, rebalance_chanid, amount, pair_fee_limit, payment_succeeded(out),
+                                       fee_paid=payment_fee_sat(out), route_length=payment_route_length(out),
+                                       failure_reason=out.get('failure_reason') or None, duration=time.monotonic() - started)
+                if payment_succeeded(out):
+                    print("Rebalanced a channel ... run again!\n\n\n")
+                    succeeded += 1
+                    rebalanced += amount
+
+            # Like the sequential loop, stop after a success so balances are re-read
+            if succeeded:
+                candidates.clear()
+
+    selector.end_round()
+    return succeeded, rebalanced
+
+# Main loop to attempt rebalancing until success criteria are met
+def main():
+    global SUCCEEDED_COUNT, ATTEMPTED_COUNT, REBALANCED_AMOUNT
+    SUCCEEDED_COUNT = ATTEMPTED_COUNT = REBALANCED_AMOUNT = 0  # Each call is a fresh run, as when a service calls it repeatedly
+
+    state = ChannelState()
+    with get_metrics().stage('fetch'):
+        state.sync()
+        node_info = run_command("getinfo")
+        planner = load_route_planner(node_info) if ROUTE_PLANNER else None
+    pool = InvoicePool(get_client(), INVOICE_POOL_FILE, INVOICE_POOL_SIZE, max_age=INVOICE_MAX_AGE) if REBALANCE_PAYMENT == "pool" else None
+    attempt_log = AttemptLog(ATTEMPT_LOG_FILE)
+
+    # The attempt log, invoice pool, route failures and graph are saved even if a round fails
+    try:
+        payer = SelfPayer(node_info['identity_pubkey'], pool, planner)
+        if pool:
+            pool.maintain_in_background()
+        mapping = state.mapping
+        debug_message("Final channel to pubkey mapping: %s", mapping)
+        for chan_id in mapping:
+            print(f"The pubkey for channel {chan_id} is {mapping[chan_id]['pubkey']}")
+
+        current_fee_limit = max_fee
+        selector = PairSelector(min_invoice_size, invoice_size).fit(attempt_log)
+        model = FeeLimitModel(target_probability=TARGET_SUCCESS_PROBABILITY).fit(attempt_log) if FEE_MODEL else None
+
+        while SUCCEEDED_COUNT < SUCCEEDED_MAX and ATTEMPTED_COUNT < ATTEMPTED_MAX:
+            debug_message("Starting loop iteration with SUCCEEDED_COUNT=%d and ATTEMPTED_COUNT=%d", SUCCEEDED_COUNT, ATTEMPTED_COUNT)
+
+            print("At start of loop - getting current channel balances")
+            print(f"Successful rebalances {SUCCEEDED_COUNT}, Total {REBALANCED_AMOUNT}")
+            print(f"Attempts {ATTEMPTED_COUNT}")
+
+            ATTEMPTED_COUNT += 1
+
+            # Resync channel balances from the node only when due, with the block height routes built locally need
+            with get_metrics().stage('fetch'):
+                if state.refresh() and planner:
+                    planner.block_height = run_command("getinfo").get('block_height')
+            succeeded, rebalanced = run_rebalance_round(state, selector, current_fee_limit, SUCCEEDED_MAX - SUCCEEDED_COUNT, payer, attempt_log, model)
+            # Stale invoices are cancelled, and the pool topped up, while the next round starts
+            if pool:
+                pool.maintain_in_background()
+            SUCCEEDED_COUNT += succeeded
+            REBALANCED_AMOUNT += rebalanced
+            print(f"\n\t*** Succeeded count now {SUCCEEDED_COUNT} in {ATTEMPTED_COUNT} attempts ***\n\n")
+            commands, stages = get_metrics().flush(round=ATTEMPTED_COUNT)
+            debug_message("Round timings: %s", get_metrics().summary(commands, stages))
+
+            if succeeded:
+                current_fee_limit -= fee_decrement
+            else:
+                current_fee_limit += fee_increment
+    finally:
+        attempt_log.close()
+        if pool:
+            pool.close()
+        if planner:
+            planner.failures.save()
+            if GRAPH_CACHE_FILE and planner.graph.changed:
+                planner.graph.save(GRAPH_CACHE_FILE)
+
+if __name__ == "__main__":
+    configure_logging(DEBUG)
+    with profiled(PROFILE_DIR, "rebalance"):
+        main()
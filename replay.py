@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Counterfactual replay of fee_setting_agent.py over the recorded forwarding history, to ask
+# what the last days would have earned with other settings. The forwarding events in the
+# local event store, and the fee rates recorded in the data store, are replayed run by run:
+# each run re-runs the agent's own decision logic (rule_based_adjustments, or
+# select_actions_based_on_q_table with Q-learning updates) on the counterfactual forwarding
+# stats, and the fee rates it sets decide how much of the recorded demand each channel gets.
+# An elasticity model scales every recorded forward by how much the counterfactual fee rate
+# of its outgoing channel differs from the fee rate it was really charged. Liquidity is not
+# modelled: forwards that fit the real channels are assumed to fit the counterfactual ones.
+#
+# A grid of settings is replayed on a process pool, the events being shared by all the
+# processes through shared memory rather than copied to each, and the results are ranked by
+# fees earned:
+#
+#   python replay.py --days 90
+#   python replay.py --alpha 0.05 0.1 0.2 --epsilon 0 0.1 --increase 0.005 0.01 0.02 --flow-threshold 0 2 5
+#   python replay.py --elasticity power --elasticity-exponent 0.5 --output replay_results.csv
+
+import argparse
+import csv
+import itertools
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context, shared_memory
+
+import numpy as np
+
+import fee_setting_agent as agent
+from event_store import ForwardingEventStore, parse_chan_ids
+
+# Configuration parameters
+REPLAY_DAYS = 90  # Days of recorded history to replay
+REPLAY_INTERVAL = 3600  # Seconds between simulated agent runs, as with DAEMON_INTERVAL
+REPLAY_WORKERS = os.cpu_count() or 1  # Processes the grid is spread over
+ELASTICITY_MODEL = "exponential"  # "exponential", "power" or "none", see demand_weights
+REFERENCE_PPM = 1000  # For the exponential model, the fee rate increase that cuts demand by a factor of e
+ELASTICITY_EXPONENT = 1.0  # For the power model, the percentage drop in demand for each percent of fee rate increase
+MAX_DEMAND_MULTIPLIER = 3.0  # Most a lower fee rate can multiply a channel's recorded demand by
+RESULTS_FILE = "replay_results.csv"  # Ranked results, as CSV
+
+STRATEGIES = ['rule_based', 'q_table', 'static']
+# One row per recorded forward, with channels as indexes into the replay's channel list and
+# the fee rate the outgoing channel really charged
+REPLAY_DTYPE = np.dtype([('timestamp_ns', np.int64), ('chan_in', np.int32), ('chan_out', np.int32),
+                         ('amt_in_msat', np.int64), ('amt_out_msat', np.int64), ('fee_ppm', np.float64)])
+RESULT_FIELDS = ['rank', 'strategy', 'alpha', 'gamma', 'epsilon', 'increase', 'decrease', 'flow_threshold', 'fees_sat', 'fee_change_pct',
+                 'volume_sat', 'forwards', 'fee_changes', 'mean_fee_ppm', 'seconds']
+
+# Set in each worker process by attach_history
+HISTORY = None
+
+# Function to load the recorded history to replay: the forwards of the last days before end,
+# and each channel's fee rate at the start, from the data store where it recorded one and
+# otherwise from the fee its first forward paid
+def load_history(event_store, data_store, days=REPLAY_DAYS, end=None):
+    end = int(end if end is not None else agent.current_time())
+    start = end - days * 86400
+    forwarding_events = event_store.get_forwarding_events(start, end)
+    events = forwarding_events.events
+    fees, rows, position = data_store.read(end=end, columns=['timestamp', 'chan_id', 'state', 'next_state'])
+    recorded = parse_chan_ids(fees['chan_id'])
+
+    # Channels with recorded fee rates but no forwards in the window are replayed too
+    chan_ids = np.union1d(forwarding_events.chan_ids, recorded)
+    index = np.searchsorted(chan_ids, forwarding_events.chan_ids)
+    history = np.zeros(len(events), dtype=REPLAY_DTYPE)
+    history['timestamp_ns'] = events['timestamp_ns']
+    history['chan_in'], history['chan_out'] = index[events['chan_in']], index[events['chan_out']]
+    history['amt_in_msat'], history['amt_out_msat'] = events['amt_in_msat'], events['amt_out_msat']
+    history['fee_ppm'] = events['fee_msat'] * 1e6 / np.maximum(events['amt_out_msat'], 1)
+
+    # Fee rates are in the agent's units, sats per 1000 sats
+    start_fee = np.full(len(chan_ids), np.nan)
+    first_out = np.unique(history['chan_out'], return_index=True)
+    start_fee[first_out[0]] = history['fee_ppm'][first_out[1]] / 1000
+    rows = np.searchsorted(chan_ids, recorded)
+    before = fees['timestamp'] < start
+    order = np.argsort(fees['timestamp'], kind='stable')
+    for row in order[~before[order]][::-1]:
+        start_fee[rows[row]] = fees['state'][row]  # The earliest rate recorded in the window
+    for row in order[before[order]]:
+        start_fee[rows[row]] = fees['next_state'][row]  # The rate last set before it
+    return {'events': history, 'chan_ids': [str(chan_id) for chan_id in chan_ids.tolist()], 'start_fee': np.nan_to_num(start_fee),
+            'start': start, 'end': end}
+
+# Function to get the factor each recorded forward's demand is scaled by when its outgoing
+# channel charges fee_ppm instead of the recorded_ppm it really charged:
+#   "exponential" - demand falls by a factor of e for every reference_ppm of fee rate, as in simulator.py
+#   "power"       - constant elasticity: demand falls by exponent percent for each percent of fee rate
+#   "none"        - demand does not depend on the fee rate
+def demand_weights(fee_ppm, recorded_ppm, model=ELASTICITY_MODEL, reference_ppm=REFERENCE_PPM, exponent=ELASTICITY_EXPONENT,
+                   max_multiplier=MAX_DEMAND_MULTIPLIER):
+    if model == "none":
+        return np.ones(len(fee_ppm))
+    if model == "exponential":
+        weights = np.exp((recorded_ppm - fee_ppm) / reference_ppm)
+    elif model == "power":
+        weights = ((fee_ppm + 1) / (recorded_ppm + 1)) ** -exponent
+    else:
+        raise ValueError(f"Unknown elasticity model: {model}")
+    return np.minimum(weights, max_multiplier)
+
+# Function to list the settings to replay: each strategy only varies the settings it uses
+def build_grid(strategies, alphas, gammas, epsilons, increases, decreases, flow_thresholds):
+    strategies, alphas, gammas, epsilons, increases, decreases, flow_thresholds = (list(dict.fromkeys(values)) for values in (
+        strategies, alphas, gammas, epsilons, increases, decreases, flow_thresholds))  # Values given twice are replayed once
+    grid = []
+    for strategy in strategies:
+        if strategy == 'static':
+            grid.append({'strategy': strategy})
+        elif strategy == 'rule_based':
+            grid += [{'strategy': strategy, 'increase': increase, 'decrease': decrease, 'flow_threshold': threshold}
+                     for increase, decrease, threshold in itertools.product(increases, decreases, flow_thresholds)]
+        else:
+            grid += [{'strategy': strategy, 'alpha': alpha, 'gamma': gamma, 'epsilon': epsilon, 'increase': increase, 'decrease': decrease}
+                     for alpha, gamma, epsilon, increase, decrease in itertools.product(alphas, gammas, epsilons, increases, decreases)]
+    return grid
+
+# Function to give a worker process its view of the shared events and the other inputs
+def attach_history(name, count, context):
+    global HISTORY
+    memory = shared_memory.SharedMemory(name=name)
+    events = np.ndarray(count, dtype=REPLAY_DTYPE, buffer=memory.buf)
+    HISTORY = dict(context, events=events, memory=memory)
+
+# Function to replay the history under one set of settings; runs in a worker process, where
+# the agent's module settings can be changed freely
+def replay(settings):
+    started = time.perf_counter()
+    history = HISTORY
+    events, chan_ids, model = history['events'], history['chan_ids'], history['model']
+    strategy = settings['strategy']
+    num_channels = len(chan_ids)
+    interval = history['interval']
+    fee_rate = history['start_fee'].copy()
+    window_runs = max(1, agent.AGGREGATION_DAYS * 86400 // interval)
+    run_times = np.arange(history['start'] + interval, history['end'] + 1, interval)
+    bounds = np.searchsorted(events['timestamp_ns'], np.concatenate(([history['start']], run_times)) * 10 ** 9)
+    position = {chan_id: i for i, chan_id in enumerate(chan_ids)}
+
+    agent.alpha = settings.get('alpha', agent.alpha)
+    agent.gamma = settings.get('gamma', agent.gamma)
+    agent.epsilon = settings.get('epsilon', agent.epsilon)
+    agent.FEE_INCREASE = settings.get('increase', agent.FEE_INCREASE)
+    agent.FEE_DECREASE = settings.get('decrease', agent.FEE_DECREASE)
+    agent.RULE_FLOW_THRESHOLD = settings.get('flow_threshold', agent.RULE_FLOW_THRESHOLD)
+    agent.Q = history['q_table'].copy()
+    agent.FEE_UPDATE_TIMES = {}
+    agent.DRY_RUN = False
+    np.random.seed(history['seed'])  # Exploration in the agent's action selection
+
+    # Stats per run, and their sum over the agent's aggregation window, as fees, amount in,
+    # amount out, forwards in and forwards out per channel
+    runs = np.zeros((window_runs, 5, num_channels))
+    window = np.zeros((5, num_channels))
+    fees_msat = volume_msat = forwards = 0.0
+    fee_changes = 0
+    for run, now in enumerate(run_times.tolist()):
+        chunk = events[bounds[run]:bounds[run + 1]]
+        fee_ppm = fee_rate[chunk['chan_out']] * 1000
+        weights = demand_weights(fee_ppm, chunk['fee_ppm'], model['model'], model['reference_ppm'], model['exponent'], model['max_multiplier'])
+        earned = weights * chunk['amt_out_msat'] * fee_ppm / 1e6
+        stats = runs[run % window_runs]
+        window -= stats
+        stats[0] = np.bincount(chunk['chan_out'], earned, minlength=num_channels)
+        stats[1] = np.bincount(chunk['chan_in'], weights * chunk['amt_in_msat'], minlength=num_channels)
+        stats[2] = np.bincount(chunk['chan_out'], weights * chunk['amt_out_msat'], minlength=num_channels)
+        stats[3] = np.bincount(chunk['chan_in'], weights, minlength=num_channels)
+        stats[4] = np.bincount(chunk['chan_out'], weights, minlength=num_channels)
+        window += stats
+        fees_msat += stats[0].sum()
+        volume_msat += stats[2].sum()
+        forwards += stats[4].sum()
+        if strategy == 'static':
+            continue
+
+        # The agent's run at this time, on the forwarding stats it would have aggregated
+        agent.CLOCK = lambda: now
+        active = np.flatnonzero(window[3] + window[4] > 1e-9)
+        channel_stats = {chan_ids[i]: {'fees': fees, 'amt_in': amt_in, 'amt_out': amt_out, 'count_in': count_in, 'count_out': count_out}
+                         for i, fees, amt_in, amt_out, count_in, count_out in zip(active.tolist(), *window[:, active].tolist())}
+        channel_aliases = {chan_id: (None, chan_id, rate, None) for chan_id, rate in zip(chan_ids, fee_rate.tolist())}
+        if strategy == 'rule_based':
+            actions = agent.apply_cooldowns(agent.rule_based_adjustments(channel_stats, channel_aliases))
+        else:
+            actions = agent.apply_cooldowns(agent.select_actions_based_on_q_table(channel_aliases))
+        changes = {}
+        for chan_id, alias, increase, reason, adjustment_amount in actions:
+            current = channel_aliases[chan_id][2]
+            changes[chan_id] = (current, agent.compute_new_fee_rate(current, increase, adjustment_amount))
+        agent.record_fee_updates(changes)
+        for chan_id, (current, new) in changes.items():
+            fee_rate[position[chan_id]] = new
+            fee_changes += new != current
+        if strategy == 'q_table' and actions:
+            # As the next run would train on the rows this one records
+            states = np.array([changes[action[0]][0] for action in actions])
+            next_states = np.array([changes[action[0]][1] for action in actions])
+            rewards = np.array([agent.reward_function_per_channel(action[0], channel_stats) for action in actions]) / 1000000
+            agent.apply_q_updates(np.minimum((states * 100).astype(np.int64), agent.Q.shape[0] - 1), np.array([int(action[2]) for action in actions]),
+                                  rewards, np.minimum((next_states * 100).astype(np.int64), agent.Q.shape[0] - 1))
+
+    return dict(settings, fees_sat=fees_msat / 1000, volume_sat=volume_msat / 1000, forwards=forwards, fee_changes=int(fee_changes),
+                mean_fee_ppm=float(fee_rate.mean() * 1000) if num_channels else 0.0, seconds=time.perf_counter() - started)
+
+# Function to replay every setting of the grid on a pool of worker processes, the events
+# being placed once in shared memory. Returns the results ranked by fees earned.
+def run_sweep(history, grid, model, interval=REPLAY_INTERVAL, workers=REPLAY_WORKERS, q_table=None, seed=0):
+    events = history['events']
+    memory = shared_memory.SharedMemory(create=True, size=max(events.nbytes, 1))
+    try:
+        np.ndarray(len(events), dtype=REPLAY_DTYPE, buffer=memory.buf)[:] = events
+        context = {'chan_ids': history['chan_ids'], 'start_fee': history['start_fee'], 'start': history['start'], 'end': history['end'],
+                   'interval': interval, 'model': model, 'seed': seed,
+                   'q_table': q_table if q_table is not None else np.zeros((agent.num_states, agent.num_actions))}
+        with ProcessPoolExecutor(max_workers=max(1, min(workers, len(grid))), mp_context=get_context('spawn'),
+                                 initializer=attach_history, initargs=(memory.name, len(events), context)) as executor:
+            results = list(executor.map(replay, grid))
+    finally:
+        memory.close()
+        memory.unlink()
+
+    recorded_sat = float(events['fee_ppm'] @ events['amt_out_msat']) / 1e9
+    results.sort(key=lambda result: result['fees_sat'], reverse=True)
+    for rank, result in enumerate(results, 1):
+        result['rank'] = rank
+        result['fee_change_pct'] = 100 * (result['fees_sat'] - recorded_sat) / recorded_sat if recorded_sat else 0.0
+    return results, recorded_sat
+
+def print_results(results, recorded_sat, top):
+    print(f"Recorded fees: {recorded_sat:.0f} sats")
+    print(f"{'rank':>4} {'strategy':>10} {'alpha':>6} {'gamma':>6} {'epsilon':>7} {'increase':>8} {'decrease':>8} {'threshold':>9} "
+          f"{'fees (sat)':>11} {'vs recorded':>11} {'forwards':>9} {'changes':>8} {'fee (ppm)':>9}")
+    for result in results[:top]:
+        value = lambda key: f"{result[key]:g}" if key in result else '-'
+        print(f"{result['rank']:>4} {result['strategy']:>10} {value('alpha'):>6} {value('gamma'):>6} {value('epsilon'):>7} {value('increase'):>8} "
+              f"{value('decrease'):>8} {value('flow_threshold'):>9} {result['fees_sat']:>11.0f} {result['fee_change_pct']:>10.1f}% "
+              f"{result['forwards']:>9.0f} {result['fee_changes']:>8} {result['mean_fee_ppm']:>9.1f}")
+
+def write_results(path, results):
+    with open(path, mode='w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=RESULT_FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(results)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay the recorded forwarding history under other fee agent settings")
+    parser.add_argument('--days', type=int, default=REPLAY_DAYS)
+    parser.add_argument('--end', type=int, help="Unix time the replay ends at; defaults to now")
+    parser.add_argument('--interval', type=int, default=REPLAY_INTERVAL, help="Seconds between simulated agent runs")
+    parser.add_argument('--strategies', nargs='+', choices=STRATEGIES, default=STRATEGIES)
+    parser.add_argument('--alpha', type=float, nargs='+', default=[agent.alpha])
+    parser.add_argument('--gamma', type=float, nargs='+', default=[agent.gamma])
+    parser.add_argument('--epsilon', type=float, nargs='+', default=[agent.epsilon])
+    parser.add_argument('--increase', type=float, nargs='+', default=[agent.FEE_INCREASE], help="FEE_INCREASE values, in sats per 1000 sats")
+    parser.add_argument('--decrease', type=float, nargs='+', default=[agent.FEE_DECREASE], help="FEE_DECREASE values, in sats per 1000 sats")
+    parser.add_argument('--flow-threshold', type=float, nargs='+', default=[agent.RULE_FLOW_THRESHOLD], help="RULE_FLOW_THRESHOLD values")
+    parser.add_argument('--elasticity', choices=['exponential', 'power', 'none'], default=ELASTICITY_MODEL)
+    parser.add_argument('--reference-ppm', type=float, default=REFERENCE_PPM)
+    parser.add_argument('--elasticity-exponent', type=float, default=ELASTICITY_EXPONENT)
+    parser.add_argument('--max-demand', type=float, default=MAX_DEMAND_MULTIPLIER)
+    parser.add_argument('--q-table', default=agent.Q_TABLE_FILE, help="Q-table the q_table strategy starts from, if the file exists")
+    parser.add_argument('--workers', type=int, default=REPLAY_WORKERS)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--top', type=int, default=20, help="Results to print")
+    parser.add_argument('--output', default=RESULTS_FILE)
+    options = parser.parse_args(argv)
+
+    with ForwardingEventStore(agent.EVENT_STORE_FILE) as event_store:
+        history = load_history(event_store, agent.get_data_store(), options.days, options.end)
+    agent.close_data_store()
+    if not len(history['events']):
+        raise Exception(f"Error replaying history: no forwarding events in the last {options.days} days in {agent.EVENT_STORE_FILE}")
+    q_table = np.load(options.q_table) if options.q_table and os.path.exists(options.q_table) else None
+    grid = build_grid(options.strategies, options.alpha, options.gamma, options.epsilon, options.increase, options.decrease, options.flow_threshold)
+    model = {'model': options.elasticity, 'reference_ppm': options.reference_ppm, 'exponent': options.elasticity_exponent,
+             'max_multiplier': options.max_demand}
+    print(f"Replaying {len(history['events'])} forwards over {len(history['chan_ids'])} channels for {len(grid)} settings "
+          f"on {min(options.workers, len(grid))} processes", file=sys.stderr)
+    started = time.perf_counter()
+    results, recorded_sat = run_sweep(history, grid, model, options.interval, options.workers, q_table, options.seed)
+    print(f"Replayed in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+    print_results(results, recorded_sat, options.top)
+    write_results(options.output, results)
+    print(f"Wrote {len(results)} results to {options.output}")
+
+if __name__ == "__main__":
+    main()
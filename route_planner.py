@@ -0,0 +1,480 @@
+# Local planner for circular rebalancing routes, paid with sendtoroute instead of leaving
+# lnd to search for a path inside payinvoice.
+# ChannelGraph holds the public channel graph as compact arrays: one row per direction of
+# each channel, sorted by sending node so that each node's channels are one slice (CSR
+# form), with fee, capacity and state vectors. It is built once from describegraph, cached
+# to disk, and patched in place from the node's channel graph updates. RouteFailures is a
+# small mission control: channels our payments failed at get a penalty that halves every
+# PENALTY_HALF_LIFE. RoutePlanner finds the k cheapest circular routes out through one peer
+# and back in through another, relaxing every channel at once with NumPy, and builds them
+# into routes for sendtoroute itself, so paying one takes a single node call.
+
+import json
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+from node_client import NodeError
+
+GRAPH_CACHE_FILE = "channel_graph.npz"  # Cached copy of the graph, so describegraph runs at most every GRAPH_MAX_AGE
+GRAPH_MAX_AGE = 6 * 3600           # Seconds before the whole graph is fetched again
+ROUTE_FAILURES_FILE = "route_failures.json"  # Recent payment failures, kept across runs
+MAX_ROUTE_HOPS = 10                # Longest circular route, counting our own two channels
+HOP_COST_MSAT = 1000               # Added per hop, so that of two routes with similar fees the shorter is tried first
+FAILURE_PENALTY_MSAT = 1000000     # Added to a channel a payment of the same size failed at, as if it charged this much more
+PENALTY_HALF_LIFE = 3600           # Seconds for a failure penalty to halve
+SEARCH_STEPS = 32                  # Cost thresholds a route search's budget is split into; more is closer to Dijkstra's order
+CANDIDATE_EDGES = 20               # Channels looked at per route wanted, when picking alternative routes
+FINAL_CLTV_DELTA = 80              # Blocks the destination is given to claim the payment, lnd's invoice default
+BLOCK_PADDING = 3                  # Blocks added to the final expiry, as lnd does, for blocks found while the payment is in flight
+KEYSEND_RECORD = '5482373484'      # Custom record that carries a keysend preimage to the destination
+
+# One row per channel direction, with the sending node's policy
+EDGE_DTYPE = np.dtype([('src', np.int32), ('dst', np.int32), ('chan_id', np.uint64), ('capacity_sat', np.int64),
+                       ('base_fee_msat', np.int64), ('fee_rate_ppm', np.int64), ('min_htlc_msat', np.int64),
+                       ('max_htlc_msat', np.int64), ('time_lock_delta', np.int32), ('disabled', np.bool_)])
+
+logger = logging.getLogger("route_planner")
+
+def _edge_row(source, target, chan_id, capacity, policy):
+    return (source, target, int(chan_id), int(capacity or 0), int(policy.get('fee_base_msat') or 0),
+            int(policy.get('fee_rate_milli_msat') or 0), int(policy.get('min_htlc') or 0),
+            int(policy.get('max_htlc_msat') or 0), int(policy.get('time_lock_delta') or 0), bool(policy.get('disabled')))
+
+class ChannelGraph:
+    def __init__(self, pubkeys, edges, fetched=None):
+        self.pubkeys = list(pubkeys)
+        self.node_index = {pubkey: i for i, pubkey in enumerate(self.pubkeys)}
+        self.fetched = time.time() if fetched is None else fetched  # When the whole graph was last fetched
+        self.changed = False  # Set by updates, so an unchanged graph is not written back to the cache
+        self.pending = {}  # (chan_id, source) -> row, for channels first seen in updates, added at the next rebuild
+        self.version = 0
+        self.lock = threading.Lock()
+        self._index(np.array(edges, dtype=EDGE_DTYPE))
+
+    @property
+    def num_nodes(self):
+        return len(self.indptr) - 1
+
+    @property
+    def num_edges(self):
+        return len(self.edges)
+
+    # Function to sort the rows by sending node and rebuild the indexes over them
+    def _index(self, edges):
+        self.edges = edges[np.argsort(edges['src'], kind='stable')]
+        self.src = np.ascontiguousarray(self.edges['src'])
+        self.dst = np.ascontiguousarray(self.edges['dst'])
+        self.indptr = np.zeros(len(self.pubkeys) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.src, minlength=len(self.pubkeys)), out=self.indptr[1:])
+        # The same rows by receiving node, for searches towards a node
+        self.in_order = np.argsort(self.dst, kind='stable')
+        self.in_src = self.src[self.in_order]
+        self.in_indptr = np.zeros(len(self.pubkeys) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.dst, minlength=len(self.pubkeys)), out=self.in_indptr[1:])
+        self.chan_order = np.argsort(self.edges['chan_id'], kind='stable')
+        self.sorted_chan_ids = self.edges['chan_id'][self.chan_order]
+        self.columns = None
+        self.version += 1
+
+    @classmethod
+    def from_describegraph(cls, graph):
+        pubkeys = [node['pub_key'] for node in graph.get('nodes') or []]
+        index = {pubkey: i for i, pubkey in enumerate(pubkeys)}
+        rows = []
+        for edge in graph.get('edges') or []:
+            for pubkey in (edge['node1_pub'], edge['node2_pub']):
+                if pubkey not in index:
+                    index[pubkey] = len(pubkeys)
+                    pubkeys.append(pubkey)
+            node1, node2 = index[edge['node1_pub']], index[edge['node2_pub']]
+            for source, target, policy in ((node1, node2, edge.get('node1_policy')), (node2, node1, edge.get('node2_policy'))):
+                if policy:
+                    rows.append(_edge_row(source, target, edge['channel_id'], edge['capacity'], policy))
+        return cls(pubkeys, rows)
+
+    # Function to write the graph to a .npz file, atomically
+    def save(self, path):
+        temp_path = path + '.tmp'
+        with self.lock:
+            self._add_pending()
+            with open(temp_path, mode='wb') as file:
+                np.savez(file, edges=self.edges, pubkeys=np.array(self.pubkeys, dtype=str), fetched=np.array(self.fetched))
+            self.changed = False
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['pubkeys'].tolist(), data['edges'], fetched=float(data['fetched']))
+
+    # Function to find the row of one direction of a channel, or None
+    def find_edge(self, chan_id, source):
+        chan_id = np.uint64(chan_id)
+        position = int(np.searchsorted(self.sorted_chan_ids, chan_id))
+        while position < len(self.sorted_chan_ids) and self.sorted_chan_ids[position] == chan_id:
+            row = int(self.chan_order[position])
+            if self.src[row] == source:
+                return row
+            position += 1
+        return None
+
+    def _node(self, pubkey):
+        if pubkey not in self.node_index:
+            self.node_index[pubkey] = len(self.pubkeys)
+            self.pubkeys.append(pubkey)
+        return self.node_index[pubkey]
+
+    # Function to fold channels first seen in updates into the arrays
+    def _add_pending(self):
+        if self.pending:
+            self._index(np.concatenate([self.edges, np.array(list(self.pending.values()), dtype=EDGE_DTYPE)]))
+            self.pending = {}
+
+    # Function to apply one subscribechannelgraph message: changed policies are patched in
+    # place, closed channels disabled, and new channels queued for the next rebuild
+    def apply_update(self, update):
+        with self.lock:
+            for change in update.get('channel_updates') or []:
+                source, target = self._node(change['advertising_node']), self._node(change['connecting_node'])
+                row = _edge_row(source, target, change['chan_id'], change.get('capacity'), change.get('routing_policy') or {})
+                position = self.find_edge(row[2], source)
+                if position is None:
+                    self.pending[(row[2], source)] = row
+                else:
+                    self.edges[position] = row
+                    self.columns = None
+            for closed in update.get('closed_chans') or []:
+                chan_id = np.uint64(closed['chan_id'])
+                rows = self.chan_order[np.searchsorted(self.sorted_chan_ids, chan_id):np.searchsorted(self.sorted_chan_ids, chan_id, side='right')]
+                self.edges['disabled'][rows] = True
+                self.edges['capacity_sat'][rows] = 0
+                self.columns = None
+                self.pending = {key: row for key, row in self.pending.items() if key[0] != int(chan_id)}
+            self.changed = True
+
+    # Function to keep the graph current from the node's channel graph subscription; runs
+    # until the subscription ends, so it is meant for a background thread
+    def follow(self, client):
+        try:
+            for update in client.subscribe('subscribechannelgraph'):
+                self.apply_update(update)
+        except NodeError as error:
+            logger.debug("No channel graph updates: %s", error)
+
+    # Function to get the rows and, per row, the fee in msat for forwarding amt_msat plus any
+    # failure penalty, or inf where the channel is disabled or cannot carry the amount, with
+    # the index arrays that go with the rows; rebuilds replace the arrays rather than change them
+    def forwarding_costs(self, amt_msat, failures=None):
+        with self.lock:
+            self._add_pending()
+            # Contiguous copies of the fields used, which are quicker to compute with than the
+            # interleaved fields of the rows; updates drop them
+            if self.columns is None:
+                edges = self.edges
+                max_htlc = np.where(edges['max_htlc_msat'] > 0, edges['max_htlc_msat'], np.iinfo(np.int64).max)
+                self.columns = (edges['base_fee_msat'].astype(np.float64), edges['fee_rate_ppm'] / 1000000,
+                                np.where(edges['disabled'], -1, np.minimum(edges['capacity_sat'] * 1000, max_htlc)),
+                                np.ascontiguousarray(edges['min_htlc_msat']))
+            base_fee, fee_rate, largest, smallest = self.columns
+            costs = base_fee + fee_rate * amt_msat
+            costs[(largest < amt_msat) | (smallest > amt_msat)] = np.inf
+            if failures is not None:
+                costs += failures.penalties(self, amt_msat)
+            return self.edges, costs, self.src, self.dst, self.indptr, (self.in_indptr, self.in_order, self.in_src)
+
+# Recent payment failures per channel direction, as lnd's mission control keeps them
+class RouteFailures:
+    def __init__(self, path=ROUTE_FAILURES_FILE, penalty_msat=FAILURE_PENALTY_MSAT, half_life=PENALTY_HALF_LIFE, clock=time.time):
+        self.path = path
+        self.penalty_msat = penalty_msat
+        self.half_life = half_life
+        self.clock = clock
+        self.failures = {}  # (chan_id, sending pubkey) -> (time, amount in msat)
+        self.lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path) as file:
+                for failure in json.load(file):
+                    self.failures[(int(failure['chan_id']), failure['source'])] = (failure['time'], failure['amt_msat'])
+
+    def record_failure(self, chan_id, source, amt_msat):
+        with self.lock:
+            self.failures[(int(chan_id), source)] = (self.clock(), int(amt_msat))
+
+    # Function to forget the failures of the channels a payment just went through
+    def record_success(self, route, our_pubkey):
+        nodes = [our_pubkey] + [hop['pub_key'] for hop in route['hops']]
+        with self.lock:
+            for hop, source in zip(route['hops'], nodes):
+                self.failures.pop((int(hop['chan_id']), source), None)
+
+    # Function to get the penalty in msat of every row of the graph for a payment of
+    # amt_msat: smaller payments than the one that failed are penalised less
+    def penalties(self, graph, amt_msat):
+        penalty = np.zeros(graph.num_edges)
+        now = self.clock()
+        with self.lock:
+            failures = list(self.failures.items())
+        for (chan_id, source), (when, failed_msat) in failures:
+            node = graph.node_index.get(source)
+            row = graph.find_edge(chan_id, node) if node is not None else None
+            if row is not None:
+                penalty[row] += self.penalty_msat * 0.5 ** ((now - when) / self.half_life) * min(1.0, amt_msat / max(failed_msat, 1))
+        return penalty
+
+    # Function to write the failures that still carry a penalty, atomically
+    def save(self):
+        if not self.path:
+            return
+        now = self.clock()
+        with self.lock:
+            failures = [{'chan_id': str(chan_id), 'source': source, 'time': when, 'amt_msat': amt_msat}
+                        for (chan_id, source), (when, amt_msat) in self.failures.items() if now - when < 8 * self.half_life]
+        temp_path = self.path + '.tmp'
+        with open(temp_path, mode='w') as file:
+            json.dump(failures, file)
+        os.replace(temp_path, self.path)
+
+# Function to list the rows of the given nodes' CSR slices, with the number per node
+def _slices(indptr, nodes):
+    starts = indptr[nodes]
+    counts = indptr[nodes + 1] - starts
+    ends = np.cumsum(counts)
+    return np.arange(ends[-1] if len(ends) else 0) + np.repeat(starts - ends + counts, counts), counts
+
+# Function to find the cheapest cost from origin to every node within budget, over at most
+# rounds channels. The rows are given in CSR order, each node's outgoing rows the slice of
+# indptr for it, as heads (the node each row leads to) and costs. Like Dijkstra's algorithm,
+# nodes are expanded in order of cost, but in batches: every node that got cheaper and costs
+# no more than a threshold has its rows relaxed at once, and the threshold rises by a
+# fraction of the budget when none are left, so most nodes are expanded only once. Keeps
+# for every node the row it was reached through, and how many channels that took; like
+# lnd, the hop limit applies to the cheapest routes rather than finding the cheapest route
+# within it. Returns the costs and those rows, -1 where a node was not reached.
+def _cheapest(costs, heads, indptr, origin, rounds, budget):
+    dist = np.full(len(indptr) - 1, np.inf)
+    dist[origin] = 0
+    links = np.full(len(indptr) - 1, -1, dtype=np.int64)
+    hops = np.zeros(len(indptr) - 1, dtype=np.int32)
+    pending = np.zeros(len(indptr) - 1, dtype=bool)
+    pending[origin] = True
+    step = budget / SEARCH_STEPS
+    threshold = 0.0
+    while True:
+        active = np.flatnonzero(pending & (dist <= threshold))
+        if not len(active):
+            waiting = dist[pending]
+            if not len(waiting):
+                break
+            threshold = max(threshold + step, waiting.min())
+            continue
+        pending[active] = False
+        active = active[hops[active] < rounds]
+        rows, counts = _slices(indptr, active)
+        candidate = np.repeat(dist[active], counts) + costs[rows]
+        nodes = heads[rows]
+        improved = (candidate < dist[nodes]) & (candidate <= budget)
+        if not improved.any():
+            continue
+        rows, nodes, candidate = rows[improved], nodes[improved], candidate[improved]
+        steps = np.repeat(hops[active] + 1, counts)[improved]
+        np.minimum.at(dist, nodes, candidate)
+        best = dist[nodes] == candidate
+        links[nodes[best]] = rows[best]
+        hops[nodes[best]] = steps[best]
+        pending[nodes] = True
+    return dist, links
+
+# Function to follow the rows kept by _cheapest from a node back to the origin
+def _walk(links, ends, origin, node, limit):
+    rows = []
+    while node != origin:
+        row = links[node]
+        if row < 0 or len(rows) >= limit:
+            return None
+        rows.append(int(row))
+        node = ends[row]
+    return rows
+
+class RoutePlanner:
+    def __init__(self, graph, our_pubkey, failures=None, max_hops=MAX_ROUTE_HOPS, hop_cost_msat=HOP_COST_MSAT):
+        self.graph = graph
+        self.our_pubkey = our_pubkey
+        self.failures = failures if failures is not None else RouteFailures(None)
+        self.max_hops = max_hops
+        self.hop_cost_msat = hop_cost_msat
+        self.block_height = None  # Current block height, from getinfo, for the expiries of routes built here
+
+    # Function to find up to k circular routes of amt_sat that leave through the peer first_hop
+    # and come back through the peer last_hop, with fees of at most fee_limit_sat, cheapest
+    # first. The cheapest route through each channel is the cheapest cost to reach it plus the
+    # cheapest cost on from it, so one search out of first_hop and one into last_hop give the
+    # cheapest routes that each differ from the others in at least one channel.
+    # The route comes back in over last_chan_id when it is given, else over last_hop's cheapest
+    # channel to us. Routes are dicts with the pubkeys of the hops (ending with ours), the
+    # channel IDs between first_hop and us with the policy each is forwarded over with (None
+    # where the channel back is private and not in the graph), the fee in msat and the cost
+    # including penalties.
+    def circular_routes(self, first_hop, last_hop, amt_sat, fee_limit_sat, k=3, last_chan_id=None):
+        graph = self.graph
+        amt_msat = int(amt_sat) * 1000
+        edges, costs, src, dst, indptr, (in_indptr, in_order, in_src) = graph.forwarding_costs(amt_msat, self.failures)
+        first, last, us = (graph.node_index.get(pubkey, -1) for pubkey in (first_hop, last_hop, self.our_pubkey))
+        if not 0 <= first < len(indptr) - 1 or not 0 <= last < len(indptr) - 1:
+            return []
+        costs += self.hop_cost_msat
+
+        # The channel back to us from last_hop is the one asked for or the cheapest of its
+        # channels to us; a private one is not in the graph, and costs nothing here
+        final, final_cost = None, 0.0
+        if us >= 0:
+            rows = np.arange(indptr[last], indptr[last + 1])
+            rows = rows[(dst[rows] == us) & np.isfinite(costs[rows])]
+            if last_chan_id is not None:
+                rows = rows[edges['chan_id'][rows] == np.uint64(last_chan_id)]
+            final = int(rows[np.argmin(costs[rows])]) if len(rows) else None
+            final_cost = float(costs[final]) if final is not None else 0.0
+            # Our node only starts and ends the route
+            costs[indptr[us]:indptr[us + 1]] = np.inf
+            costs[in_order[in_indptr[us]:in_indptr[us + 1]]] = np.inf
+
+        # Penalties count against the fee limit, hop costs do not
+        rounds = self.max_hops - 2
+        budget = int(fee_limit_sat) * 1000 + self.hop_cost_msat * (rounds + 1) - final_cost
+        if first == last:
+            middles = [([], 0.0)]
+        elif rounds <= 0:
+            middles = []
+        else:
+            # Every route within budget has a channel that is reached within half the budget and
+            # leads on to last_hop within the other half, so each search only needs half
+            out_cost, reached_by = _cheapest(costs, dst, indptr, first, rounds, budget / 2)
+            # Towards last_hop, the rows are taken by receiving node, and the rows found mapped back
+            in_cost, leaves_by = _cheapest(costs[in_order], in_src, in_indptr, last, rounds, budget / 2)
+            leaves_by = np.where(leaves_by >= 0, in_order[leaves_by], -1)
+            # The cheapest route through each channel out of the nodes reached
+            rows, _ = _slices(indptr, np.flatnonzero(np.isfinite(out_cost)))
+            through = out_cost[src[rows]] + costs[rows] + in_cost[dst[rows]]
+            keep = through <= budget
+            middles = self._alternatives(rows[keep], through[keep], reached_by, leaves_by, src, dst, first, last, k, rounds)
+
+        routes = []
+        for rows, cost in middles:
+            fee_rows = rows + ([final] if final is not None else [])
+            fee_msat = self._route_fee(edges, fee_rows, amt_msat)
+            if fee_msat > int(fee_limit_sat) * 1000:
+                continue
+            policies = [(int(edges['base_fee_msat'][row]), int(edges['fee_rate_ppm'][row]), int(edges['time_lock_delta'][row]))
+                        for row in fee_rows]
+            routes.append({'hops': [first_hop] + [graph.pubkeys[dst[row]] for row in rows] + [self.our_pubkey],
+                           'chan_ids': [str(edges['chan_id'][row]) for row in fee_rows] + ([] if final is not None else [last_chan_id]),
+                           'policies': policies + ([] if final is not None else [None]), 'fee_msat': fee_msat,
+                           'cost_msat': int(cost + final_cost)})
+            if len(routes) == k:
+                break
+        return routes
+
+    # Function to turn the cost of the cheapest route through each row into distinct simple
+    # routes, cheapest first, as (rows, cost)
+    def _alternatives(self, rows, through, reached_by, leaves_by, src, dst, first, last, k, rounds):
+        if not len(rows):
+            return []
+        count = min(len(rows), k * CANDIDATE_EDGES)
+        best = np.argpartition(through, count - 1)[:count]
+        best = best[np.argsort(through[best], kind='stable')]
+        middles, seen = [], set()
+        for row, cost in zip(rows[best].tolist(), through[best].tolist()):
+            before = _walk(reached_by, src, first, src[row], rounds)
+            after = _walk(leaves_by, dst, last, dst[row], rounds)
+            if before is None or after is None:
+                continue
+            path = before[::-1] + [row] + after
+            nodes = [src[path[0]]] + [dst[step] for step in path]
+            if len(path) > rounds or len(set(nodes)) < len(nodes) or tuple(path) in seen:
+                continue
+            seen.add(tuple(path))
+            middles.append((path, cost))
+        return middles
+
+    # Function to work out a route's fees from its destination back, as each node charges
+    # on the amount it forwards, which includes the fees of the nodes after it
+    @staticmethod
+    def _route_fee(edges, rows, amt_msat):
+        carried = amt_msat
+        for row in reversed(rows):
+            carried += int(edges['base_fee_msat'][row]) + carried * int(edges['fee_rate_ppm'][row]) // 1000000
+        return carried - amt_msat
+
+    # Function to turn a planned route into the route sendtoroute takes, out over our channel
+    # chan_id, as lnd's buildroute would: amounts and expiries are worked back from the
+    # destination, which gets the payment_addr of the invoice paid or, for keysend, the
+    # preimage. Returns None when a channel's policy or the block height is not known, for
+    # buildroute to do it.
+    @staticmethod
+    def build_route(route, chan_id, amt_sat, block_height, payment_addr=None, preimage=None, final_cltv_delta=FINAL_CLTV_DELTA):
+        if block_height is None or None in route['policies'] or None in route['chan_ids']:
+            return None
+        amt_msat = int(amt_sat) * 1000
+        expiry = int(block_height) + final_cltv_delta + BLOCK_PADDING
+        hops = []
+        # Each hop is the node a channel leads to; it forwards over the next channel, with that
+        # channel's policy, and the destination forwards nothing
+        chan_ids = [str(chan_id)] + route['chan_ids']
+        forward_policies = route['policies'] + [(0, 0, 0)]
+        next_delta = 0  # Time lock delta of the hop after this one
+        for i in range(len(chan_ids) - 1, -1, -1):
+            base_fee, fee_rate, time_lock_delta = forward_policies[i]
+            forward = hops[0]['amt_to_forward_msat'] + hops[0]['fee_msat'] if hops else amt_msat
+            outgoing_expiry = hops[0]['expiry'] + next_delta if hops else expiry
+            fee = base_fee + forward * fee_rate // 1000000 if hops else 0
+            hops.insert(0, {'chan_id': chan_ids[i], 'pub_key': route['hops'][i], 'amt_to_forward_msat': forward,
+                            'fee_msat': fee, 'expiry': outgoing_expiry, 'tlv_payload': True})
+            next_delta = time_lock_delta
+        if payment_addr:
+            hops[-1]['mpp_record'] = {'payment_addr': payment_addr, 'total_amt_msat': str(amt_msat)}
+        if preimage:
+            hops[-1]['custom_records'] = {KEYSEND_RECORD: preimage}
+        total_amt_msat = hops[0]['amt_to_forward_msat'] + hops[0]['fee_msat']
+        for hop in hops:
+            hop.update(amt_to_forward=str(hop['amt_to_forward_msat'] // 1000), fee=str(hop['fee_msat'] // 1000),
+                       amt_to_forward_msat=str(hop['amt_to_forward_msat']), fee_msat=str(hop['fee_msat']))
+        return {'total_time_lock': hops[0]['expiry'] + next_delta, 'total_fees': str((total_amt_msat - amt_msat) // 1000),
+                'total_amt': str(total_amt_msat // 1000), 'hops': hops, 'total_fees_msat': str(total_amt_msat - amt_msat),
+                'total_amt_msat': str(total_amt_msat)}
+
+    # Function to learn from a sendtoroute attempt. A failure reported by a node along the route
+    # penalises the channel that node was to forward over; failures at our own node or at the
+    # destination say nothing about the network. Returns a failure reason for the attempt log.
+    def record_attempt(self, attempt, amt_sat):
+        route = attempt.get('route') or {}
+        if attempt.get('status') == 'SUCCEEDED':
+            self.failures.record_success(route, self.our_pubkey)
+            return None
+        failure = attempt.get('failure') or {}
+        hops = route.get('hops') or []
+        index = int(failure.get('failure_source_index') or 0)
+        code = failure.get('code', 'UNKNOWN_FAILURE')
+        if index == 0:
+            return f"FAILURE_REASON_INSUFFICIENT_BALANCE: {code} at our node"
+        if index < len(hops):
+            self.failures.record_failure(hops[index]['chan_id'], hops[index - 1]['pub_key'], int(amt_sat) * 1000)
+            return f"{code} at hop {index} ({hops[index]['chan_id']})"
+        return f"{code} at the destination"
+
+# Function to load the channel graph from cache_file if it was fetched less than max_age
+# seconds ago, else fetch it with describegraph and cache it
+def load_channel_graph(client, cache_file=GRAPH_CACHE_FILE, max_age=GRAPH_MAX_AGE):
+    if cache_file and os.path.exists(cache_file):
+        try:
+            graph = ChannelGraph.load(cache_file)
+            if time.time() - graph.fetched < max_age:
+                return graph
+        except (OSError, ValueError, KeyError) as error:
+            logger.info("Ignoring unreadable graph cache %s: %s", cache_file, error)
+    graph = ChannelGraph.from_describegraph(client.call('describegraph'))
+    if cache_file:
+        graph.save(cache_file)
+    return graph
@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Offline Lightning fee-market simulator, for training fee_setting_agent.py and comparing
+# its strategies without a live node. FeeMarket holds synthetic channels as NumPy arrays
+# and routes a day of forwards at a time, with demand on each channel falling as our fee
+# rate rises and forwards failing once a channel runs out of liquidity. SimulatedNode
+# answers the agent's node calls from the market, so the agent runs unchanged, one run
+# per simulated day, as it would from cron:
+#
+#   python simulator.py --days 1000 --channels 20 --seeds 0 1 2
+#   python simulator.py --days 500 --seeds 0 1 2 --check   # exits with an error if Q-learning earns less than static fees
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from contextlib import contextmanager, redirect_stdout
+
+import numpy as np
+
+import fee_setting_agent as agent
+from fake_lnd import EVENT_DTYPE, FakeNode, forwarding_event_dicts
+
+START_TIME = 1700000000  # Simulated clock at the start of every simulation, so runs are reproducible
+STRATEGIES = ['static', 'rule_based', 'q_learning', 'q_table']
+CHECKED_STRATEGIES = ['q_learning', 'q_table']  # Strategies --check requires to earn at least what static fees earn
+
+# Function to check which forwards fit a per-channel liquidity limit, taken in time order:
+# each channel accepts forwards until the first one that does not fit
+def fits_liquidity(index, amounts, limits):
+    order = np.argsort(index, kind='stable')
+    sorted_index = index[order]
+    totals = np.cumsum(amounts[order])
+    before = np.concatenate(([0], totals))[np.searchsorted(sorted_index, sorted_index)]
+    fits = np.empty(len(index), dtype=bool)
+    fits[order] = totals - before <= limits[sorted_index]
+    return fits
+
+class FeeMarket:
+    def __init__(self, num_channels=20, seed=0, now=START_TIME):
+        if num_channels < 2:
+            raise ValueError("the simulator needs at least two channels to route between")
+        rng = np.random.default_rng(seed)
+        self.seed = seed
+        self.now = int(now)
+        self.capacity = rng.choice([1000000, 2000000, 5000000, 10000000], num_channels).astype(np.int64)
+        self.local_msat = (self.capacity * rng.uniform(0.1, 0.9, num_channels)).astype(np.int64) * 1000
+        self.fee_ppm = rng.choice([0, 10, 50, 100, 500], num_channels).astype(np.int64)
+
+        # Demand model: forwards per day out of each channel at a zero fee rate, falling by a
+        # factor of e for every reference_ppm of fee rate, with lognormal amounts
+        self.base_demand = rng.lognormal(np.log(20), 0.8, num_channels)
+        self.reference_ppm = rng.uniform(100, 1500, num_channels)
+        self.median_amount = rng.choice([20000, 50000, 200000], num_channels)  # sats
+
+        self.events = np.zeros(1024, dtype=EVENT_DTYPE)
+        self.num_events = 0
+        self.failed_forwards = 0
+
+    @property
+    def num_channels(self):
+        return len(self.capacity)
+
+    # Function to route the forwards demanded over the next number of seconds and advance the clock
+    def step(self, seconds=86400):
+        n = self.num_channels
+        rng = np.random.default_rng([self.seed, self.now])
+        demand = self.base_demand * np.exp(-self.fee_ppm / self.reference_ppm) * seconds / 86400
+        chan_out = np.repeat(np.arange(n, dtype=np.int32), rng.poisson(demand))
+        count = len(chan_out)
+
+        # Payments arrive through channels in proportion to the balance our peers can spend
+        remote_msat = self.capacity * 1000 - self.local_msat
+        chan_in = rng.choice(n, size=count, p=remote_msat / remote_msat.sum()).astype(np.int32)
+        same = chan_in == chan_out
+        chan_in[same] = (chan_in[same] + rng.integers(1, n, same.sum())) % n
+
+        offsets = rng.integers(0, seconds * 10 ** 9, count)
+        order = np.argsort(offsets, kind='stable')
+        chan_in, chan_out, offsets = chan_in[order], chan_out[order], offsets[order]
+        amt_out = np.maximum(rng.lognormal(np.log(self.median_amount[chan_out]), 1.0), 1000).astype(np.int64) * 1000
+        fees = amt_out * self.fee_ppm[chan_out] // 1000000
+        amt_in = amt_out + fees
+
+        routed = fits_liquidity(chan_out, amt_out, self.local_msat)
+        routed &= fits_liquidity(chan_in, np.where(routed, amt_in, 0), remote_msat)
+        self.local_msat -= np.bincount(chan_out[routed], amt_out[routed], minlength=n).astype(np.int64)
+        self.local_msat += np.bincount(chan_in[routed], amt_in[routed], minlength=n).astype(np.int64)
+        self.failed_forwards += count - int(routed.sum())
+
+        new_events = np.zeros(int(routed.sum()), dtype=EVENT_DTYPE)
+        new_events['timestamp_ns'] = self.now * 10 ** 9 + offsets[routed]
+        new_events['chan_in'], new_events['chan_out'] = chan_in[routed], chan_out[routed]
+        new_events['amt_in_msat'], new_events['amt_out_msat'], new_events['fee_msat'] = amt_in[routed], amt_out[routed], fees[routed]
+        self._append(new_events)
+        self.now += seconds
+        return new_events
+
+    def _append(self, new_events):
+        end = self.num_events + len(new_events)
+        if end > len(self.events):
+            events = np.zeros(max(end, 2 * len(self.events)), dtype=EVENT_DTYPE)
+            events[:self.num_events] = self.events[:self.num_events]
+            self.events = events
+        self.events[self.num_events:end] = new_events
+        self.num_events = end
+
+    # Function to find the range of stored events between two times, in nanoseconds
+    def window(self, start_ns, end_ns):
+        timestamps = self.events['timestamp_ns'][:self.num_events]
+        return int(np.searchsorted(timestamps, start_ns)), int(np.searchsorted(timestamps, end_ns))
+
+    def local_ratio(self):
+        return self.local_msat / (self.capacity * 1000)
+
+# The fake node, backed by a FeeMarket: channel balances, fee policies and forwarding
+# history all come from the market's arrays
+class SimulatedNode(FakeNode):
+    def __init__(self, market):
+        super().__init__(num_channels=0, num_events=0, seed=market.seed, now=market.now)
+        self.market = market
+        self.chan_ids = [str(700000 * 2 ** 40 + i * 2 ** 16 + 1) for i in range(market.num_channels)]
+        for i, chan_id in enumerate(self.chan_ids):
+            remote_pubkey = '02' + self.rng.getrandbits(256).to_bytes(32, 'big').hex()
+            self.peer_aliases[remote_pubkey] = f"sim-peer-{i}"
+            self.channels[chan_id] = {'chan_id': chan_id, 'channel_point': f"{self.rng.getrandbits(256):064x}:0", 'remote_pubkey': remote_pubkey,
+                                      'peer_alias': f"sim-peer-{i}", 'capacity': str(int(market.capacity[i])), 'active': True}
+            self.policies[chan_id] = {'fee_base_msat': '0', 'fee_rate_milli_msat': str(int(market.fee_ppm[i])),
+                                      'time_lock_delta': 40, 'min_htlc': '1000', 'disabled': False}
+            self.peer_policies[chan_id] = {'fee_base_msat': '1000', 'fee_rate_milli_msat': str(self.rng.randint(0, 2000)),
+                                           'time_lock_delta': 80, 'min_htlc': '1000', 'disabled': False}
+
+    def _listchannels(self, **flags):
+        local_balance = (self.market.local_msat // 1000).tolist()
+        for chan_id, balance, capacity in zip(self.chan_ids, local_balance, self.market.capacity.tolist()):
+            self.channels[chan_id]['local_balance'] = str(balance)
+            self.channels[chan_id]['remote_balance'] = str(capacity - balance)
+        return super()._listchannels(**flags)
+
+    def _fwdinghistory(self, start_time=0, end_time=None, index_offset=0, max_events=100):
+        end_time = self.market.now if end_time is None else end_time
+        first, last = self.market.window(int(start_time) * 10 ** 9, int(end_time) * 10 ** 9)
+        first = min(first + int(index_offset), last)
+        forwarding_events = forwarding_event_dicts(self.market.events[first:min(first + int(max_events), last)], self.chan_ids)
+        return {'forwarding_events': forwarding_events, 'last_offset_index': int(index_offset) + len(forwarding_events)}
+
+    def _updatechanpolicy(self, **flags):
+        result = super()._updatechanpolicy(**flags)
+        self.market.fee_ppm[:] = [int(self.policies[chan_id]['fee_rate_milli_msat']) for chan_id in self.chan_ids]
+        return result
+
+# Function to point the agent's configuration at a simulated node and scratch files, restoring it afterwards
+@contextmanager
+def agent_settings(**settings):
+    previous = {name: getattr(agent, name) for name in settings}
+    for name, value in settings.items():
+        setattr(agent, name, value)
+    try:
+        yield
+    finally:
+        for name, value in previous.items():
+            setattr(agent, name, value)
+
+# Function to simulate one strategy: each simulated day, the market routes a day of forwards
+# and then the agent runs once, as it would from cron
+def run_simulation(strategy, days=365, num_channels=20, seed=0):
+    market = FeeMarket(num_channels, seed)
+    node = SimulatedNode(market)
+    started = time.perf_counter()
+    with tempfile.TemporaryDirectory() as workdir, open(os.devnull, 'w') as devnull:
+        settings = dict(NODE=node, NODE_PUBKEY=None, CLOCK=lambda: market.now, DEBUG=False, PROMPT=False, DRY_RUN=False, BATCH_UPDATES=True,
+                        QTABLE=strategy in ('q_learning', 'q_table'), Q_STORE=strategy == 'q_learning', REPLAY_EPOCHS=0,
+                        Q=np.zeros((agent.num_states, agent.num_actions)), Q_STORE_TABLE=None, TRAINING_CHECKPOINT=None,
+                        DATA_FILE=os.path.join(workdir, 'fee_adjustment_data.csv'), DATA_STORE_FILE=os.path.join(workdir, 'fee_adjustment_data.db'),
+                        DATA_STORE_DIR=os.path.join(workdir, 'fee_adjustment_data'),
+                        DATA_STORE=None, EVENT_STORE_FILE=os.path.join(workdir, 'forwarding_events.db'),
+                        Q_TABLE_FILE=os.path.join(workdir, 'q_table.npy'), Q_CHECKPOINT_FILE=os.path.join(workdir, 'q_table_checkpoint.json'),
+                        Q_STORE_DIR=os.path.join(workdir, 'q_store'), ALIAS_CACHE_FILE=':memory:', EVENT_STORE=None,
+                        FEE_UPDATE_TIMES={}, FEE_UPDATE_TIMES_FILE=os.path.join(workdir, 'fee_update_times.json'))
+        with agent_settings(**settings), redirect_stdout(devnull):
+            np.random.seed(seed)  # Exploration in the agent's action selection
+            for day in range(days):
+                market.step(86400)
+                if strategy != 'static':
+                    agent.run_phase()
+            agent.close_event_store()
+            agent.close_data_store()
+
+    events = market.events[:market.num_events]
+    return {'strategy': strategy, 'seed': seed, 'days': days, 'channels': num_channels,
+            'fees_sat': int(events['fee_msat'].sum()) // 1000, 'volume_sat': int(events['amt_out_msat'].sum()) // 1000,
+            'forwards': int(market.num_events), 'failed_forwards': int(market.failed_forwards),
+            'mean_fee_ppm': float(market.fee_ppm.mean()), 'mean_local_ratio': float(market.local_ratio().mean()),
+            'seconds': time.perf_counter() - started}
+
+# Function to print the results of every strategy, averaged over the seeds
+def print_comparison(results):
+    print(f"{'strategy':>11} {'fees (sat)':>12} {'volume (sat)':>14} {'forwards':>9} {'failed':>8} {'fee (ppm)':>10} {'local':>6} {'days/min':>9}")
+    for strategy in dict.fromkeys(result['strategy'] for result in results):
+        runs = [result for result in results if result['strategy'] == strategy]
+        mean = {key: np.mean([run[key] for run in runs]) for key in ('fees_sat', 'volume_sat', 'forwards', 'failed_forwards', 'mean_fee_ppm', 'mean_local_ratio')}
+        days_per_minute = 60 * sum(run['days'] for run in runs) / sum(run['seconds'] for run in runs)
+        print(f"{strategy:>11} {mean['fees_sat']:>12.0f} {mean['volume_sat']:>14.0f} {mean['forwards']:>9.0f} {mean['failed_forwards']:>8.0f} "
+              f"{mean['mean_fee_ppm']:>10.1f} {mean['mean_local_ratio']:>6.2f} {days_per_minute:>9.0f}")
+
+# Function to find the checked strategies that earned less in fees than static fees, averaged over the seeds
+def failed_checks(results):
+    fees = {}
+    for result in results:
+        fees.setdefault(result['strategy'], []).append(result['fees_sat'])
+    return [strategy for strategy in CHECKED_STRATEGIES if strategy in fees and np.mean(fees[strategy]) < np.mean(fees['static'])]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare fee_setting_agent.py strategies on a simulated fee market")
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--channels', type=int, default=20)
+    parser.add_argument('--seeds', type=int, nargs='+', default=[0])
+    parser.add_argument('--strategies', nargs='+', choices=STRATEGIES, default=STRATEGIES)
+    parser.add_argument('--json', metavar='FILE', help="Also write every run's results to this file")
+    parser.add_argument('--check', action='store_true', help=f"Exit with an error if {' or '.join(CHECKED_STRATEGIES)} earns less than static fees")
+    options = parser.parse_args(argv)
+    if options.check and 'static' not in options.strategies:
+        options.strategies = ['static'] + options.strategies
+
+    results = []
+    for seed in options.seeds:
+        for strategy in options.strategies:
+            results.append(run_simulation(strategy, options.days, options.channels, seed))
+            print(f"Simulated {options.days} days of {strategy}, seed {seed}, in {results[-1]['seconds']:.1f}s", file=sys.stderr)
+    print_comparison(results)
+    if options.json:
+        with open(options.json, 'w') as file:
+            json.dump(results, file, indent=2)
+    if options.check:
+        failed = failed_checks(results)
+        for strategy in failed:
+            print(f"Check failed: {strategy} earned less in fees than static fees")
+        return 1 if failed else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())